@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#
+# Compact binary traces of raw scan results, captured on the bridge and replayed on a host.
+#
+# A trace is b'BLTR' and a version byte, then one record per scan result:
+#   ts_ms (u32, since capture start), addr_type, addr (6), adv_type, rssi (i8), len, payload
+# Scan responses (adv_type 4) are separate records, like the radio delivers them.
+#
+# Replay feeds records through the same decoding and reporting as basic.py (lights.py), so parser
+# changes can be checked against real captures without a board:
+#   ./advtrace.py capture.bin --speed 0            # as fast as possible, reports timing
+#   ./advtrace.py capture.bin --speed 1 --send beacon-reporting.whistlr.info:9999
+
+import struct
+
+try:
+  from micropython import const
+except ImportError:
+  def const(x):
+    return x
+
+import lights
+
+
+MAGIC = b'BLTR'
+VERSION = const(1)
+RECORD = '<IB6sBbB'
+RECORD_SIZE = const(14)
+
+_IRQ_SCAN_RESULT = const(5)
+_ADV_SCAN_RSP = const(4)
+
+_BUFFER_SIZE = const(4096)
+_MAX_PAYLOAD = const(31)
+
+
+class TraceWriter:
+  """Captures scan results on the bridge.
+
+  Records are packed straight into a preallocated buffer from the BLE IRQ (no allocation there),
+  and written to the file from flush(), which is called outside it. Results that arrive while the
+  buffer is full, or after the file reaches max_bytes, are counted and dropped.
+  """
+
+  def __init__(self, path, max_bytes=256 * 1024):
+    import time
+    self._ticks_ms = time.ticks_ms
+    self._ticks_diff = time.ticks_diff
+
+    self._file = open(path, 'wb')
+    self._file.write(MAGIC + bytes([VERSION]))
+    self._written = len(MAGIC) + 1
+    self._max_bytes = max_bytes
+
+    self._buffer = bytearray(_BUFFER_SIZE)
+    self._used = 0
+    self._start = self._ticks_ms()
+    self.records = 0
+    self.dropped = 0
+
+  def install(self):
+    from aioble import core
+    core._irq_handlers.insert(0, self._irq)  # returns None, so aioble still sees every result
+
+  def uninstall(self):
+    from aioble import core
+    if self._irq in core._irq_handlers:
+      core._irq_handlers.remove(self._irq)
+    self.flush()
+    self._file.close()
+
+  def _irq(self, event, data):
+    if event != _IRQ_SCAN_RESULT:
+      return None
+    addr_type, addr, adv_type, rssi, adv_data = data
+    length = min(len(adv_data), _MAX_PAYLOAD)
+    end = self._used + RECORD_SIZE + length
+    if end > _BUFFER_SIZE or self._written + end > self._max_bytes:
+      self.dropped += 1
+      return None
+
+    ts = self._ticks_diff(self._ticks_ms(), self._start)
+    struct.pack_into(RECORD, self._buffer, self._used, ts, addr_type, addr, adv_type, rssi, length)
+    self._buffer[self._used + RECORD_SIZE:end] = adv_data[:length]
+    self._used = end
+    self.records += 1
+    return None
+
+  def flush(self):
+    used = self._used  # anything added from here on is written next time
+    if not used:
+      return
+    self._file.write(memoryview(self._buffer)[:used])
+    self._file.flush()
+    self._written += used
+
+    # move anything the IRQ appended while we were writing to the front
+    import machine
+    irq = machine.disable_irq()
+    extra = self._used - used
+    if extra:
+      self._buffer[:extra] = self._buffer[used:used + extra]
+    self._used = extra
+    machine.enable_irq(irq)
+
+  async def run(self, interval_ms=1000):
+    import uasyncio as asyncio
+    while True:
+      await asyncio.sleep_ms(interval_ms)
+      self.flush()
+
+
+def read_trace(f):
+  """Yields (ts_ms, addr_type, addr, adv_type, rssi, payload) for each record in a trace file."""
+  header = f.read(len(MAGIC) + 1)
+  if header[:len(MAGIC)] != MAGIC:
+    raise ValueError('not a trace')
+  if header[len(MAGIC)] != VERSION:
+    raise ValueError('unsupported trace version {}'.format(header[len(MAGIC)]))
+
+  while True:
+    head = f.read(RECORD_SIZE)
+    if len(head) < RECORD_SIZE:
+      return  # a capture cut off mid-record just ends early
+    ts, addr_type, addr, adv_type, rssi, length = struct.unpack(RECORD, head)
+    payload = f.read(length)
+    if len(payload) < length:
+      return
+    yield ts, addr_type, addr, adv_type, rssi, payload
+
+
+class Replay:
+  """Runs trace records through lights.parse_result and a LightTable, like basic.py's scan()."""
+
+  def __init__(self):
+    self.table = lights.LightTable()
+    self.known = set()
+    self._resp = {}  # addr => last scan response, merged with later advertisements
+    self.records = 0
+    self.results = 0
+    self.reported = 0
+
+  def feed(self, ts, addr_type, addr, adv_type, rssi, payload):
+    """Returns the state if it's news for the server, else None."""
+    self.records += 1
+    if adv_type == _ADV_SCAN_RSP:
+      self._resp[addr] = payload
+      return None
+
+    parsed = lights.parse_result(addr_type, addr, payload, self._resp.get(addr), self.known)
+    if not parsed:
+      return None
+    self.results += 1
+    _, is_on, brightness = parsed
+    state = self.table.seen(addr, is_on, brightness, ts)
+    if state:
+      self.reported += 1
+    return state
+
+
+def main():
+  import argparse
+  import json
+  import socket
+  import sys
+  import time
+
+  parser = argparse.ArgumentParser(description='Replay a captured advertisement trace.')
+  parser.add_argument('trace')
+  parser.add_argument('--speed', type=float, default=0, help='1 for real time, 0 for as fast as possible')
+  parser.add_argument('--send', help='host:port of a beacon server to send frames to')
+  parser.add_argument('--verbose', action='store_true', help='print each reported state')
+  args = parser.parse_args()
+
+  sock = None
+  if args.send:
+    host, port = args.send.rsplit(':', 1)
+    sock = socket.create_connection((host, int(port)))
+
+  replay = Replay()
+  frames = 0
+  start = time.monotonic()
+  busy = 0.0
+
+  with open(args.trace, 'rb') as f:
+    for record in read_trace(f):
+      ts = record[0]
+      if args.speed > 0:
+        wait = start + ts / 1000.0 / args.speed - time.monotonic()
+        if wait > 0:
+          time.sleep(wait)
+
+      t = time.perf_counter()
+      state = replay.feed(*record)
+      out = []
+      frame = replay.table.pop_change(ts)
+      while frame is not None:
+        out.append(frame)
+        frame = replay.table.pop_change(ts)
+      busy += time.perf_counter() - t
+
+      if state and args.verbose:
+        print(record[2].hex(':'), 'on=', state.is_on, 'brightness=', state.brightness, file=sys.stderr)
+      if out:
+        frames += len(out)
+        if sock:
+          sock.sendall(b''.join(out))
+
+  if sock:
+    sock.close()
+
+  print(json.dumps({
+    'records': replay.records,
+    'results': replay.results,
+    'reported': replay.reported,
+    'frames': frames,
+    'lights': len(replay.table.known),
+    'elapsed_s': round(time.monotonic() - start, 3),
+    'records_per_s': round(replay.records / busy) if busy else None,
+    'us_per_record': round(busy * 1e6 / replay.records, 2) if replay.records else None,
+  }))
+
+
+if __name__ == '__main__':
+  main()
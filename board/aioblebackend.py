@@ -0,0 +1,126 @@
+import uasyncio as asyncio
+import aioble
+import pyb
+import time
+
+import bridgecore
+import latency as latency_module
+import registers
+
+
+class AiobleBackend(bridgecore.Backend):
+  """The pyboard's own radio, through aioble.
+
+  Connections come from links when one is held open, else are made for the command (with
+  adaptive timeouts from the latency table). Links are encrypted from the stored bond when
+  there is one, and after a write the state is read back and any queued register reads run.
+  """
+
+  def __init__(self, settings, write_engine, register_client, bonds, pairing_stats, latency):
+    self._settings = settings
+    self._write_engine = write_engine
+    self._register_client = register_client
+    self._bonds = bonds
+    self._pairing_stats = pairing_stats
+    self._latency = latency
+    self.links = None  # a PersistentLinks, if connections to busy lights are held open
+
+  async def scan(self, duration_ms, interval_us, window_us, active, started, on_result):
+    async with aioble.scan(duration_ms, interval_us=interval_us, window_us=window_us, active=active) as scanner:
+      started()
+      async for result in scanner:
+        on_result(result.device.addr_type, result.device.addr, result.adv_data, result.resp_data)
+
+  async def secure(self, connection):
+    """Encrypts the link: from the stored bond if there is one (quick), else by pairing."""
+    addr = connection.device.addr
+    stats = self._pairing_stats
+    if connection.encrypted:
+      stats.already += 1
+      return
+
+    # aioble's pair() doesn't report failure, so check the link afterwards
+    if self._bonds.has_bond(addr):
+      start = time.ticks_ms()
+      # A timeout or a dropped link says nothing about the bond (the adaptive timeout can be
+      # short), so keep it and let the retry use it again.
+      await connection.pair(timeout_ms=self._latency.begin(addr, latency_module.PAIR))
+      if connection.encrypted:
+        self._latency.end()
+        stats.fast += 1
+        stats.fast_ms += time.ticks_diff(time.ticks_ms(), start)
+        return
+      if not connection.is_connected():
+        raise aioble.DeviceDisconnectedError()
+
+      print('bond not accepted, pairing', addr)
+      stats.fallbacks += 1
+      self._bonds.forget(addr)
+
+    start = time.ticks_ms()
+    await connection.pair(timeout_ms=self._settings.pair_timeout_ms)
+    if not connection.encrypted:
+      raise asyncio.TimeoutError()  # as pairing would on a timeout, so it's retried
+    stats.slow += 1
+    stats.slow_ms += time.ticks_diff(time.ticks_ms(), start)
+
+  async def _enact(self, connection, command, confirm, mark):
+    addr = connection.device.addr
+    mark(bridgecore.CONNECTED)
+    await self.secure(connection)
+    mark(bridgecore.PAIRED)
+
+    round_trips = await self._write_engine.write(
+        connection, command, self._latency.begin(addr, latency_module.WRITE))
+    self._latency.end()
+    mark(bridgecore.WRITTEN)
+    print('wrote in', round_trips, 'round trips')
+
+    # Confirm right away, rather than the server waiting for the next advertisement.
+    try:
+      is_on, brightness = await self._write_engine.read_state(connection)
+      confirm(addr, is_on, brightness)
+      mark(bridgecore.CONFIRMED)
+    except Exception as e:
+      print('confirm failed', bridgecore.log_exception(e, addr))
+
+    if self._register_client.pending(addr):
+      # metadata rides along on the connection we already have
+      try:
+        handles = await self._write_engine.discover(connection)
+        done = await self._register_client.run(connection, handles)
+        print('registers done', done)
+      except Exception as e:
+        print('registers failed', bridgecore.log_exception(e, addr))
+
+  async def enact(self, addr, command, confirm, mark):
+    try:
+      connection = self.links and self.links.connection(addr)
+      if connection:
+        await self._enact(connection, command, confirm, mark)  # held open by links, so leave it open
+      else:
+        device = aioble.Device(0, addr)
+        connection = await device.connect(timeout_ms=self._latency.begin(addr, latency_module.CONNECT))
+        self._latency.end()
+        async with connection:
+          await self._enact(connection, command, confirm, mark)
+    except Exception as e:
+      self._latency.outcome(addr, False, e.__class__.__name__ == 'TimeoutError')
+      raise
+    self._latency.outcome(addr, True)
+
+  def pick(self, addrs):
+    return self._latency.pick(addrs)
+
+  def note_command(self, addr):
+    if self.links:
+      self.links.note_command(addr)
+    client = self._register_client
+    if not client.pending(addr) and client.cached(addr, registers.REGISTER_NAME) is None:
+      client.queue_read(addr, registers.REGISTER_NAME, registers.NAME_LENGTH)
+
+  def indicate(self, busy):
+    if busy:
+      pyb.LED(1).on()
+    else:
+      pyb.LED(1).off()
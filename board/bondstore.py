@@ -0,0 +1,211 @@
+from micropython import const
+
+import os
+import struct
+import micropython
+import uasyncio as asyncio
+
+
+# Each log record is a header followed by key and value bytes. A zero-length value is a delete.
+_HEADER = '<BBBH'
+_HEADER_SIZE = const(5)
+_OP_SET = const(1)
+_OP_DELETE = const(0)
+
+_IRQ_GET_SECRET = const(29)
+_IRQ_SET_SECRET = const(30)
+
+SECURITY_TYPE = const(0x73)
+
+_FLUSH_DELAY_MS = const(2000)  # batch writes that arrive during a single pairing
+_COMPACT_MIN = const(16)       # always allow this many stale records before compacting
+
+
+class BondStore:
+  """Bond/secret storage for the BLE stack.
+
+  Secrets are held in memory, indexed by (type, key) and by ordinal within each type, so both
+  lookups done by _IRQ_GET_SECRET are O(1). Changes are appended to an on-flash log outside the
+  IRQ path, and the log is compacted once it's mostly stale records.
+  """
+
+  def __init__(self, path='bonds.log'):
+    self._path = path
+    self._secrets = {}  # (sec_type, key) => value
+    self._by_type = {}  # sec_type => [key, ...] in insertion order
+    self._dirty = []    # (op, sec_type, key, value) waiting to be appended
+    self._records = 0   # records currently in the on-flash log
+    self._flag = None
+    self._scheduled = False
+    self._had_log = True
+
+    try:
+      self._load()
+    except OSError:
+      self._had_log = False  # no log yet
+
+  def __len__(self):
+    return len(self._secrets)
+
+  def _keys_for(self, addr):
+    # the stack's keys hold the peer address, in either byte order depending on the type
+    reverse = bytes(reversed(addr))
+    return [k for k in self._secrets if addr in k[1] or reverse in k[1]]
+
+  def has_bond(self, addr):
+    return bool(self._keys_for(addr))
+
+  def forget(self, addr):
+    """Deletes everything stored for a peer, e.g. when it no longer accepts our bond."""
+    for sec_type, key in self._keys_for(addr):
+      self.set_secret(sec_type, key, None)
+
+  def get_secret(self, sec_type, index, key):
+    if key:
+      return self._secrets.get((sec_type, bytes(key)), None)
+
+    keys = self._by_type.get(sec_type)
+    if not keys or index >= len(keys):
+      return None
+    return self._secrets[sec_type, keys[index]]
+
+  def set_secret(self, sec_type, key, value):
+    key = bytes(key)
+    value = bytes(value) if value else None
+
+    if not self._apply(sec_type, key, value):
+      return False
+
+    self._dirty.append((value is None and _OP_DELETE or _OP_SET, sec_type, key, value))
+    self._wake()
+    return True
+
+  def install(self, security=None):
+    """Takes over secret storage from aioble's security module.
+
+    Our handler is placed before aioble's own and answers every get/set secret, including
+    misses. Secrets aioble loaded from its JSON file are migrated if we have no log yet (first
+    use), then dropped from aioble (and its file), so deleted keys can't come back from there.
+    """
+    from aioble import core
+
+    if security is not None and security._secrets:
+      if not self._had_log:
+        for (sec_type, key), value in security._secrets.items():
+          self.set_secret(sec_type, key, value)
+        self.flush()  # the log must exist before aioble's copy goes
+      security._secrets.clear()
+      security._modified = True
+      security._save_secrets()
+
+    core._irq_handlers.insert(0, self._irq)
+    core._shutdown_handlers.append(self.flush)
+
+  def _irq(self, event, data):
+    if event == _IRQ_SET_SECRET:
+      return self.set_secret(*data)
+    elif event == _IRQ_GET_SECRET:
+      return self.get_secret(*data)  # None on a miss: aioble's copy is cleared, so it misses too
+
+  def _apply(self, sec_type, key, value):
+    k = sec_type, key
+    if value is None:
+      if k not in self._secrets:
+        return False
+      del self._secrets[k]
+      self._by_type[sec_type].remove(key)
+      return True
+
+    if k not in self._secrets:
+      self._by_type.setdefault(sec_type, []).append(key)
+    self._secrets[k] = value
+    return True
+
+  def _wake(self):
+    if self._flag is not None:
+      self._flag.set()
+    elif not self._scheduled:
+      # No flush task running (e.g., test.py), so write from the scheduler instead.
+      self._scheduled = True
+      micropython.schedule(self._scheduled_flush, None)
+
+  def _scheduled_flush(self, _):
+    self._scheduled = False
+    self.flush()
+
+  async def run(self):
+    """Flushes batched changes to flash. Run as a task."""
+    self._flag = asyncio.ThreadSafeFlag()
+    if self._dirty:
+      self._flag.set()
+    while True:
+      await self._flag.wait()
+      await asyncio.sleep_ms(_FLUSH_DELAY_MS)
+      self.flush()
+
+  def flush(self):
+    if not self._dirty:
+      return
+    dirty = self._dirty
+    self._dirty = []
+
+    if self._records + len(dirty) > 2 * len(self._secrets) + _COMPACT_MIN:
+      self._compact()
+    else:
+      with open(self._path, 'ab') as f:
+        for record in dirty:
+          _write_record(f, *record)
+      self._records += len(dirty)
+    os.sync()
+    print('bonds flushed', len(dirty), 'records', self._records)
+
+  def _compact(self):
+    tmp = self._path + '.tmp'
+    with open(tmp, 'wb') as f:
+      for (sec_type, key), value in self._secrets.items():
+        _write_record(f, _OP_SET, sec_type, key, value)
+    os.rename(tmp, self._path)
+    self._records = len(self._secrets)
+
+  def _load(self):
+    with open(self._path, 'rb') as f:
+      while True:
+        header = f.read(_HEADER_SIZE)
+        if len(header) < _HEADER_SIZE:
+          break  # end, or truncated by a reset mid-write
+        op, sec_type, key_len, value_len = struct.unpack(_HEADER, header)
+        key = f.read(key_len)
+        value = f.read(value_len)
+        if len(key) != key_len or len(value) != value_len:
+          break
+        self._apply(sec_type, key, op == _OP_SET and value or None)
+        self._records += 1
+
+
+def _write_record(f, op, sec_type, key, value):
+  value = value or b''
+  f.write(struct.pack(_HEADER, op, sec_type, len(key), len(value)))
+  f.write(key)
+  f.write(value)
+
+
+class PairingStats:
+  """Counts how each connection was secured, and the time it took."""
+
+  def __init__(self):
+    self.already = 0    # encrypted already (e.g., a held connection)
+    self.fast = 0       # encryption restored from a stored bond
+    self.fast_ms = 0
+    self.slow = 0       # full pairing
+    self.slow_ms = 0
+    self.fallbacks = 0  # stored bond didn't work, so paired again
+
+  def frame(self):
+    fast_avg = self.fast_ms // self.fast if self.fast else 0
+    slow_avg = self.slow_ms // self.slow if self.slow else 0
+    return bytes(6) + struct.pack('>BHHHHB', SECURITY_TYPE, min(0xffff, self.fast), min(0xffff, fast_avg),
+                                  min(0xffff, self.slow), min(0xffff, slow_avg), min(0xff, self.fallbacks))
+
+  def summary(self):
+    return 'security already %d fast %d (%d ms) slow %d (%d ms) fallbacks %d\n' % (
+        self.already, self.fast, self.fast_ms, self.slow, self.slow_ms, self.fallbacks)
@@ -0,0 +1,440 @@
+# The bridge itself: scan results into the light table, the queue of commands to enact, and the
+# 16-byte protocol to the server. The radio is behind a backend (see Backend below), so this runs
+# under MicroPython on the pyboard (aioblebackend.py, from basic.py) and under CPython on a host
+# (simbackend.py, from host.py).
+
+import struct
+import sys
+
+try:
+  import uasyncio as asyncio
+  sleep_ms = asyncio.sleep_ms
+except ImportError:
+  import asyncio
+
+  def sleep_ms(ms):
+    return asyncio.sleep(ms / 1000)
+
+import lights
+import settings as settings_module
+
+
+BACKOFF_MAX = 8
+PUSHED_ATTEMPTS = 3  # failed connects to a server address pushed by the server, before the default
+OUTBOX_MAX = 32
+
+# Commands from the server carry a trace ID (rest[3:5], zero for none), and the bridge reports
+# the time it reached each stage: [TRACE_TYPE, stage, id (2), ticks (4), attempt, ok]. The server
+# relates our ticks to its clock by sending [CLOCK_TYPE, 0, its time (4)], which is echoed back
+# right away with ours appended.
+TRACE_TYPE = 0x54
+CLOCK_TYPE = 0x74
+TICKS_MASK = 0x3fffffff  # MicroPython ticks wrap at 2**30
+
+RECEIVED = 1
+DEQUEUED = 2
+CONNECTED = 3
+PAIRED = 4
+WRITTEN = 5
+CONFIRMED = 6
+DONE = 7
+
+
+def log_exception(e, addr=None):
+  name = e.__class__.__name__
+  known_names = ['TimeoutError', 'DeviceDisconnectedError']
+  if name in known_names:
+    return name
+  if name == 'OSError':
+    return name + ': ' + str(e.args[0])
+
+  print('exception', e.__class__, 'for', addr)
+  print('>----', addr)
+  if hasattr(sys, 'print_exception'):
+    sys.print_exception(e)
+  else:
+    import traceback
+    traceback.print_exception(type(e), e, e.__traceback__)
+  print('<----')
+  return name
+
+
+class PendingCommand(object):
+  def __init__(self, trace=0):
+    self.set_on = None
+    self.toggle_on = None
+    self.set_brightness = None
+    self.when = None
+    self.trace = trace
+    self.attempt = 0
+
+  def valid(self, expiry_ms):
+    now = lights.ticks_ms()
+    if self.when is None:
+      # only check validity from the first time this was attempted
+      self.when = now
+    return lights.ticks_diff(now, self.when) <= expiry_ms
+
+  def __str__(self):
+    parts = ['PendingCommand']
+    if self.set_on is not None:
+      parts.append('set_on=' + str(self.set_on))
+    if self.toggle_on is not None:
+      parts.append('toggle_on=' + str(self.toggle_on))
+    if self.set_brightness is not None:
+      parts.append('set_brightness=' + str(self.set_brightness))
+    if self.when is not None:
+      parts.append('when=' + str(self.when))
+    if self.trace:
+      parts.append('trace=' + str(self.trace))
+    return '<' + ' '.join(parts) + '>'
+
+
+def build_command(on, brightness, trace=0):
+  pc = PendingCommand(trace)
+
+  # control on/off (or toggle on/off)
+  if on == 2:
+    pc.toggle_on = True
+  elif on == 1:
+    pc.set_on = True
+  elif on == 0:
+    pc.set_on = False
+
+  brightness = int(brightness)
+  if brightness <= 100:
+    pc.set_brightness = brightness
+
+  return pc
+
+
+class Backend:
+  """The radio, as the bridge uses it. Subclasses implement scan() and enact()."""
+
+  async def scan(self, duration_ms, interval_us, window_us, active, started, on_result):
+    """Scans for duration_ms. Calls started() once scanning, then for each result
+    on_result(addr_type, addr, adv_data, resp_data)."""
+    raise NotImplementedError()
+
+  async def enact(self, addr, command, confirm, mark):
+    """Connects to addr and writes command (a PendingCommand), raising if that fails. Calls
+    confirm(addr, is_on, brightness) if the state could be read back, and mark(stage) as it
+    reaches CONNECTED, PAIRED, WRITTEN and CONFIRMED."""
+    raise NotImplementedError()
+
+  def pick(self, addrs):
+    """Chooses which of the lights with pending commands to try next."""
+    return addrs[0]
+
+  def note_command(self, addr):
+    """Called as a command for addr is queued."""
+    pass
+
+  def indicate(self, busy):
+    """Called as the bridge starts and stops having commands to enact."""
+    pass
+
+
+class Bridge:
+  """Scans, enacts commands and talks to the server, with a backend for the radio.
+
+  Frames from a zero MAC are for the bridge itself: settings are handled here, and other types
+  go to handlers (type => callable(rest), returning True if the bridge should reconnect).
+  """
+
+  def __init__(self, backend, settings, scan_policy, ble_lock=None, hostname=None, fallback=None, port=None):
+    self.backend = backend
+    self.settings = settings
+    self.scan_policy = scan_policy
+    self.hostname = hostname  # the default server, with fallback if it doesn't resolve
+    self.fallback = fallback
+    self.port = port or settings.default('server_port')
+    self._pushed_failures = 0
+
+    self.ble_lock = ble_lock or asyncio.Lock()
+    self._pending_lock = asyncio.Lock()
+    self._update_event = asyncio.Event()
+
+    self.light_table = lights.LightTable()  # sent as a snapshot on connect, and changes as they happen
+    self.outbox = []         # other 16-byte frames for the server (e.g., telemetry)
+    self.pending = {}        # addr => PendingCommand
+    self._enacting = None    # the PendingCommand enact_forever holds, traced by it
+    self.observers = []      # each called with (addr, is_on, brightness) for every state seen
+    self.handlers = {}
+    self._report_settings = True
+
+  def seen(self, addr, is_on, brightness):
+    """Records a state from an advertisement or a notification. Returns it if it's news."""
+    for observer in self.observers:
+      observer(addr, is_on, brightness)
+    state = self.light_table.seen(addr, is_on, brightness)
+    if state:
+      self._update_event.set()
+    return state
+
+  def confirm(self, addr, is_on, brightness):
+    self.light_table.confirm(addr, is_on, brightness)
+    for observer in self.observers:
+      observer(addr, is_on, brightness)
+    self._update_event.set()
+    print('(confirm) device on=', is_on, 'brightness=', brightness)
+
+  def _scan_result(self, addr_type, addr, adv_data, resp_data):
+    parsed = lights.parse_result(addr_type, addr, adv_data, resp_data, self.scan_policy.known)
+    if not parsed:
+      return
+    name, is_on, brightness = parsed
+    self.scan_policy.observe(addr)
+    if self.seen(addr, is_on, brightness):
+      print('(scan) device', name, 'on=', is_on, 'brightness=', brightness)
+
+  async def scan(self):
+    await self.ble_lock.acquire()
+
+    # scans are short and restarted, so the policy can change parameters as things change
+    duration_ms, interval_us, window_us, active = self.scan_policy.next(len(self.pending) > 0)
+    start = lights.ticks_ms()
+
+    print('scanning...')
+    print('(scan) window', window_us, 'interval', interval_us, 'active', active)
+    await self.backend.scan(
+        duration_ms, interval_us, window_us, active, self.ble_lock.release, self._scan_result)
+
+    self.scan_policy.finish(lights.ticks_diff(lights.ticks_ms(), start))
+
+  async def scan_forever(self):
+    while True:
+      await self.scan()
+      await sleep_ms(self.settings.delay_ms)
+
+  async def enact_forever(self):
+    while True:
+      if not len(self.pending):
+        self.backend.indicate(False)
+        await self._pending_lock.acquire()
+        await self.ble_lock.acquire()
+
+      # Pick the next command to try, favouring lights that are likely to succeed.
+      addr = self.backend.pick(list(self.pending.keys()))
+      command = self.pending[addr]
+      self._enacting = command
+      command.attempt += 1
+      self.trace(command, DEQUEUED)
+      ok = True
+
+      try:
+        print('enact', addr, '...')
+        await self.backend.enact(addr, command, self.confirm, lambda stage: self.trace(command, stage))
+        print('enacted!', addr)
+        self.trace(command, DONE)
+      except Exception as e:
+        ok = False
+        print(log_exception(e, addr))
+
+      await sleep_ms(self.settings.delay_ms)
+
+      if not ok and self.pending.get(addr) is not command:
+        self.trace(command, DONE, 0)  # replaced while it was enacted, the newer one runs next
+        continue
+
+      # If this is still within a valid window, try again.
+      if not ok:
+        if command.valid(self.settings.command_expiry_ms):
+          continue
+        print('abandoned task for', addr, 'command', command)
+        self.trace(command, DONE, 0)
+        await sleep_ms(self.settings.delay_ms)  # scan gets unhappy without this
+
+      # A newer command may have replaced this one while it was in flight: that one runs next.
+      if self.pending.get(addr) is command:
+        del self.pending[addr]
+      if not len(self.pending):
+        self.ble_lock.release()
+
+  def insert_command(self, addr, pc):
+    print('inserting', addr, pc)
+    self.trace(pc, RECEIVED)
+    if not len(self.pending):
+      self._pending_lock.release()  # allow task to run
+    elif addr in self.pending and self.pending[addr] is not self._enacting:
+      self.trace(self.pending[addr], DONE, 0)  # replaced before it was enacted
+
+    self.pending[addr] = pc
+    self.backend.indicate(True)
+    self.scan_policy.need_discovery(addr)
+    self.backend.note_command(addr)
+
+  async def read_command(self, mac, rest):
+    trace = len(rest) >= 5 and (rest[3] << 8 | rest[4]) or 0
+    self.insert_command(mac, build_command(rest[1], rest[2], trace))
+
+  def trace(self, command, stage, ok=1):
+    """Reports a stage of a traced command to the server."""
+    if not command.trace:
+      return
+    ticks = lights.ticks_ms() & TICKS_MASK
+    self.send_frame(bytes(6) + struct.pack(
+        '>BBHIBB', TRACE_TYPE, stage, command.trace, ticks, min(command.attempt, 255), ok))
+
+  def read_bridge_command(self, rest):
+    """Handles a frame for the bridge itself. Returns True if we should reconnect."""
+    if rest[0] == CLOCK_TYPE:
+      ticks = lights.ticks_ms() & TICKS_MASK
+      self.send_frame(bytes(6) + bytes([CLOCK_TYPE, 0]) + bytes(rest[2:6]) + struct.pack('>I', ticks))
+      return False
+    handler = self.handlers.get(rest[0])
+    if handler:
+      return handler(rest)
+    if rest[0] != settings_module.SETTINGS_TYPE:
+      print('unknown bridge command', rest)
+      return False
+    if not self.settings.handle(rest):
+      return False
+
+    self._report_settings = True
+    self._update_event.set()
+    changed = self.settings.take_changed()
+    return any(name in changed for name in settings_module.SERVER_KNOBS)
+
+  def send_frame(self, frame):
+    self.outbox.append(frame)
+    if len(self.outbox) > OUTBOX_MAX:
+      self.outbox.pop(0)  # drop oldest, we're probably disconnected
+    self._update_event.set()
+
+  async def _open(self):
+    settings = self.settings
+    pushed = settings.server_ip or settings.server_port != settings.default('server_port')
+    if pushed and self._pushed_failures < PUSHED_ATTEMPTS:
+      host = settings.server_ip and settings.server_ip_str() or self.hostname
+      print('connecting to', host, settings.server_port)
+      try:
+        out = await asyncio.open_connection(host, settings.server_port)
+      except Exception:
+        self._pushed_failures += 1
+        raise
+      self._pushed_failures = 0
+      return out
+
+    # The default server, also now and then if a pushed address keeps failing, so that a bad
+    # one (saved in flash) can't cut us off: the server can push a correction once we're back.
+    if pushed:
+      print('pushed server failing, trying the default')
+      self._pushed_failures = 0
+    try:
+      print('connecting to', self.hostname)
+      return await asyncio.open_connection(self.hostname, self.port)
+    except Exception:
+      if not self.fallback:
+        raise
+      print('failed, fallback to', self.fallback)
+      return await asyncio.open_connection(self.fallback, self.port)
+
+  async def network_forever(self):
+    failures = 0
+
+    while True:
+      writer = None
+      updater = None
+      try:
+        reader, writer = await self._open()
+        failures = 0
+
+        print('connected!')
+        updater = asyncio.create_task(self._network_update(writer))
+
+        pending = b''
+        reconnect = False
+        while True:
+          part = await reader.read(1024)
+          if not len(part):
+            break
+          pending += part
+          print('got pending', len(pending))
+
+          while len(pending) >= 16:
+            command = pending[0:16]
+            pending = pending[16:]
+
+            mac = command[0:6]
+            rest = command[6:]
+            if mac == bytes(6):
+              reconnect = self.read_bridge_command(rest) or reconnect
+            else:
+              await self.read_command(mac, rest)
+
+          if reconnect:
+            print('server settings changed, reconnecting')
+            updater.cancel()
+            writer.close()
+            await writer.wait_closed()
+            break
+
+      except Exception as e:
+        print(log_exception(e, self.hostname))
+        failures += 1
+        if failures > BACKOFF_MAX:
+          failures = BACKOFF_MAX
+
+        if updater is not None:
+          updater.cancel()
+        try:
+          writer.close()
+          await writer.wait_closed()
+        except Exception:
+          pass  # ignore
+
+      # The updater drains shared state (outbox, changes, settings report), so it must not outlive
+      # its connection and hand any of that to a dead writer instead of the next one.
+      if updater is not None:
+        updater.cancel()
+
+      delay = self.settings.backoff_ms * failures
+      print('network delaying', delay)
+      await sleep_ms(delay)
+
+  async def _send_snapshot(self, writer):
+    frames = self.light_table.snapshot()
+    for frame in frames:
+      writer.write(frame)
+    await writer.drain()
+    print('sent snapshot of', len(frames) - 1)
+
+  async def _network_update(self, writer):
+    try:
+      self._report_settings = True
+      await self._send_snapshot(writer)
+
+      while True:
+        await self._update_event.wait()
+        if self._report_settings:
+          self._report_settings = False
+          for frame in self.settings.report():
+            writer.write(frame)
+        while len(self.outbox):
+          writer.write(self.outbox.pop(0))
+
+        frame = self.light_table.pop_change()
+        if frame is None:
+          self._update_event.clear()
+          await writer.drain()
+          continue
+
+        writer.write(frame)
+        await writer.drain()
+
+    except Exception as e:
+      print(log_exception(e, self.hostname))
+      try:
+        writer.close()
+        await writer.wait_closed()
+      except Exception:
+        pass  # ignore
+
+  async def start(self):
+    """Starts the bridge's tasks."""
+    await self._pending_lock.acquire()  # released as the first command arrives
+
+    asyncio.create_task(self.enact_forever())
+    asyncio.create_task(self.scan_forever())
+    asyncio.create_task(self.network_forever())
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+#
+# Follows the output of a board running basic.py, timestamps each line on the host and turns the
+# known log lines into JSON-lines records. Optionally reports rolling latency/failure stats.
+#
+# Usage:
+#   ./follow.py -d /dev/ttyACM0 --stats 50
+#   ./follow.py --input saved.log          # replay a previously captured log
+
+import argparse
+import ast
+import json
+import os
+import sys
+import time
+
+import pyboard
+
+
+_KNOWN_ERRORS = ('TimeoutError', 'DeviceDisconnectedError')
+
+
+def parse_addr(raw):
+  """Parses a printed bytes MAC (e.g., "b'\\x00\\ro\\xc6\\xaa\\xf5'") to "aa:bb:..." form."""
+  try:
+    value = ast.literal_eval(raw)
+  except (ValueError, SyntaxError):
+    return raw
+  if not isinstance(value, bytes):
+    return raw
+  return ':'.join('{:02x}'.format(b) for b in value)
+
+
+def split_addr(line, prefix):
+  """Returns (addr, rest) for a line starting with prefix followed by a printed bytes literal."""
+  rest = line[len(prefix):].lstrip()
+  if not rest.startswith("b'") and not rest.startswith('b"'):
+    return None, rest
+  quote = rest[1]
+  i = 2
+  while i < len(rest):
+    if rest[i] == '\\':
+      i += 2
+      continue
+    if rest[i] == quote:
+      break
+    i += 1
+  return parse_addr(rest[:i + 1]), rest[i + 1:].strip()
+
+
+class LineParser:
+  """Converts individual lines printed by basic.py into event dicts (or None)."""
+
+  def __init__(self):
+    self._exception = None
+
+  def parse(self, line):
+    if self._exception is not None:
+      if line.startswith('<----'):
+        out = self._exception
+        self._exception = None
+        return out
+      self._exception['trace'].append(line)
+      return None
+
+    if line.startswith('>----'):
+      addr, _ = split_addr(line, '>----')
+      self._exception = {'event': 'exception', 'addr': addr, 'trace': []}
+      return None
+
+    if line.startswith('enacted!'):
+      addr, _ = split_addr(line, 'enacted!')
+      return {'event': 'enact_success', 'addr': addr}
+
+    if line.startswith('enact '):
+      addr, _ = split_addr(line, 'enact')
+      return {'event': 'enact_start', 'addr': addr}
+
+    if line.startswith('abandoned task for'):
+      addr, rest = split_addr(line, 'abandoned task for')
+      command = rest[len('command'):].strip() if rest.startswith('command') else rest
+      return {'event': 'enact_abandoned', 'addr': addr, 'command': command}
+
+    if line.startswith('inserting'):
+      addr, rest = split_addr(line, 'inserting')
+      return {'event': 'command', 'addr': addr, 'command': rest}
+
+    if line == 'scanning...':
+      return {'event': 'scan_start'}
+
+    if line.startswith('(scan) device'):
+      # e.g. "(scan) device MICRO_DIMMER on= True brightness= 50"
+      parts = line.split()
+      out = {'event': 'scan_result'}
+      try:
+        out['name'] = ' '.join(parts[2:parts.index('on=')])  # empty from passive scans
+        out['on'] = parts[parts.index('on=') + 1] == 'True'
+        out['brightness'] = int(parts[parts.index('brightness=') + 1])
+      except (IndexError, ValueError):
+        out['raw'] = line
+      return out
+
+    if line.startswith('(confirm) device') or line.startswith('(notify) device'):
+      parts = line.split()
+      out = {'event': line.startswith('(confirm)') and 'confirm' or 'notify'}
+      try:
+        out['on'] = parts[parts.index('on=') + 1] == 'True'
+        out['brightness'] = int(parts[parts.index('brightness=') + 1])
+      except (IndexError, ValueError):
+        out['raw'] = line
+      return out
+
+    if line.startswith('network delaying'):
+      try:
+        delay = int(line.split()[-1])
+      except ValueError:
+        delay = None
+      return {'event': 'network_delay', 'delay_ms': delay}
+
+    if line.startswith('connecting to') or line.startswith('failed, fallback to'):
+      return {'event': 'network_connecting', 'host': line.split()[-1]}
+
+    if line == 'connected!':
+      return {'event': 'network_connected'}
+
+    if line in _KNOWN_ERRORS or line.startswith('OSError'):
+      return {'event': 'error', 'error': line}
+
+    return None
+
+
+class EnactStats:
+  """Tracks enact attempts per address and keeps a rolling window of command outcomes."""
+
+  def __init__(self, window=50):
+    self._window = window
+    self._pending = {}   # addr => (first start, attempts)
+    self._outcomes = []  # (ok, latency_s, attempts)
+
+  def observe(self, record):
+    """Annotates record with latency/attempts where relevant. Returns True if an outcome."""
+    event = record['event']
+    addr = record.get('addr')
+
+    if event == 'enact_start':
+      start, attempts = self._pending.get(addr, (record['ts'], 0))
+      self._pending[addr] = (start, attempts + 1)
+      record['attempt'] = attempts + 1
+      return False
+
+    if event not in ('enact_success', 'enact_abandoned'):
+      return False
+
+    start, attempts = self._pending.pop(addr, (None, 0))
+    latency = None
+    if start is not None:
+      latency = record['ts'] - start
+      record['latency_ms'] = int(latency * 1000)
+    record['attempts'] = attempts
+
+    self._outcomes.append((event == 'enact_success', latency, attempts))
+    if len(self._outcomes) > self._window:
+      self._outcomes.pop(0)
+    return True
+
+  def summary(self, ts):
+    ok_latencies = sorted(l for ok, l, _ in self._outcomes if ok and l is not None)
+    failures = sum(1 for ok, _, _ in self._outcomes if not ok)
+    attempts = sum(a for _, _, a in self._outcomes)
+    count = len(self._outcomes)
+
+    def pct(p):
+      if not ok_latencies:
+        return None
+      i = min(len(ok_latencies) - 1, int(p * len(ok_latencies)))
+      return int(ok_latencies[i] * 1000)
+
+    return {
+      'ts': ts,
+      'event': 'stats',
+      'window': count,
+      'failures': failures,
+      'failure_rate': round(failures / count, 3) if count else None,
+      'attempts_per_command': round(attempts / count, 2) if count else None,
+      'p50_ms': pct(0.5),
+      'p90_ms': pct(0.9),
+      'max_ms': pct(1.0),
+      'in_flight': len(self._pending),
+    }
+
+
+class EventStream:
+  """Used as a Pyboard data_consumer: splits bytes into lines and writes JSON-lines records."""
+
+  def __init__(self, out, stats=None, raw=False, clock=time.time):
+    self._out = out
+    self._stats = stats
+    self._raw = raw
+    self._clock = clock
+    self._parser = LineParser()
+    self._partial = bytearray()  # pyboard hands us a byte at a time
+
+  def __call__(self, data):
+    self._partial += data
+    if b'\n' not in data:
+      return
+    lines = self._partial.replace(b'\x04', b'').split(b'\n')
+    self._partial = lines.pop()
+    for line in lines:
+      self.line(line.rstrip(b'\r').decode('utf-8', 'replace'))
+
+  def finish(self):
+    """Emits a last line that didn't end with a newline."""
+    line = self._partial.replace(b'\x04', b'').rstrip(b'\r')
+    self._partial = bytearray()
+    if line:
+      self.line(line.decode('utf-8', 'replace'))
+
+  def line(self, line, ts=None):
+    if ts is None:
+      ts = self._clock()
+    if self._raw:
+      self._emit({'ts': ts, 'event': 'line', 'line': line})
+
+    record = self._parser.parse(line)
+    if record is None:
+      return
+    record['ts'] = ts
+
+    outcome = self._stats and self._stats.observe(record)
+    self._emit(record)
+    if outcome:
+      self._emit(self._stats.summary(ts))
+
+  def _emit(self, record):
+    self._out.write(json.dumps(record) + '\n')
+    self._out.flush()
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Follow basic.py output as JSON-lines events.')
+  parser.add_argument(
+    '-d',
+    '--device',
+    default=os.environ.get('PYBOARD_DEVICE', '/dev/ttyACM0'),
+    help='the serial device or the IP address of the pyboard',
+  )
+  parser.add_argument('-b', '--baudrate', default=os.environ.get('PYBOARD_BAUDRATE', '115200'))
+  parser.add_argument('-i', '--input', help='parse a saved log (or "-" for stdin) instead')
+  parser.add_argument('--stats', type=int, default=0, help='rolling window of commands for stats')
+  parser.add_argument('--raw', action='store_true', help='also emit every raw line')
+  args = parser.parse_args()
+
+  stats = EnactStats(args.stats) if args.stats else None
+  stream = EventStream(sys.stdout, stats=stats, raw=args.raw)
+
+  if args.input:
+    f = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+    with f:
+      for line in f:
+        stream(line)
+    stream.finish()
+    return
+
+  try:
+    pyb = pyboard.Pyboard(args.device, args.baudrate)
+  except pyboard.PyboardError as er:
+    print(er, file=sys.stderr)
+    sys.exit(1)
+
+  try:
+    pyb.follow(timeout=None, data_consumer=stream)
+  except pyboard.PyboardError as er:
+    print(er, file=sys.stderr)
+    sys.exit(1)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    stream.finish()
+    pyb.close()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,211 @@
+from micropython import const
+
+import uasyncio as asyncio
+import bluetooth
+from aioble import core
+
+
+_IRQ_GATTC_CHARACTERISTIC_RESULT = const(11)
+_IRQ_GATTC_CHARACTERISTIC_DONE = const(12)
+_IRQ_GATTC_READ_RESULT = const(15)
+_IRQ_GATTC_READ_DONE = const(16)
+_IRQ_GATTC_WRITE_DONE = const(17)
+
+_FLAG_WRITE_NO_RESPONSE = const(0x04)
+
+_DISCOVER_TIMEOUT_MS = const(5000)
+WRITE_TIMEOUT_MS = const(5000)
+_READ_TIMEOUT_MS = const(5000)
+
+
+class GattWriteError(Exception):
+  pass
+
+
+def decode_state(state, level):
+  """Returns (is_on, brightness) from raw state and level characteristic values."""
+  is_on = bool(state[0] & 15)
+  brightness = int(round(int.from_bytes(level[0:2], 'little') / 100))  # 10_000 => 100
+  if is_on and not brightness:
+    brightness = 1  # as the advertisement is decoded
+  return is_on, brightness
+
+
+class WriteEngine:
+  """Writes light state with raw gattc calls on an aioble connection.
+
+  Both characteristics are found in a single discovery pass and their handles are cached per
+  device, along with any extra characteristics asked for (so other code using the connection
+  doesn't need its own discovery). All but the last write are sent without response (where the
+  characteristic allows it), and since ATT is ordered on a link, the response to the final write
+  confirms the lot.
+  """
+
+  def __init__(self, state_uuid, level_uuid, extra_uuids=()):
+    self._state_uuid = state_uuid
+    self._level_uuid = level_uuid
+    self._wanted = (state_uuid, level_uuid) + tuple(extra_uuids)
+    self._handles = {}  # addr => {uuid: (value_handle, properties, end_handle)}
+
+    # only one operation is in flight at a time (enact is serial)
+    self._conn_handle = None
+    self._found = None
+    self._defs = None
+    self._read = None
+    self._status = None
+    self._event = asyncio.ThreadSafeFlag()
+
+    core.register_irq_handler(self._irq, None)
+
+  def forget(self, addr):
+    if addr in self._handles:
+      del self._handles[addr]
+
+  def _irq(self, event, data):
+    if event == _IRQ_GATTC_CHARACTERISTIC_RESULT:
+      conn_handle, def_handle, value_handle, properties, uuid = data
+      if conn_handle == self._conn_handle and self._found is not None:
+        self._defs.append(def_handle)
+        uuid = bluetooth.UUID(uuid)
+        if uuid in self._wanted:
+          self._found[uuid] = (value_handle, properties)
+
+    elif event == _IRQ_GATTC_CHARACTERISTIC_DONE:
+      conn_handle, status = data
+      if conn_handle == self._conn_handle:
+        self._status = status
+        self._event.set()
+
+    elif event == _IRQ_GATTC_READ_RESULT:
+      conn_handle, value_handle, char_data = data
+      if conn_handle == self._conn_handle:
+        self._read = bytes(char_data)
+
+    elif event == _IRQ_GATTC_WRITE_DONE or event == _IRQ_GATTC_READ_DONE:
+      conn_handle, value_handle, status = data
+      if conn_handle == self._conn_handle:
+        self._status = status
+        self._event.set()
+
+  async def _wait(self, timeout_ms):
+    # nb. callers reset _status before starting the operation, as the IRQ can beat us here
+    await asyncio.wait_for_ms(self._event.wait(), timeout_ms)
+    return self._status
+
+  async def discover(self, connection):
+    """Returns {uuid: (value_handle, properties, end_handle)} for the wanted characteristics."""
+    addr = connection.device.addr
+    found = self._handles.get(addr)
+    if found:
+      return found
+
+    self._conn_handle = connection._conn_handle
+    self._found = {}
+    self._defs = []
+    self._status = None
+    try:
+      core.ble.gattc_discover_characteristics(self._conn_handle, 1, 0xffff)
+      status = await self._wait(_DISCOVER_TIMEOUT_MS)
+      found = self._found
+      defs = self._defs
+    finally:
+      self._conn_handle = None
+      self._found = None
+      self._defs = None
+
+    if status or self._state_uuid not in found or self._level_uuid not in found:
+      raise GattWriteError('could not discover characteristics')
+
+    # A characteristic's descriptors run until the next characteristic's definition.
+    for uuid, (value_handle, properties) in found.items():
+      end_handle = 0xffff
+      for d in defs:
+        if value_handle < d <= end_handle:
+          end_handle = d - 1
+      found[uuid] = (value_handle, properties, end_handle)
+
+    self._handles[addr] = found
+    return found
+
+  def plan(self, command):
+    """Returns a list of (uuid, value) writes for command, dropping ones that are implied."""
+    level = None
+    if command.set_brightness is not None:
+      brightness = command.set_brightness * 100  # 100 => 10_000
+      level = (self._level_uuid, brightness.to_bytes(2, 'little'))
+
+    if command.toggle_on:
+      state = (self._state_uuid, b'\x02')
+    elif command.set_on is None:
+      state = None
+    elif command.set_on and command.set_brightness:
+      state = None  # a non-zero level turns the light on anyway
+    else:
+      state = (self._state_uuid, command.set_on and b'\x01' or b'\x00')
+
+    if command.set_on is False:
+      # turning off goes last so the level write can't turn it back on
+      writes = [level, state]
+    else:
+      writes = [state, level]
+    return [w for w in writes if w is not None]
+
+  async def write(self, connection, command, timeout_ms=WRITE_TIMEOUT_MS):
+    """Applies command. Returns the number of round trips that were waited on."""
+    writes = self.plan(command)
+    if not writes:
+      return 0
+
+    try:
+      handles = await self.discover(connection)
+      self._conn_handle = connection._conn_handle
+      round_trips = 0
+
+      for i, (uuid, value) in enumerate(writes):
+        value_handle, properties, _ = handles[uuid]
+        last = i == len(writes) - 1
+        if not last and properties & _FLAG_WRITE_NO_RESPONSE:
+          print('writing (no response)', value)
+          core.ble.gattc_write(self._conn_handle, value_handle, value, 0)
+          continue
+
+        print('writing', value)
+        self._status = None
+        core.ble.gattc_write(self._conn_handle, value_handle, value, 1)
+        status = await self._wait(timeout_ms)
+        round_trips += 1
+        if status:
+          raise GattWriteError('write failed: ' + str(status))
+
+      return round_trips
+
+    except Exception:
+      # handles might be stale (e.g., firmware update), rediscover next time
+      self.forget(connection.device.addr)
+      raise
+    finally:
+      self._conn_handle = None
+
+  async def _read_value(self, value_handle):
+    self._read = None
+    self._status = None
+    core.ble.gattc_read(self._conn_handle, value_handle)
+    status = await self._wait(_READ_TIMEOUT_MS)
+    if status or self._read is None:
+      raise GattWriteError('read failed: ' + str(status))
+    return self._read
+
+  async def read_state(self, connection):
+    """Reads back (is_on, brightness) from the light, e.g. to confirm a write."""
+    state, level = await self.read_raw(connection)
+    return decode_state(state, level)
+
+  async def read_raw(self, connection):
+    """Reads the raw (state, level) values, e.g. as a baseline for notifications."""
+    handles = await self.discover(connection)
+    self._conn_handle = connection._conn_handle
+    try:
+      return (await self._read_value(handles[self._state_uuid][0]),
+              await self._read_value(handles[self._level_uuid][0]))
+    finally:
+      self._conn_handle = None
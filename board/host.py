@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+#
+# Runs the bridge on a Linux host, with the same core as the pyboard (bridgecore.py) and
+# simulated lights (simbackend.py) in place of the radio. It talks to the beacon server like any
+# other bridge: snapshot on connect, state changes, confirms, settings.
+#
+# The server only knows lights listed in its devices file, so generate one first:
+#   ./loadgen.py --lights 20 --write-devices /tmp/host.json5
+#   DEVICES_PATH=/tmp/host.json5 node server/index.js
+#   ./host.py --lights 20 --server localhost:9999
+
+import argparse
+import asyncio
+
+import bridgecore
+import scanpolicy
+import settings as settings_module
+import simbackend
+
+
+def parse_server(raw):
+  host, _, port = raw.rpartition(':')
+  return host or 'localhost', int(port)
+
+
+async def main_async(args):
+  settings = settings_module.Settings(args.settings)
+  host, port = parse_server(args.server)
+
+  backend = simbackend.SimBackend(
+      args.lights, args.interval_ms, args.connect_ms, args.write_ms, args.loss, args.change_rate)
+  bridge = bridgecore.Bridge(backend, settings, scanpolicy.ScanPolicy(settings), hostname=host, port=port)
+  await bridge.start()
+  await asyncio.Event().wait()
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Runs the bridge on this host, with simulated lights.')
+  parser.add_argument('--server', default='localhost:9999', help='host:port of the beacon server')
+  parser.add_argument('--settings', default='host-settings.json', help='where settings from the server are kept')
+  parser.add_argument('--lights', type=int, default=8)
+  parser.add_argument('--interval-ms', type=int, default=1000, help='advertising interval of each light')
+  parser.add_argument('--connect-ms', type=int, default=300)
+  parser.add_argument('--write-ms', type=int, default=100)
+  parser.add_argument('--loss', type=float, default=0.0, help='chance an attempt to enact times out')
+  parser.add_argument('--change-rate', type=float, default=0.0, help='changes at the wall per light per second')
+  args = parser.parse_args()
+
+  try:
+    asyncio.run(main_async(args))
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,131 @@
+from micropython import const
+
+import array
+import random
+import time
+
+
+CONNECT = const(0)
+PAIR = const(1)
+WRITE = const(2)
+_STAGES = const(3)
+_NAMES = ('connect', 'pair', 'write')
+
+_SAMPLES = const(8)      # per stage, the most recent
+_MIN_SAMPLES = const(3)  # before timeouts adapt
+_HEADROOM = const(3)     # timeout is this times the p90
+_MAX_MISSES = const(4)   # each timeout doubles the next one, up to this many times
+_DECAY_AT = const(32)    # halve attempts/successes here, so old history fades
+
+_FLOOR_MS = (1000, 1000, 500)
+
+
+class DeviceLatency:
+  def __init__(self):
+    self.samples = array.array('H', [0] * (_SAMPLES * _STAGES))  # ms, ring per stage
+    self.counts = bytearray(_STAGES)  # samples recorded, stops at 255
+    self.next = bytearray(_STAGES)    # ring position
+    self.misses = bytearray(_STAGES)  # timeouts since the last success at that stage
+    self.attempts = 0
+    self.successes = 0
+
+  def percentile(self, stage, p):
+    n = min(self.counts[stage], _SAMPLES)
+    if not n:
+      return None
+    base = stage * _SAMPLES
+    values = sorted(self.samples[base:base + n])
+    return values[min(n - 1, int(p * n))]
+
+
+class LatencyTable:
+  """Per-light connect/pair/write latency and success history.
+
+  Each stage keeps its last few durations, and its timeout is a multiple of their p90 (between a
+  floor and the usual fixed timeout), so a light that's normally quick but now out of range
+  fails fast rather than holding up the single enactor. A timeout doubles the next one in case
+  the light is just slow right now. Success rates order which pending command goes next.
+  """
+
+  def __init__(self, defaults):
+    self._defaults = defaults  # callable returning the fixed (max) timeouts, by stage
+    self.devices = {}  # addr => DeviceLatency
+    self._addr = None
+    self._stage = None
+    self._start = 0
+
+  def _device(self, addr):
+    d = self.devices.get(addr)
+    if d is None:
+      d = DeviceLatency()
+      self.devices[addr] = d
+    return d
+
+  def timeout(self, addr, stage):
+    cap = self._defaults()[stage]
+    d = self.devices.get(addr)
+    if d is None or d.counts[stage] < _MIN_SAMPLES:
+      return cap
+    ms = max(_FLOOR_MS[stage], d.percentile(stage, 0.9) * _HEADROOM) << d.misses[stage]
+    return min(cap, ms)
+
+  def begin(self, addr, stage):
+    """Marks the start of a stage. Returns its timeout."""
+    self._addr = addr
+    self._stage = stage
+    self._start = time.ticks_ms()
+    return self.timeout(addr, stage)
+
+  def end(self):
+    """Records the duration of the stage started with begin()."""
+    ms = time.ticks_diff(time.ticks_ms(), self._start)
+    d = self._device(self._addr)
+    stage = self._stage
+    d.samples[stage * _SAMPLES + d.next[stage]] = min(ms, 0xffff)
+    d.next[stage] = (d.next[stage] + 1) % _SAMPLES
+    if d.counts[stage] < 255:
+      d.counts[stage] += 1
+    d.misses[stage] = 0
+    self._stage = None
+
+  def outcome(self, addr, ok, timed_out=False):
+    """Records an attempt. If it timed out, the stage that was running gets longer next time."""
+    d = self._device(addr)
+    if timed_out and self._stage is not None and self._addr == addr and d.misses[self._stage] < _MAX_MISSES:
+      d.misses[self._stage] += 1
+    self._stage = None
+
+    d.attempts += 1
+    if ok:
+      d.successes += 1
+    if d.attempts >= _DECAY_AT:
+      d.attempts //= 2
+      d.successes //= 2
+
+  def likelihood(self, addr):
+    d = self.devices.get(addr)
+    if d is None:
+      return 0.5
+    return (d.successes + 1) / (d.attempts + 2)
+
+  def pick(self, addrs):
+    """Chooses one of addrs, weighted by how likely each is to succeed."""
+    total = 0.0
+    for addr in addrs:
+      total += self.likelihood(addr)
+    r = random.random() * total
+    for addr in addrs:
+      r -= self.likelihood(addr)
+      if r <= 0:
+        return addr
+    return addrs[-1]
+
+  def summary(self):
+    lines = []
+    for addr, d in self.devices.items():
+      parts = [':'.join('%02x' % b for b in addr), 'ok %d/%d' % (d.successes, d.attempts)]
+      for stage in range(_STAGES):
+        parts.append('%s p50 %s p90 %s timeout %d' % (
+            _NAMES[stage], d.percentile(stage, 0.5), d.percentile(stage, 0.9), self.timeout(addr, stage)))
+      lines.append(' '.join(parts))
+    return '\n'.join(lines) + '\n'
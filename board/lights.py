@@ -0,0 +1,156 @@
+# Decoding of light advertisements and the bridge's table of light states. Nothing in here
+# touches the radio, so it also runs under CPython (e.g., to replay traces, see advtrace.py).
+
+import random
+
+try:
+  from time import ticks_ms, ticks_diff
+except ImportError:
+  import time
+
+  def ticks_ms():
+    return int(time.monotonic() * 1000)
+
+  def ticks_diff(a, b):
+    return a - b
+
+
+ADDR_PUBLIC = 0
+
+LIGHT_TYPE = 0x55     # state, from an advertisement
+CONFIRM_TYPE = 0x43   # state, read back after a write
+SNAPSHOT_TYPE = 0x53  # state in a snapshot, includes age in seconds
+
+_ADV_TYPE_SHORT_NAME = 0x08
+_ADV_TYPE_NAME = 0x09
+_ADV_TYPE_MANUFACTURER = 0xff
+
+_NAME_PREFIX = 'MICRO_DIMMER'
+_KEEPALIVE_MS = 30 * 1000  # resend unchanged states this often, server times out at 60s
+
+
+def adv_fields(payload, adv_type):
+  """Yields the data of each field of adv_type in an advertising payload."""
+  i = 0
+  while i + 1 < len(payload):
+    length = payload[i]
+    if not length:
+      break
+    if payload[i + 1] == adv_type:
+      yield payload[i + 2:i + 1 + length]
+    i += 1 + length
+
+
+def decode_name(*payloads):
+  for payload in payloads:
+    if not payload:
+      continue
+    for t in (_ADV_TYPE_NAME, _ADV_TYPE_SHORT_NAME):
+      for field in adv_fields(payload, t):
+        return bytes(field).decode('utf-8')
+  return ''
+
+
+def decode_manufacturer(payload):
+  """Returns the data of the last manufacturer field (without company ID), or None."""
+  out = None
+  for field in adv_fields(payload, _ADV_TYPE_MANUFACTURER):
+    if len(field) >= 2:
+      out = field[2:]
+  return out
+
+
+def parse_result(addr_type, addr, adv_data, resp_data, known):
+  """Returns (name, is_on, brightness) for a light's scan result, or None.
+
+  Passive scans usually don't get the name (it's in the scan response), so once a light has been
+  seen by name its address is added to known, and it's recognized by that afterwards.
+  """
+  if addr_type != ADDR_PUBLIC:
+    return None  # only has fixed addresses
+  if not adv_data:
+    return None  # we only care if there's a payload
+
+  name = decode_name(adv_data, resp_data)
+  if name.startswith(_NAME_PREFIX):
+    known.add(addr)
+  elif addr not in known:
+    return None
+
+  data = decode_manufacturer(adv_data)
+  if not data or len(data) < 8:
+    return None
+
+  # data[5] is the settings revision count (some change)
+  is_on = bool(data[6] & 15)  # Clipsal app checks low bits
+  brightness = int(round(data[7] / 255.0 * 100.0))
+  if is_on and not brightness:
+    brightness = 1
+  return name, is_on, brightness
+
+
+class SeenState(object):
+  def __init__(self, is_on, brightness, now=None):
+    self.is_on = is_on
+    self.brightness = brightness
+    self.when = ticks_ms() if now is None else now  # last seen
+    self.sent = None                                # last sent to the server
+    self.confirmed = False                          # read back after a write, not advertised
+
+  def same(self, other):
+    return other and self.is_on == other.is_on and self.brightness == other.brightness
+
+
+def payload(addr, state, kind=LIGHT_TYPE, age=0):
+  out = addr + bytes([kind, state.is_on, state.brightness, age >> 8, age & 0xff, 0, 0, 0, 0, 0])
+  if len(out) != 16:
+    raise Exception('could not get 16 bytes to send')
+  return out
+
+
+class LightTable:
+  """The last state of every light, and which of those still need to be sent upstream."""
+
+  def __init__(self):
+    self.known = {}    # addr => SeenState
+    self.changes = {}  # addr => SeenState, waiting to be sent
+
+  def seen(self, addr, is_on, brightness, now=None):
+    """Records an advertised state. Returns it if it's news for the server, else None."""
+    state = SeenState(is_on, brightness, now)
+    prev = self.known.get(addr)
+    if state.same(prev) and prev.sent is not None and ticks_diff(state.when, prev.sent) < _KEEPALIVE_MS:
+      prev.when = state.when
+      return None
+
+    self.changes[addr] = state
+    self.known[addr] = state
+    return state
+
+  def confirm(self, addr, is_on, brightness, now=None):
+    """Records a state read back after a write, so the next advertisement of it isn't news."""
+    state = SeenState(is_on, brightness, now)
+    state.confirmed = True
+    self.changes[addr] = state
+    self.known[addr] = state
+    return state
+
+  def pop_change(self, now=None):
+    """Returns a payload for a random pending change, or None."""
+    if not self.changes:
+      return None
+    addr = random.choice(list(self.changes.keys()))
+    state = self.changes.pop(addr)
+    state.sent = ticks_ms() if now is None else now
+    return payload(addr, state, state.confirmed and CONFIRM_TYPE or LIGHT_TYPE)
+
+  def snapshot(self, now=None):
+    """Returns payloads for every known light, then the end marker."""
+    if now is None:
+      now = ticks_ms()
+    out = []
+    for addr, state in self.known.items():
+      age = min(0xffff, ticks_diff(now, state.when) // 1000)
+      out.append(payload(addr, state, SNAPSHOT_TYPE, age))
+    out.append(bytes(6) + bytes([SNAPSHOT_TYPE, 0xff, 0, 0, 0, 0, 0, 0, 0, 0]))
+    return out
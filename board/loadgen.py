@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+#
+# Emulates many bridges talking to the beacon server, to see how the server copes as load grows.
+# Each bridge owns some lights (with overlap, like real bridges in range of the same lights),
+# sends a snapshot on connect, forwards state changes and keepalives, and answers commands with
+# a confirm frame after a configurable latency (or not at all, with --loss).
+#
+# The server only knows lights listed in its devices file, so generate one first:
+#   ./loadgen.py --lights 300 --write-devices /tmp/load.json5
+#   DEVICES_PATH=/tmp/load.json5 node server/index.js
+#   ./loadgen.py --lights 300 --bridges 4 --ramp 1,2,4,8 --server-pid <pid>
+#
+# Command round trips are measured by sending EXECUTEs to the smarthome endpoint, which waits for
+# the light to confirm.
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+
+FRAME = 16
+LIGHT_TYPE = 0x55
+CONFIRM_TYPE = 0x43
+SNAPSHOT_TYPE = 0x53
+KEEPALIVE_S = 30
+
+
+def light_macs(count):
+  return [bytes([0x02, 0x4c, 0x47, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff]) for i in range(count)]
+
+
+def format_mac(mac):
+  return ':'.join('{:02x}'.format(b) for b in mac)
+
+
+def write_devices(path, macs):
+  with open(path, 'w') as f:
+    f.write('{\n')
+    for i, mac in enumerate(macs):
+      f.write("  '{}': {{type: 'clipsal', name: 'Load {}'}},\n".format(format_mac(mac), i))
+    f.write('}\n')
+
+
+def frame(mac, kind, is_on, brightness, age=0):
+  return mac + bytes([kind, is_on, brightness, age >> 8, age & 0xff, 0, 0, 0, 0, 0])
+
+
+class Stats:
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.start = time.monotonic()
+    self.frames = 0
+    self.write_wait = 0.0
+    self.commands = 0
+    self.dropped = 0
+    self.rtts = []
+    self.errors = 0
+    self.tasks = set()
+
+  def spawn(self, coro):
+    """Starts a task whose results count towards this step."""
+    task = asyncio.create_task(coro)
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
+    return task
+
+  async def settle(self):
+    """Cancels this step's unfinished tasks, so none of them count towards the next."""
+    tasks = list(self.tasks)
+    for t in tasks:
+      t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class Light:
+  def __init__(self, mac):
+    self.mac = mac
+    self.is_on = random.random() < 0.3
+    self.brightness = random.randint(1, 100)
+    self.sent = 0.0
+
+
+class Bridge:
+  def __init__(self, index, lights, args, stats):
+    self.index = index
+    self.lights = {l.mac: l for l in lights}
+    self.args = args
+    self.stats = stats
+    self.writer = None
+
+  async def send(self, data):
+    self.writer.write(data)
+    start = time.monotonic()
+    await self.writer.drain()  # blocks when the server isn't keeping up
+    self.stats.write_wait += time.monotonic() - start
+    self.stats.frames += len(data) // FRAME
+
+  async def run(self, scale):
+    reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+
+    snapshot = b''.join(frame(l.mac, SNAPSHOT_TYPE, l.is_on, l.brightness) for l in self.lights.values())
+    await self.send(snapshot + bytes(6) + bytes([SNAPSHOT_TYPE, 0xff]) + bytes(8))
+    now = time.monotonic()
+    for l in self.lights.values():
+      l.sent = now
+
+    tasks = [
+      asyncio.create_task(self.advertise(scale)),
+      asyncio.create_task(self.commands(reader)),
+    ]
+    try:
+      await asyncio.gather(*tasks)
+    finally:
+      for t in tasks:
+        t.cancel()
+      self.writer.close()
+
+  async def advertise(self, scale):
+    # Each light changes state now and then (someone at a switch), and is kept alive.
+    rate = self.args.change_rate * scale * len(self.lights)
+    lights = list(self.lights.values())
+    while True:
+      await asyncio.sleep(random.expovariate(rate) if rate else 1)
+      now = time.monotonic()
+
+      light = random.choice(lights)
+      light.is_on = not light.is_on
+      light.brightness = random.randint(1, 100)
+      batch = [frame(light.mac, LIGHT_TYPE, light.is_on, light.brightness)]
+      light.sent = now
+
+      for other in lights:
+        if now - other.sent > KEEPALIVE_S:
+          other.sent = now
+          batch.append(frame(other.mac, LIGHT_TYPE, other.is_on, other.brightness))
+      await self.send(b''.join(batch))
+
+  async def commands(self, reader):
+    pending = b''
+    while True:
+      part = await reader.read(4096)
+      if not part:
+        raise ConnectionError('server closed bridge {}'.format(self.index))
+      pending += part
+      while len(pending) >= FRAME:
+        command, pending = pending[:FRAME], pending[FRAME:]
+        light = self.lights.get(command[0:6])
+        if light:
+          self.stats.spawn(self.enact(light, command[6:]))
+
+  async def enact(self, light, rest):
+    if random.random() < self.args.loss:
+      self.stats.dropped += 1
+      return
+    latency = max(0, random.gauss(self.args.latency_ms, self.args.jitter_ms)) / 1000
+    await asyncio.sleep(latency)
+
+    if rest[1] == 2:
+      light.is_on = not light.is_on
+    elif rest[1] <= 1:
+      light.is_on = bool(rest[1])
+    if rest[2] <= 100:
+      light.brightness = rest[2]
+    light.sent = time.monotonic()
+    await self.send(frame(light.mac, CONFIRM_TYPE, light.is_on, light.brightness))
+
+
+async def execute(args, macs, stats):
+  """Sends EXECUTEs to the smarthome endpoint and times them."""
+  request_id = 0
+  while True:
+    await asyncio.sleep(random.expovariate(args.command_rate))
+    request_id += 1
+    mac = format_mac(random.choice(macs))
+    body = json.dumps({
+      'requestId': str(request_id),
+      'inputs': [{
+        'intent': 'action.devices.EXECUTE',
+        'payload': {'commands': [{
+          'devices': [{'id': mac}],
+          'execution': [{'command': 'action.devices.commands.OnOff', 'params': {'on': random.random() < 0.5}}],
+        }]},
+      }],
+    }).encode()
+    stats.spawn(post(args, body, stats))
+
+
+async def post(args, body, stats):
+  start = time.monotonic()
+  try:
+    reader, writer = await asyncio.open_connection(args.host, args.smarthome_port)
+    writer.write(b'POST / HTTP/1.0\r\nContent-Type: application/json\r\nContent-Length: '
+                 + str(len(body)).encode() + b'\r\n\r\n' + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    if b'"SUCCESS"' not in response:
+      stats.errors += 1
+      return
+  except OSError:
+    stats.errors += 1
+    return
+  stats.commands += 1
+  stats.rtts.append(time.monotonic() - start)
+
+
+def cpu_seconds(pid):
+  """Returns utime+stime of pid from /proc, in seconds."""
+  with open('/proc/{}/stat'.format(pid)) as f:
+    fields = f.read().rsplit(')', 1)[1].split()
+  return (int(fields[11]) + int(fields[12])) / 100.0  # USER_HZ is 100 almost everywhere
+
+
+def pct(values, p):
+  if not values:
+    return None
+  values = sorted(values)
+  return int(values[min(len(values) - 1, int(p * len(values)))] * 1000)
+
+
+async def step(args, scale, macs, stats):
+  lights = [Light(mac) for mac in macs]
+  bridges = []
+  for i in range(args.bridges):
+    # each light is heard by its home bridge and, sometimes, a neighbour
+    owned = [l for j, l in enumerate(lights) if j % args.bridges == i or random.random() < args.overlap]
+    bridges.append(Bridge(i, owned, args, stats))
+
+  cpu_start = args.server_pid and cpu_seconds(args.server_pid)
+  stats.reset()
+
+  tasks = [asyncio.create_task(b.run(scale)) for b in bridges]
+  if args.command_rate:
+    tasks.append(asyncio.create_task(execute(args, macs, stats)))
+  done, _ = await asyncio.wait(tasks, timeout=args.step_s, return_when=asyncio.FIRST_EXCEPTION)
+  elapsed = time.monotonic() - stats.start
+  for t in tasks:
+    t.cancel()
+  await asyncio.gather(*tasks, return_exceptions=True)
+  await stats.settle()
+  for t in done:
+    if t.exception():
+      print('step failed:', t.exception(), file=sys.stderr)
+
+  result = {
+    'scale': scale,
+    'bridges': args.bridges,
+    'lights': len(macs),
+    'frames_per_s': round(stats.frames / elapsed, 1),
+    'write_wait_ms': int(stats.write_wait * 1000),
+    'commands': stats.commands,
+    'command_errors': stats.errors,
+    'dropped': stats.dropped,
+    'rtt_p50_ms': pct(stats.rtts, 0.5),
+    'rtt_p90_ms': pct(stats.rtts, 0.9),
+  }
+  if args.server_pid:
+    cpu = cpu_seconds(args.server_pid) - cpu_start
+    result['server_cpu_pct'] = round(cpu * 100 / elapsed, 1)
+    result['server_us_per_frame'] = round(cpu * 1e6 / stats.frames, 1) if stats.frames else None
+  return result
+
+
+async def main_async(args):
+  macs = light_macs(args.lights)
+  stats = Stats()
+  for scale in args.ramp:
+    print(json.dumps(await step(args, scale, macs, stats)), flush=True)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Emulate bridges against the beacon server.')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=9999)
+  parser.add_argument('--smarthome-port', type=int, default=8888)
+  parser.add_argument('--bridges', type=int, default=4)
+  parser.add_argument('--lights', type=int, default=100)
+  parser.add_argument('--overlap', type=float, default=0.2, help='chance a light is heard by another bridge')
+  parser.add_argument('--change-rate', type=float, default=1 / 60.0, help='state changes per light per second')
+  parser.add_argument('--command-rate', type=float, default=1.0, help='EXECUTEs per second, 0 to disable')
+  parser.add_argument('--latency-ms', type=float, default=400)
+  parser.add_argument('--jitter-ms', type=float, default=150)
+  parser.add_argument('--loss', type=float, default=0.02, help='chance a command is never confirmed')
+  parser.add_argument('--ramp', default='1', help='comma-separated load multipliers, one step each')
+  parser.add_argument('--step-s', type=float, default=30)
+  parser.add_argument('--server-pid', type=int, help='sample this process for CPU use')
+  parser.add_argument('--write-devices', help='write a devices.json5 for --lights and exit')
+  args = parser.parse_args()
+  args.ramp = [float(x) for x in args.ramp.split(',')]
+
+  if args.write_devices:
+    write_devices(args.write_devices, light_macs(args.lights))
+    return
+
+  try:
+    asyncio.run(main_async(args))
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,147 @@
+from micropython import const
+
+import uasyncio as asyncio
+import binascii
+import socket
+
+
+_REQUEST_TIMEOUT_MS = const(2000)
+_MAX_HEADERS = const(32)
+
+_LIGHT_TYPE = const(0x55)
+_UNCHANGED = const(255)
+_TOGGLE = const(2)
+
+
+def parse_mac(raw):
+  """Parses "aa:bb:cc:dd:ee:ff" or "aabbccddeeff" into 6 bytes, or returns None."""
+  raw = raw.replace(':', '').replace('-', '')
+  if len(raw) != 12:
+    return None
+  try:
+    return binascii.unhexlify(raw)
+  except ValueError:
+    return None
+
+
+def build_rest(on, brightness):
+  """Builds the 10-byte command payload, as the server would send it."""
+  return bytes([_LIGHT_TYPE, on, brightness, 0, 0, 0, 0, 0, 0, 0])
+
+
+def _parse_query(query):
+  out = {}
+  for pair in query.split('&'):
+    if '=' in pair:
+      k, v = pair.split('=', 1)
+      out[k] = v
+    elif pair:
+      out[pair] = ''
+  return out
+
+
+def _parse_request(path):
+  """Parses "/light/<mac>?on=1&brightness=50" (or on=toggle). Returns (mac, rest) or None."""
+  query = ''
+  if '?' in path:
+    path, query = path.split('?', 1)
+
+  parts = [p for p in path.split('/') if p]
+  if len(parts) != 2 or parts[0] != 'light':
+    return None
+  mac = parse_mac(parts[1])
+  if mac is None:
+    return None
+
+  args = _parse_query(query)
+  on = _UNCHANGED
+  brightness = _UNCHANGED
+
+  raw_on = args.get('on')
+  if raw_on == 'toggle':
+    on = _TOGGLE
+  elif raw_on in ('1', 'true'):
+    on = 1
+  elif raw_on in ('0', 'false'):
+    on = 0
+  elif raw_on is not None:
+    return None
+
+  if 'brightness' in args:
+    try:
+      brightness = int(args['brightness'])
+    except ValueError:
+      return None
+    if brightness < 0 or brightness > 100:
+      return None
+
+  return mac, build_rest(on, brightness)
+
+
+async def _respond(writer, status, body=''):
+  writer.write(('HTTP/1.0 ' + status + '\r\nContent-Type: text/plain\r\n\r\n' + body).encode())
+  await writer.drain()
+
+
+async def _handle_http(reader, writer, on_command, on_stats):
+  try:
+    line = await asyncio.wait_for_ms(reader.readline(), _REQUEST_TIMEOUT_MS)
+    parts = line.decode().split()
+
+    # drain headers; we don't use any of them
+    for _ in range(_MAX_HEADERS):
+      header = await asyncio.wait_for_ms(reader.readline(), _REQUEST_TIMEOUT_MS)
+      if not header or header == b'\r\n':
+        break
+
+    if len(parts) < 2 or parts[0] not in ('GET', 'POST'):
+      await _respond(writer, '405 Method Not Allowed')
+      return
+
+    if parts[1] == '/stats' and on_stats:
+      await _respond(writer, '200 OK', on_stats())
+      return
+
+    parsed = _parse_request(parts[1])
+    if not parsed:
+      await _respond(writer, '400 Bad Request', 'expected /light/<mac>?on=0|1|toggle&brightness=0-100\n')
+      return
+
+    mac, rest = parsed
+    await on_command(mac, rest)
+    await _respond(writer, '202 Accepted', 'ok\n')
+
+  except Exception as e:
+    print('local http error', e.__class__.__name__)
+  finally:
+    try:
+      writer.close()
+      await writer.wait_closed()
+    except:
+      pass  # ignore
+
+
+async def serve_http(on_command, port=80, on_stats=None):
+  """Serves local HTTP control requests. on_command(mac, rest) is awaited for each valid one.
+
+  If on_stats is given, GET /stats responds with the text it returns, for diagnostics.
+  """
+  await asyncio.start_server(lambda r, w: _handle_http(r, w, on_command, on_stats), '0.0.0.0', port)
+  print('local http on', port)
+
+
+async def serve_udp(on_command, port=9999):
+  """Accepts the same 16-byte frames the server sends, as single UDP datagrams."""
+  s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  s.bind(socket.getaddrinfo('0.0.0.0', port)[0][-1])
+  s.setblocking(False)
+  print('local udp on', port)
+
+  stream = asyncio.StreamReader(s)
+  while True:
+    frame = await stream.read(64)
+    if len(frame) != 16:
+      print('local udp ignoring', len(frame), 'bytes')
+      continue
+    await on_command(frame[0:6], frame[6:])
@@ -0,0 +1,131 @@
+from micropython import const
+
+import uasyncio as asyncio
+import gc
+import time
+
+
+_SAMPLE_MS = const(100)
+_REPORT_MS = const(30 * 1000)
+
+# Collect ourselves while idle once this much has been allocated since the last collection, and
+# set gc.threshold well above it so automatic collections rarely land on the command path.
+_IDLE_COLLECT_FRACTION = const(4)  # of free heap
+_THRESHOLD_FRACTION = const(2)     # of free heap
+
+MONITOR_TYPE = const(0x4d)
+
+
+def largest_free_block(limit):
+  """Finds the largest single allocation that would succeed (roughly), by bisection.
+
+  Each failed allocation (and any above gc.threshold) runs a collection, so only call this idle.
+  """
+  low, high = 0, limit
+  while high - low > 64:
+    mid = (low + high) // 2
+    try:
+      b = bytearray(mid)
+      del b
+      low = mid
+    except MemoryError:
+      high = mid
+  return low
+
+
+class Monitor:
+  """Samples event loop lag and the heap, and does collections at quiet times."""
+
+  def __init__(self, is_idle, send, reporters=()):
+    self._is_idle = is_idle
+    self._send = send
+    self._reporters = reporters  # each returns another frame to send with every report
+    self.frag = 0  # percent, from the last idle probe
+    self._reset()
+    self._threshold = None
+    self._baseline = gc.mem_alloc()  # live heap after our last collection
+    self._tune()
+
+  def _reset(self):
+    self.lag_max = 0
+    self.lag_total = 0
+    self.samples = 0
+    self.gc_max = 0       # our own collections, ms
+    self.auto_gcs = 0     # collections we noticed but didn't do
+    self._probed = False  # fragmentation, this report
+
+  def _tune(self):
+    free = gc.mem_free()
+    self._idle_collect = free // _IDLE_COLLECT_FRACTION
+    threshold = free // _THRESHOLD_FRACTION
+    if threshold != self._threshold:
+      gc.threshold(threshold)
+      self._threshold = threshold
+
+  def _collect(self):
+    start = time.ticks_ms()
+    gc.collect()
+    duration = time.ticks_diff(time.ticks_ms(), start)
+    if duration > self.gc_max:
+      self.gc_max = duration
+    self._baseline = gc.mem_alloc()
+    self._tune()
+
+  async def run(self):
+    last_report = time.ticks_ms()
+    last_alloc = gc.mem_alloc()
+
+    while True:
+      start = time.ticks_ms()
+      await asyncio.sleep_ms(_SAMPLE_MS)
+      lag = time.ticks_diff(time.ticks_ms(), start) - _SAMPLE_MS
+      if lag > self.lag_max:
+        self.lag_max = lag
+      self.lag_total += lag
+      self.samples += 1
+
+      alloc = gc.mem_alloc()
+      if alloc < last_alloc:
+        self.auto_gcs += 1  # heap shrank without us
+        self._baseline = alloc
+      last_alloc = alloc
+
+      if self._is_idle() and alloc - self._baseline >= self._idle_collect:
+        self._collect()
+        last_alloc = self._baseline
+
+      if self._is_idle() and not self._probed:
+        self._probe()
+        last_alloc = self._baseline  # its collections aren't automatic ones
+
+      if time.ticks_diff(time.ticks_ms(), last_report) >= _REPORT_MS:
+        self.report()
+        last_report = time.ticks_ms()
+
+  def _probe(self):
+    free = gc.mem_free()
+    largest = largest_free_block(free)
+    self.frag = 100 - (largest * 100 // free) if free else 0
+    self._probed = True
+    self._baseline = gc.mem_alloc()
+
+  def report(self):
+    free = gc.mem_free()
+    frag = self.frag
+    lag_avg = self.lag_total // self.samples if self.samples else 0
+
+    print('monitor lag max', self.lag_max, 'avg', lag_avg, 'free', free, 'frag', frag,
+          'gc max', self.gc_max, 'auto gcs', self.auto_gcs)
+
+    self._send(bytes(6) + bytes([
+      MONITOR_TYPE,
+      min(0xffff, self.lag_max) >> 8, min(0xffff, self.lag_max) & 0xff,
+      min(0xff, lag_avg),
+      min(0xffff, free // 1024) >> 8, min(0xffff, free // 1024) & 0xff,
+      frag,
+      min(0xffff, self.gc_max) >> 8, min(0xffff, self.gc_max) & 0xff,
+      min(0xff, self.auto_gcs),
+    ]))
+    for reporter in self._reporters:
+      self._send(reporter())
+    self._reset()
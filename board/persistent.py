@@ -0,0 +1,225 @@
+from micropython import const
+
+import uasyncio as asyncio
+import aioble
+import bluetooth
+import time
+from aioble import core
+
+import gattwrite
+
+
+_IRQ_GATTC_DESCRIPTOR_RESULT = const(13)
+_IRQ_GATTC_DESCRIPTOR_DONE = const(14)
+_IRQ_GATTC_WRITE_DONE = const(17)
+_IRQ_GATTC_NOTIFY = const(18)
+
+_CCCD_UUID = bluetooth.UUID(0x2902)
+
+_CHECK_MS = const(1000)     # notice dropped links this often
+_CONNECT_MS = const(5000)
+_TIMEOUT_MS = const(3000)
+_MIN_USES = const(3)        # commands before a light becomes a candidate by itself
+
+
+class LinkError(Exception):
+  pass
+
+
+class Link:
+  def __init__(self, connection, state, level):
+    self.connection = connection
+    self.since = time.ticks_ms()
+    self.handles = ()  # (state value handle, level value handle)
+    self.state = state
+    self.level = level
+    self.dirty = False
+
+
+class PersistentLinks:
+  """Holds connections open to busy lights and forwards their state notifications.
+
+  Candidates are the configured lights plus any light that's commanded often. When there are
+  more candidates than slots, every rotate_ms the link held longest is dropped for the candidate
+  that's waited longest, so each gets a turn. Commands for a linked light reuse its connection.
+  """
+
+  def __init__(self, settings, write_engine, state_uuid, level_uuid, ble_lock, on_change, secure, configured=()):
+    self._settings = settings  # persistent_slots, persistent_rotate_ms
+    self._secure = secure      # async (connection), encrypts the link
+    self._engine = write_engine
+    self._state_uuid = state_uuid
+    self._level_uuid = level_uuid
+    self._ble_lock = ble_lock
+    self._on_change = on_change
+
+    self.links = {}                   # addr => Link
+    self._by_conn = {}                # conn_handle => Link
+    self._waiting = list(configured)  # candidates without a link, longest waiting first
+    self._uses = {}                   # addr => commands seen
+    self._last_rotate = time.ticks_ms()
+
+    self._conn_handle = None
+    self._found_cccd = None
+    self._status = None
+    self._event = asyncio.ThreadSafeFlag()
+    self._notified = asyncio.ThreadSafeFlag()
+
+    core.register_irq_handler(self._irq, None)
+
+  def connection(self, addr):
+    """Returns the open connection to addr, or None."""
+    link = self.links.get(addr)
+    if link and link.connection.is_connected():
+      return link.connection
+    return None
+
+  def note_command(self, addr):
+    uses = self._uses.get(addr, 0) + 1
+    self._uses[addr] = uses
+    if uses == _MIN_USES and addr not in self.links and addr not in self._waiting:
+      self._waiting.append(addr)
+
+  def _irq(self, event, data):
+    if event == _IRQ_GATTC_NOTIFY:
+      conn_handle, value_handle, notify_data = data
+      link = self._by_conn.get(conn_handle)
+      if link is None or not link.handles:
+        return
+      if value_handle == link.handles[0]:
+        link.state = bytes(notify_data)
+      elif value_handle == link.handles[1]:
+        link.level = bytes(notify_data)
+      else:
+        return
+      link.dirty = True
+      self._notified.set()
+
+    elif event == _IRQ_GATTC_DESCRIPTOR_RESULT:
+      conn_handle, dsc_handle, uuid = data
+      if conn_handle == self._conn_handle and bluetooth.UUID(uuid) == _CCCD_UUID:
+        self._found_cccd = dsc_handle
+
+    elif event == _IRQ_GATTC_DESCRIPTOR_DONE or event == _IRQ_GATTC_WRITE_DONE:
+      conn_handle = data[0]
+      if conn_handle == self._conn_handle:
+        self._status = data[-1]
+        self._event.set()
+
+  async def _wait(self):
+    await asyncio.wait_for_ms(self._event.wait(), _TIMEOUT_MS)
+    return self._status
+
+  async def _subscribe(self, characteristic):
+    value_handle, _, end_handle = characteristic
+    self._found_cccd = None
+    self._status = None
+    core.ble.gattc_discover_descriptors(self._conn_handle, value_handle + 1, end_handle)
+    await self._wait()
+    if self._found_cccd is None:
+      raise LinkError('no cccd')
+
+    self._status = None
+    core.ble.gattc_write(self._conn_handle, self._found_cccd, b'\x01\x00', 1)
+    if await self._wait():
+      raise LinkError('could not subscribe')
+    return value_handle
+
+  async def _open(self, addr):
+    await self._ble_lock.acquire()
+    connection = None
+    try:
+      connection = await aioble.Device(0, addr).connect(timeout_ms=_CONNECT_MS)
+      await self._secure(connection)
+
+      handles = await self._engine.discover(connection)
+      state, level = await self._engine.read_raw(connection)  # baseline, before any notification
+      link = Link(connection, state, level)
+      self._by_conn[connection._conn_handle] = link
+
+      self._conn_handle = connection._conn_handle
+      try:
+        link.handles = (await self._subscribe(handles[self._state_uuid]),
+                        await self._subscribe(handles[self._level_uuid]))
+      finally:
+        self._conn_handle = None
+
+      self.links[addr] = link
+      print('(link) open', addr)
+    except Exception:
+      if connection is not None:
+        self._by_conn.pop(connection._conn_handle, None)
+        try:
+          await connection.disconnect()
+        except Exception:
+          pass
+      raise
+    finally:
+      self._ble_lock.release()
+
+  async def _close(self, addr):
+    link = self.links.pop(addr)
+    self._by_conn.pop(link.connection._conn_handle, None)
+    try:
+      await link.connection.disconnect()
+    except Exception:
+      pass
+    print('(link) closed', addr)
+
+  def _deliver(self):
+    for addr, link in self.links.items():
+      if link.dirty:
+        link.dirty = False
+        try:
+          is_on, brightness = gattwrite.decode_state(link.state, link.level)
+        except IndexError:
+          print('(link) bad notification', addr)  # e.g. empty
+          continue
+        self._on_change(addr, is_on, brightness)
+
+  async def _maintain(self, busy):
+    slots = self._settings.persistent_slots
+
+    # links can drop on their own (out of range, power cut); they wait for another turn
+    for addr in list(self.links.keys()):
+      dropped = not self.links[addr].connection.is_connected()
+      if dropped or (len(self.links) > slots and not busy(addr)):
+        await self._close(addr)
+        self._waiting.append(addr)
+
+    if not self._waiting or busy(None):
+      return
+
+    now = time.ticks_ms()
+    if len(self.links) >= slots:
+      if not slots or time.ticks_diff(now, self._last_rotate) < self._settings.persistent_rotate_ms:
+        return
+      oldest = None
+      for addr, link in self.links.items():
+        if not busy(addr) and (oldest is None or time.ticks_diff(link.since, self.links[oldest].since) < 0):
+          oldest = addr
+      if oldest is None:
+        return
+      await self._close(oldest)
+      self._waiting.append(oldest)
+    self._last_rotate = now
+
+    addr = self._waiting.pop(0)
+    try:
+      await self._open(addr)
+    except Exception as e:
+      print('(link) failed', addr, e.__class__.__name__)
+      self._waiting.append(addr)  # back of the line, so one bad light can't hog the turns
+
+  async def run(self, busy):
+    """busy(addr) is True if a command for addr is pending, busy(None) if any is."""
+    while True:
+      try:
+        await asyncio.wait_for_ms(self._notified.wait(), _CHECK_MS)
+      except asyncio.TimeoutError:
+        pass
+      try:
+        self._deliver()
+        await self._maintain(busy)
+      except Exception as e:
+        print('(link) error', e.__class__.__name__)
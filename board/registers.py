@@ -0,0 +1,244 @@
+from micropython import const
+
+import uasyncio as asyncio
+import bluetooth
+import time
+from aioble import core
+
+
+_IRQ_GATTC_DESCRIPTOR_RESULT = const(13)
+_IRQ_GATTC_DESCRIPTOR_DONE = const(14)
+_IRQ_GATTC_WRITE_DONE = const(17)
+_IRQ_GATTC_NOTIFY = const(18)
+
+_CCCD_UUID = bluetooth.UUID(0x2902)
+
+_FUNC_READ = const(0x43)
+_FUNC_WRITE = const(0x10)
+_FUNC_ERROR = const(0x80)
+
+_MAX_FRAME = const(64)
+_RESPONSE_HEADER = const(8)
+_TIMEOUT_MS = const(3000)
+_MAX_ATTEMPTS = const(3)
+
+# Registers we know the meaning of. Others can still be queued by number.
+REGISTER_NAME = const(0x1002)
+NAME_LENGTH = const(12)
+
+
+class RegisterError(Exception):
+  pass
+
+
+class RegisterCodec:
+  """Encodes requests into (and decodes responses from) preallocated buffers."""
+
+  def __init__(self):
+    self._tx = bytearray(_MAX_FRAME)
+    self._tx_mv = memoryview(self._tx)
+
+  def read(self, register, length=8):
+    if length % 2:
+      raise RegisterError('expected even read')
+    b = self._tx
+    b[0] = 255
+    b[1] = 255
+    b[2] = 6
+    b[3] = 255
+    b[4] = _FUNC_READ
+    b[5] = register >> 8
+    b[6] = register & 0xff
+    b[7] = (length // 2) >> 8
+    b[8] = (length // 2) & 0xff
+    return self._tx_mv[:9]
+
+  def write(self, register, value, length=8):
+    if length % 2:
+      raise RegisterError('expected even write')
+    if len(value) > length or length + 10 > _MAX_FRAME:
+      raise RegisterError('write too long')
+    b = self._tx
+    b[0] = 255
+    b[1] = 255
+    b[2] = length + 7
+    b[3] = 255
+    b[4] = _FUNC_WRITE
+    b[5] = register >> 8
+    b[6] = register & 0xff
+    b[7] = (length // 2) >> 8
+    b[8] = (length // 2) & 0xff
+    b[9] = length
+    self._tx_mv[10:10 + len(value)] = value
+    for i in range(10 + len(value), 10 + length):
+      b[i] = 0
+    return self._tx_mv[:10 + length]
+
+  @staticmethod
+  def decode(frame):
+    """Returns (function, payload) where payload is a view into frame."""
+    if len(frame) < 5 or frame[0] != 255 or frame[1] != 255:
+      raise RegisterError('bad response')
+    func = frame[4]
+    if func & _FUNC_ERROR:
+      raise RegisterError('device error ' + str(func))
+    return func, memoryview(frame)[_RESPONSE_HEADER:]
+
+
+class RegisterClient:
+  """Queues vendor register reads/writes per device, and runs them on an open connection.
+
+  Requests go one at a time over the request characteristic; each is matched to the next
+  notification on the response characteristic. Read results are cached on the bridge. A request
+  that fails _MAX_ATTEMPTS times is dropped, and a dropped read is cached as empty so it isn't
+  queued again.
+  """
+
+  def __init__(self, request_uuid, response_uuid):
+    self._request_uuid = request_uuid
+    self._response_uuid = response_uuid
+    self._codec = RegisterCodec()
+    self._queue = {}  # addr => [(register, length, value or None), ...]
+    self._failures = {}  # addr => failed attempts at the head of its queue
+    self._cccd = {}   # addr => cccd handle for the response characteristic
+    self.cache = {}   # addr => {register: (bytes, ticks_ms)}
+
+    self._conn_handle = None
+    self._response_handle = None
+    self._found_cccd = None
+    self._rx = bytearray(_MAX_FRAME)
+    self._rx_len = 0
+    self._status = None
+    self._event = asyncio.ThreadSafeFlag()
+
+    core.register_irq_handler(self._irq, None)
+
+  def queue_read(self, addr, register, length=8):
+    self._queue.setdefault(addr, []).append((register, length, None))
+
+  def queue_write(self, addr, register, value, length=8):
+    self._queue.setdefault(addr, []).append((register, length, value))
+
+  def pending(self, addr):
+    return bool(self._queue.get(addr))
+
+  def cached(self, addr, register):
+    """Returns the value read (empty if the read failed for good), or None if not read yet."""
+    entry = self.cache.get(addr, {}).get(register)
+    return entry and entry[0]
+
+  def _irq(self, event, data):
+    if event == _IRQ_GATTC_NOTIFY:
+      conn_handle, value_handle, notify_data = data
+      if conn_handle == self._conn_handle and value_handle == self._response_handle:
+        n = min(len(notify_data), _MAX_FRAME)
+        self._rx[0:n] = notify_data[0:n]
+        self._rx_len = n
+        self._event.set()
+
+    elif event == _IRQ_GATTC_DESCRIPTOR_RESULT:
+      conn_handle, dsc_handle, uuid = data
+      if conn_handle == self._conn_handle and bluetooth.UUID(uuid) == _CCCD_UUID:
+        self._found_cccd = dsc_handle
+
+    elif event == _IRQ_GATTC_DESCRIPTOR_DONE or event == _IRQ_GATTC_WRITE_DONE:
+      conn_handle = data[0]
+      if conn_handle == self._conn_handle:
+        self._status = data[-1]
+        self._event.set()
+
+  async def _wait(self):
+    await asyncio.wait_for_ms(self._event.wait(), _TIMEOUT_MS)
+    return self._status
+
+  async def _subscribe(self, addr, response):
+    value_handle, _, end_handle = response
+    cccd = self._cccd.get(addr)
+    if cccd is None:
+      self._found_cccd = None
+      self._status = None
+      core.ble.gattc_discover_descriptors(self._conn_handle, value_handle + 1, end_handle)
+      await self._wait()
+      cccd = self._found_cccd
+      if cccd is None:
+        raise RegisterError('no cccd for response')
+      self._cccd[addr] = cccd
+
+    self._status = None
+    core.ble.gattc_write(self._conn_handle, cccd, b'\x01\x00', 1)
+    if await self._wait():
+      raise RegisterError('could not subscribe')
+
+  async def run(self, connection, handles):
+    """Runs anything queued for this device. handles is from WriteEngine.discover()."""
+    addr = connection.device.addr
+    queue = self._queue.get(addr)
+    if not queue:
+      return 0
+
+    request = handles.get(self._request_uuid)
+    response = handles.get(self._response_uuid)
+    if not request or not response:
+      del self._queue[addr]  # no point retrying
+      for register, _, value in queue:
+        if value is None:
+          self._store(addr, register, b'')
+      raise RegisterError('device has no command service')
+
+    self._conn_handle = connection._conn_handle
+    self._response_handle = None
+    done = 0
+    try:
+      await self._subscribe(addr, response)
+      self._response_handle = response[0]
+
+      while queue:
+        register, length, value = queue[0]
+        if value is None:
+          frame = self._codec.read(register, length)
+        else:
+          frame = self._codec.write(register, value, length)
+
+        self._rx_len = 0
+        self._status = None
+        core.ble.gattc_write(self._conn_handle, request[0], frame, 1)
+        # the write's response, then the notification (either can be in before we wait)
+        while self._status is None or not (self._status or self._rx_len):
+          await self._wait()
+        if self._status:
+          raise RegisterError('request failed ' + str(self._status))
+        func, payload = RegisterCodec.decode(memoryview(self._rx)[:self._rx_len])
+
+        if value is None:
+          if func != _FUNC_READ:
+            raise RegisterError('unexpected response ' + str(func))
+          self._store(addr, register, bytes(payload[:length]))
+        queue.pop(0)
+        self._failures.pop(addr, None)
+        done += 1
+
+    except Exception:
+      self._failed(addr, queue)
+      raise
+    finally:
+      self._conn_handle = None
+      self._response_handle = None
+      if not queue:
+        del self._queue[addr]
+
+    return done
+
+  def _failed(self, addr, queue):
+    failures = self._failures.get(addr, 0) + 1
+    if failures < _MAX_ATTEMPTS:
+      self._failures[addr] = failures
+      return
+
+    del self._failures[addr]
+    register, _, value = queue.pop(0)
+    print('register request dropped', hex(register))
+    if value is None:
+      self._store(addr, register, b'')
+
+  def _store(self, addr, register, value):
+    self.cache.setdefault(addr, {})[register] = (value, time.ticks_ms())
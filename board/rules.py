@@ -0,0 +1,199 @@
+from micropython import const
+
+import uasyncio as asyncio
+import array
+import machine
+import struct
+import time
+
+
+RULES_TYPE = const(0x52)
+
+# ops, in rest[1] of a frame from a zero MAC
+_OP_COMMIT = const(0)  # replace the running rules with those sent since BEGIN, and save them
+_OP_BEGIN = const(1)
+_OP_LIGHT = const(2)   # slot, mac (6)
+_OP_RULE = const(3)    # index, then a rule record
+_OP_TIME = const(4)    # local time as seconds since 2000 (4), UTC offset in minutes (2, signed)
+
+# rule record: trigger, a, b, target slot, on, brightness (all that fits after op and index)
+_RULE_SIZE = const(6)
+TRIGGER_CHANGE = const(1)  # a: slot, b: one of the conditions below
+TRIGGER_TIME = const(2)    # a: hour, b: minute, of the bridge's local time
+WHEN_OFF = const(0)
+WHEN_ON = const(1)
+WHEN_ANY = const(2)
+
+ALL_LIGHTS = const(0xff)   # as the target slot
+NONE = const(0xff)         # as on or brightness, leave that alone
+
+_MAX_LIGHTS = const(32)
+_MAX_RULES = const(32)
+_MAX_FIRED = const(16)
+_COOLDOWN_MS = const(2000)  # per rule, so rules that trigger each other can't loop quickly
+_CHECK_MS = const(1000)
+
+_UNKNOWN = const(0xff)
+_EPOCH_2000 = const(946684800)  # Unix seconds at 2000-01-01
+
+
+class Rules:
+  """Automation rules that run on the bridge, so they work without the server (or cloud).
+
+  The server compiles rules into frames: a table of light slots, then fixed-size rule records.
+  Both are kept in preallocated buffers, and observe() (called for every scan result) only
+  compares bytes and queues the indexes of rules that fire; run() turns those into commands.
+  """
+
+  def __init__(self, act, path='rules.bin'):
+    self._act = act  # async (mac, on, brightness)
+    self._path = path
+
+    self._macs = [None] * _MAX_LIGHTS
+    self._slots = {}  # mac => slot
+    self._rules = bytearray(_MAX_RULES * _RULE_SIZE)
+    self._count = 0
+
+    self._last_on = bytearray([_UNKNOWN] * _MAX_LIGHTS)
+    self._last_brightness = bytearray(_MAX_LIGHTS)
+    self._fired_at = array.array('i', [0] * _MAX_RULES)
+    self._fired = bytearray(_MAX_FIRED)
+    self._fired_count = 0
+    self._flag = asyncio.ThreadSafeFlag()
+    self._last_minute = None
+    self.clock_set = False  # the RTC starts at 2000-01-01, so time rules wait for the server's time
+    self.utc_offset_min = 0
+
+    self._staging = None
+    self._frames = None
+    try:
+      with open(path, 'rb') as f:
+        data = f.read()
+      for i in range(0, len(data) - 15, 16):
+        self.handle(data[i + 6:i + 16], save=False)
+    except OSError:
+      pass
+
+  def handle(self, rest, save=True):
+    """Handles the 10 bytes after a zero MAC. Returns (rules, lights) on commit, else None."""
+    op = rest[1]
+    if op == _OP_TIME:
+      self._set_clock(rest)
+      return None
+    if op == _OP_BEGIN:
+      self._staging = ([None] * _MAX_LIGHTS, bytearray(_MAX_RULES * _RULE_SIZE), [0])
+      self._frames = [bytes(6) + bytes(rest)]
+      return None
+    if self._staging is None:
+      print('rules frame without begin', op)
+      return None
+
+    macs, records, count = self._staging
+    self._frames.append(bytes(6) + bytes(rest))
+    if op == _OP_LIGHT and rest[2] < _MAX_LIGHTS:
+      macs[rest[2]] = bytes(rest[3:9])
+    elif op == _OP_RULE and rest[2] < _MAX_RULES:
+      i = rest[2] * _RULE_SIZE
+      records[i:i + _RULE_SIZE] = rest[3:3 + _RULE_SIZE]  # exactly, so the buffer keeps its size
+      count[0] = max(count[0], rest[2] + 1)
+    elif op != _OP_COMMIT:
+      print('rules frame rejected', op, rest[2])
+    if op != _OP_COMMIT:
+      return None
+
+    self._macs = macs
+    self._slots = {mac: slot for slot, mac in enumerate(macs) if mac is not None}
+    self._rules = records
+    self._count = count[0]
+    for i in range(_MAX_LIGHTS):
+      self._last_on[i] = _UNKNOWN
+    for i in range(_MAX_RULES):
+      self._fired_at[i] = 0
+    self._fired_count = 0
+
+    if save:
+      with open(self._path, 'wb') as f:
+        for frame in self._frames:
+          f.write(frame)
+    self._staging = None
+    self._frames = None
+    print('rules', self._count, 'lights', len(self._slots))
+    return self._count, len(self._slots)
+
+  def observe(self, addr, is_on, brightness):
+    """Records a light's state, and fires change rules for it. Doesn't allocate."""
+    slot = self._slots.get(addr)
+    if slot is None:
+      return
+    on = is_on and 1 or 0
+    last_on = self._last_on[slot]
+    last_brightness = self._last_brightness[slot]
+    self._last_on[slot] = on
+    self._last_brightness[slot] = brightness
+    if last_on == _UNKNOWN or (last_on == on and last_brightness == brightness):
+      return  # first sighting, or no change
+
+    r = self._rules
+    for i in range(self._count):
+      base = i * _RULE_SIZE
+      if r[base] != TRIGGER_CHANGE or r[base + 1] != slot:
+        continue
+      when = r[base + 2]
+      if when == WHEN_ANY or (when == on and last_on != on):
+        self._fire(i)
+
+  def _fire(self, i):
+    now = time.ticks_ms()
+    if self._fired_at[i] and time.ticks_diff(now, self._fired_at[i]) < _COOLDOWN_MS:
+      return
+    if self._fired_count >= _MAX_FIRED:
+      return
+    self._fired_at[i] = now or 1
+    self._fired[self._fired_count] = i
+    self._fired_count += 1
+    self._flag.set()
+
+  def _set_clock(self, rest):
+    seconds, self.utc_offset_min = struct.unpack('>Ih', rest[2:8])
+    if time.gmtime(0)[0] != 2000:
+      seconds += _EPOCH_2000  # our epoch is 2000 on the pyboard, but not on every port
+    t = time.gmtime(seconds)
+    machine.RTC().datetime((t[0], t[1], t[2], t[6] + 1, t[3], t[4], t[5], 0))
+    self.clock_set = True
+    print('clock set', t, 'utc offset', self.utc_offset_min)
+
+  def _check_time(self):
+    if not self.clock_set:
+      return
+    t = time.localtime()
+    minute = t[3] * 60 + t[4]
+    if minute == self._last_minute:
+      return
+    self._last_minute = minute
+
+    r = self._rules
+    for i in range(self._count):
+      base = i * _RULE_SIZE
+      if r[base] == TRIGGER_TIME and r[base + 1] == t[3] and r[base + 2] == t[4]:
+        self._fire(i)
+
+  async def run(self):
+    while True:
+      try:
+        await asyncio.wait_for_ms(self._flag.wait(), _CHECK_MS)
+      except asyncio.TimeoutError:
+        pass
+      self._check_time()
+
+      while self._fired_count:
+        self._fired_count -= 1
+        i = self._fired[self._fired_count]
+        base = i * _RULE_SIZE
+        target, on, brightness = self._rules[base + 3], self._rules[base + 4], self._rules[base + 5]
+        print('rule fired', i)
+        if target == ALL_LIGHTS:
+          for mac in self._macs:
+            if mac is not None:
+              await self._act(mac, on, brightness)
+        elif target < _MAX_LIGHTS and self._macs[target] is not None:
+          await self._act(self._macs[target], on, brightness)
@@ -0,0 +1,75 @@
+try:
+  from micropython import const
+except ImportError:
+  def const(x):
+    return x
+
+
+_DISCOVERY_SCAN_MS = const(30 * 1000)
+_DISCOVERY_EVERY = const(30)         # scans; picks up new/renamed lights now and then
+
+_BUSY_DUTY = const(50)               # cap while commands are pending, to leave room to connect
+_TARGET_PER_S = const(1)             # results we'd like per light per second
+
+
+class ScanPolicy:
+  """Chooses scan parameters.
+
+  Lights we've seen by name are tracked by address, so most scans are passive (no scan requests,
+  and the state is in the manufacturer data anyway). An active scan is only done to find names:
+  when nothing is known yet, when a command targets an unknown address, and occasionally.
+
+  The passive duty cycle follows the observed advertisement rate of known lights: if they
+  advertise often we can listen less, and we listen less still while connections are pending.
+  """
+
+  def __init__(self, settings):
+    self._settings = settings  # scan_ms (short, so parameters can follow conditions), interval, min duty
+    self.known = set()
+    self._scans = 0
+    self._unknown = False
+    self._duty = 100
+    self._used = 100
+    self._active = True
+    self._results = 0
+    self._seen = set()
+
+  def need_discovery(self, addr):
+    if addr not in self.known:
+      self._unknown = True
+
+  def next(self, busy):
+    """Returns (duration_ms, interval_us, window_us, active) for the next scan."""
+    self._scans += 1
+    self._results = 0
+    self._seen = set()
+
+    interval_us = self._settings.scan_interval_us
+    self._active = not self.known or self._unknown or self._scans % _DISCOVERY_EVERY == 0
+    if self._active:
+      self._unknown = False
+      return _DISCOVERY_SCAN_MS, interval_us, interval_us, True
+
+    duty = max(self._duty, self._settings.scan_min_duty)
+    if busy and duty > _BUSY_DUTY:
+      duty = _BUSY_DUTY
+    self._used = duty
+    return self._settings.scan_ms, interval_us, interval_us * duty // 100, False
+
+  def observe(self, addr):
+    """Records a result from a known light."""
+    self._results += 1
+    self._seen.add(addr)
+
+  def finish(self, duration_ms):
+    """Updates the duty cycle from results of the scan that just ran."""
+    if self._active or not self._seen or duration_ms <= 0:
+      return
+
+    # per-light results/sec at the duty we used, scaled up to roughly what they really send
+    rate = self._results * 1000.0 / (len(self._seen) * duration_ms)
+    actual = rate * 100.0 / self._used
+
+    duty = int(_TARGET_PER_S * 100.0 / actual)
+    self._duty = max(self._settings.scan_min_duty, min(100, duty))
+    print('scan duty', self._duty, 'rate', actual)
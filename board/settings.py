@@ -0,0 +1,106 @@
+try:
+  from micropython import const
+except ImportError:
+  def const(x):
+    return x
+
+import json
+import struct
+
+
+SETTINGS_TYPE = const(0x63)
+_END = const(0)  # key of the frame that ends a batch of changes
+
+# name, key, default, min, max
+_KNOBS = (
+  ('delay_ms', 1, 100, 10, 5000),
+  ('backoff_ms', 2, 1000, 100, 30000),
+  ('command_expiry_ms', 3, 5000, 500, 60000),
+  ('pair_timeout_ms', 4, 30 * 1000, 1000, 120 * 1000),
+  ('scan_interval_us', 5, 30000, 2500, 10240000),  # BLE limits
+  ('scan_min_duty', 6, 25, 1, 100),                 # percent of the interval
+  ('scan_ms', 7, 10 * 1000, 1000, 60 * 1000),
+  ('server_port', 8, 9999, 1, 65535),
+  ('server_ip', 9, 0, 0, 0xffffffff),               # IPv4 as an int, 0 to look up the hostname
+  ('persistent_slots', 10, 0, 0, 3),                # connections held to busy lights, 0 for none
+  ('persistent_rotate_ms', 11, 60 * 1000, 5000, 60 * 60 * 1000),
+)
+
+SERVER_KNOBS = ('server_port', 'server_ip')
+
+
+class Settings:
+  """Timing and server knobs, which the server can change at runtime and are kept in flash.
+
+  Changes arrive as frames from a zero MAC: [SETTINGS_TYPE, key, value (4 bytes)]. Values out of
+  range are ignored. A frame with key 0 ends the batch: changes are saved, and the effective
+  settings should be reported back (in the same format, also ending with key 0).
+  """
+
+  def __init__(self, path='settings.json'):
+    self._path = path
+    self._by_key = {}
+    for knob in _KNOBS:
+      setattr(self, knob[0], knob[2])
+      self._by_key[knob[1]] = knob
+    self.changed = set()
+
+    try:
+      with open(path) as f:
+        saved = json.load(f)
+    except (OSError, ValueError):
+      saved = {}
+    for knob in _KNOBS:
+      if knob[0] in saved:
+        self.set(knob[1], saved[knob[0]])
+    self.changed = set()
+
+  def set(self, key, value):
+    """Applies a value by key. Returns False if the key is unknown or the value out of range."""
+    knob = self._by_key.get(key)
+    if knob is None or not knob[3] <= value <= knob[4]:
+      print('settings rejected', key, value)
+      return False
+    name = knob[0]
+    if getattr(self, name) != value:
+      setattr(self, name, value)
+      self.changed.add(name)
+      print('settings', name, '=', value)
+    return True
+
+  def handle(self, rest):
+    """Handles the 10 bytes after a zero MAC. Returns True at the end of a batch."""
+    key = rest[1]
+    if key != _END:
+      self.set(key, struct.unpack('>I', rest[2:6])[0])
+      return False
+    if self.changed:
+      self.save()
+    return True
+
+  def default(self, name):
+    for knob in _KNOBS:
+      if knob[0] == name:
+        return knob[2]
+    raise KeyError(name)
+
+  def take_changed(self):
+    out = self.changed
+    self.changed = set()
+    return out
+
+  def save(self):
+    with open(self._path, 'w') as f:
+      json.dump({knob[0]: getattr(self, knob[0]) for knob in _KNOBS}, f)
+
+  def server_ip_str(self):
+    ip = self.server_ip
+    return '.'.join(str((ip >> shift) & 0xff) for shift in (24, 16, 8, 0))
+
+  def report(self):
+    """Returns frames with every effective value, then the end marker."""
+    out = []
+    for knob in _KNOBS:
+      out.append(bytes(6) + struct.pack('>BBI', SETTINGS_TYPE, knob[1], getattr(self, knob[0])) + bytes(4))
+    out.append(bytes(6) + bytes([SETTINGS_TYPE, _END]) + bytes(8))
+    return out
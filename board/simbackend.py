@@ -0,0 +1,106 @@
+# Simulated lights for the bridge core, in process: they advertise their state like the real
+# ones (so scan results go through the same decoding), and take commands after a delay. Runs
+# under CPython (see host.py) and MicroPython.
+
+import random
+
+import bridgecore
+from bridgecore import asyncio, sleep_ms
+import lights
+
+
+_COMPANY = b'\x5c\x02'
+
+
+def light_mac(i):
+  """Matches loadgen.py, so its --write-devices makes a devices file for these."""
+  return bytes([0x02, 0x4c, 0x47, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff])
+
+
+class SimLight:
+  def __init__(self, addr, name, is_on=False, brightness=100):
+    self.addr = addr
+    self.name = name
+    self.is_on = is_on
+    self.brightness = brightness
+    self.revision = 0
+
+  def apply(self, command):
+    if command.toggle_on:
+      self.is_on = not self.is_on
+    elif command.set_on is not None:
+      self.is_on = command.set_on
+    if command.set_brightness is not None:
+      self.brightness = command.set_brightness
+    self.revision = (self.revision + 1) & 0xff
+
+  def adv_data(self):
+    level = int(round(self.brightness * 255 / 100))
+    data = bytes([0, 0, 0, 0, 0, self.revision, self.is_on and 1 or 0, level])
+    return bytes([2, 0x01, 0x06, 1 + len(_COMPANY) + len(data), 0xff]) + _COMPANY + data
+
+  def resp_data(self):
+    name = self.name.encode('utf-8')
+    return bytes([1 + len(name), 0x09]) + name
+
+
+class SimBackend(bridgecore.Backend):
+  """Lights that advertise every interval_ms, and are heard in proportion to the scan window.
+
+  Commands take connect_ms then write_ms (each give or take half), and fail with a timeout with
+  chance loss. Lights also change by themselves (someone at the wall) at change_rate per second.
+  """
+
+  def __init__(self, count=8, interval_ms=1000, connect_ms=300, write_ms=100, loss=0.0, change_rate=0.0):
+    self.lights = {}
+    for i in range(count):
+      addr = light_mac(i)
+      self.lights[addr] = SimLight(addr, 'MICRO_DIMMER_%d' % i, random.random() < 0.5)
+    self._interval_ms = interval_ms
+    self._connect_ms = connect_ms
+    self._write_ms = write_ms
+    self._loss = loss
+    self._change_rate = change_rate
+    self.enacted = 0
+    self.failed = 0
+
+  async def scan(self, duration_ms, interval_us, window_us, active, started, on_result):
+    started()
+    all_lights = list(self.lights.values())
+    if not all_lights:
+      await sleep_ms(duration_ms)
+      return
+
+    step_ms = max(1, self._interval_ms // len(all_lights))
+    change_chance = self._change_rate * self._interval_ms / 1000
+    start = lights.ticks_ms()
+    i = 0
+    while lights.ticks_diff(lights.ticks_ms(), start) < duration_ms:
+      await sleep_ms(step_ms)
+      light = all_lights[i % len(all_lights)]
+      i += 1
+      if random.random() < change_chance:
+        light.is_on = not light.is_on
+        light.revision = (light.revision + 1) & 0xff
+      if random.random() * interval_us >= window_us:
+        continue  # advertised while the radio wasn't listening
+      on_result(lights.ADDR_PUBLIC, light.addr, light.adv_data(), active and light.resp_data() or None)
+
+  def _jitter(self, ms):
+    return ms // 2 + int(random.random() * ms)
+
+  async def enact(self, addr, command, confirm, mark):
+    await sleep_ms(self._jitter(self._connect_ms))
+    light = self.lights.get(addr)
+    if light is None or random.random() < self._loss:
+      self.failed += 1
+      raise asyncio.TimeoutError()
+    mark(bridgecore.CONNECTED)
+    mark(bridgecore.PAIRED)  # nothing to secure here
+
+    await sleep_ms(self._jitter(self._write_ms))
+    light.apply(command)
+    mark(bridgecore.WRITTEN)
+    self.enacted += 1
+    confirm(addr, light.is_on, light.brightness)
+    mark(bridgecore.CONFIRMED)
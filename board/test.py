@@ -1,15 +1,13 @@
 
 from micropython import const
 
-import os
 import bluetooth
 import time
-import json
-import binascii
 import network
 import socket
 
 import ble_advertising
+import bondstore
 
 
 control_service_uuid = bluetooth.UUID('720a9080-9c7d-11e5-a7e3-0002a5d5c51b')
@@ -78,71 +76,6 @@ _IRQ_GET_SECRET = const(29)
 _IRQ_SET_SECRET = const(30)
 
 
-class SecretManager:
-  def __init__(self):
-    try:
-      self._load_secrets()
-    except Exception as e:
-      print('failed to load', e)
-      self._secrets = {}
-      self._save_secrets()
-
-  def get_secret(self, sec_type, index, key):
-    ret = self._get_secret(sec_type, index, key)
-    print('get secret:', sec_type, index, bytes(key) if key else None, 'result', ret)
-    return ret
-
-  def _get_secret(self, sec_type, index, key):
-    if key:
-      key = sec_type, bytes(key)
-      return self._secrets.get(key, None)
-
-    i = 0
-    for (t, _key), value in self._secrets.items():
-      if t == sec_type:
-        if i == index:
-          return value
-        i += 1
-
-    return None
-
-  def set_secret(self, sec_type, key, value):
-    key = sec_type, bytes(key)
-    value = bytes(value) if value else None
-    print("set secret:", key, value)
-
-    if value is not None:
-      self._secrets[key] = value
-      return True
-
-    if key in self._secrets:
-      del self._secrets[key]
-      return True
-
-    return False
-
-  def save(self):
-    self._save_secrets()
-
-  def _load_secrets(self):
-    self._secrets = {}
-    with open('secrets.json', 'r') as f:
-      entries = json.load(f)
-      for sec_type, key, value in entries:
-        self._secrets[sec_type, binascii.a2b_base64(key)] = binascii.a2b_base64(value)
-
-  def _save_secrets(self):
-    with open('secrets.json', 'w') as f:
-      json_secrets = [
-        (sec_type, binascii.b2a_base64(key), binascii.b2a_base64(value))
-        for (sec_type, key), value in self._secrets.items()
-      ]
-      json.dump(json_secrets, f)
-    print("saved")
-    os.sync()
-
-
-
 class LightManager:
   def __init__(self, ble, secret_manager):
     self._secret = secret_manager
@@ -181,9 +114,8 @@ class LightManager:
 
   def _irq(self, event, data):
     if event == _IRQ_SET_SECRET:
-      ret = self._secret.set_secret(*data)
-      self._secret.save()
-      return ret
+      # nb. the store flushes to flash later, not from inside the IRQ
+      return self._secret.set_secret(*data)
 
     elif event == _IRQ_GET_SECRET:
       return self._secret.get_secret(*data)
@@ -264,7 +196,7 @@ class LightManager:
 
 if __name__ == '__main__':
   ble = bluetooth.BLE()
-  secret = SecretManager()
+  secret = bondstore.BondStore()
   m = LightManager(ble, secret)
   m.start(60)
 
@@ -0,0 +1,73 @@
+# Runs board modules under CPython: the board directory is put on the path, and the few
+# MicroPython-only modules they import are replaced by minimal equivalents.
+
+import asyncio
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _install():
+  micropython = types.ModuleType('micropython')
+  micropython.const = lambda x: x
+  micropython.schedule = lambda fn, arg: fn(arg)
+  sys.modules.setdefault('micropython', micropython)
+
+  class ThreadSafeFlag(asyncio.Event):
+    async def wait(self):
+      await super().wait()
+      self.clear()
+
+  uasyncio = types.ModuleType('uasyncio')
+  uasyncio.__dict__.update(asyncio.__dict__)
+  uasyncio.ThreadSafeFlag = ThreadSafeFlag
+  uasyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+  uasyncio.wait_for_ms = lambda aw, ms: asyncio.wait_for(aw, ms / 1000)
+  sys.modules.setdefault('uasyncio', uasyncio)
+
+  core = types.ModuleType('aioble.core')
+  core._irq_handlers = []
+  core._shutdown_handlers = []
+  core.ble = None  # tests put a fake radio here
+  core.register_irq_handler = lambda irq, shutdown: core._irq_handlers.append(irq)
+  aioble = types.ModuleType('aioble')
+  aioble.core = core
+  sys.modules.setdefault('aioble', aioble)
+  sys.modules.setdefault('aioble.core', core)
+
+  class UUID:
+    def __init__(self, value):
+      self.value = value.value if isinstance(value, UUID) else value
+
+    def __eq__(self, other):
+      return isinstance(other, UUID) and self.value == other.value
+
+    def __hash__(self):
+      return hash(self.value)
+
+  bluetooth = types.ModuleType('bluetooth')
+  bluetooth.UUID = UUID
+  sys.modules.setdefault('bluetooth', bluetooth)
+
+  machine = types.ModuleType('machine')
+
+  class RTC:
+    now = None
+
+    def datetime(self, value):
+      RTC.now = value
+
+  machine.RTC = RTC
+  machine.disable_irq = lambda: None
+  machine.enable_irq = lambda state: None
+  sys.modules.setdefault('machine', machine)
+
+  if not hasattr(time, 'ticks_ms'):
+    time.ticks_ms = lambda: int(time.monotonic() * 1000)
+    time.ticks_diff = lambda a, b: a - b
+
+
+_install()
@@ -0,0 +1,51 @@
+import io
+
+import pytest
+from aioble import core
+
+import advtrace
+from test_lights import ADDR, OTHER, advert
+
+
+def test_capture_replays_to_the_same_states(tmp_path):
+  path = str(tmp_path / 'capture.bin')
+  writer = advtrace.TraceWriter(path)
+  writer.install()
+  irq = core._irq_handlers[0]
+
+  assert irq(5, (0, ADDR, 4, -60, advert(40, b'MICRO_DIMMER'))) is None  # scan response
+  irq(5, (0, ADDR, 0, -60, advert(40)))
+  irq(5, (0, ADDR, 0, -61, advert(40)))  # same state, not news
+  irq(5, (0, OTHER, 0, -70, advert(80)))  # never seen by name
+  irq(5, (0, ADDR, 0, -60, advert(0)))
+  irq(3, (1, 2))  # not a scan result
+  writer.uninstall()
+  assert irq not in core._irq_handlers
+  assert writer.records == 5 and writer.dropped == 0
+
+  with open(path, 'rb') as f:
+    records = list(advtrace.read_trace(f))
+  assert [r[1:5] for r in records] == [(0, ADDR, 4, -60), (0, ADDR, 0, -60), (0, ADDR, 0, -61), (0, OTHER, 0, -70), (0, ADDR, 0, -60)]
+  assert records[1][5] == advert(40)
+
+  replay = advtrace.Replay()
+  states = [replay.feed(*r) for r in records]
+  assert [s and (s.is_on, s.brightness) for s in states] == [None, (True, 40), (True, 40), None, (False, 0)]
+  assert replay.results == 3
+
+
+def test_capture_stops_at_max_bytes(tmp_path):
+  writer = advtrace.TraceWriter(str(tmp_path / 'capture.bin'), max_bytes=64)
+  for _ in range(4):
+    writer._irq(5, (0, ADDR, 0, -60, advert(40)))
+  writer.uninstall()
+  assert writer.records == 2 and writer.dropped == 2
+
+
+def test_cut_off_trace_ends_early():
+  record = advtrace.struct.pack(advtrace.RECORD, 0, 0, ADDR, 0, -60, 3) + b'abc'
+  trace = advtrace.MAGIC + bytes([advtrace.VERSION]) + record + record[:-1]
+  assert len(list(advtrace.read_trace(io.BytesIO(trace)))) == 1
+
+  with pytest.raises(ValueError):
+    list(advtrace.read_trace(io.BytesIO(b'NOPE\x01')))
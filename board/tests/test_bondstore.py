@@ -0,0 +1,45 @@
+import bondstore
+
+
+ADDR = bytes([0x00, 0x0d, 0x6f, 0xcd, 0x94, 0xe1])
+OTHER = bytes([0x00, 0x0d, 0x6f, 0xc6, 0xaa, 0xf5])
+_GET = 29
+
+
+class FakeSecurity:
+  """aioble's security module, as far as install() uses it."""
+
+  def __init__(self, secrets):
+    self._secrets = dict(secrets)
+    self._modified = False
+    self.saved = None
+
+  def _save_secrets(self, arg=None):
+    self.saved = dict(self._secrets)
+
+
+def stale():
+  return {(1, b'\x00' + ADDR): b'ltk-addr', (1, b'\x00' + OTHER): b'ltk-other'}
+
+
+def test_key_gone_after_forget(tmp_path):
+  path = str(tmp_path / 'bonds.log')
+  security = FakeSecurity(stale())
+  store = bondstore.BondStore(path)
+  store.install(security)
+  assert store.has_bond(ADDR)
+  assert security._secrets == {} and security.saved == {}
+
+  store.forget(ADDR)
+  assert not store.has_bond(ADDR)
+  assert store._irq(_GET, (1, 0, b'\x00' + ADDR)) is None
+  # by ordinal, only the other bond is left
+  assert store._irq(_GET, (1, 0, None)) == b'ltk-other'
+  assert store._irq(_GET, (1, 1, None)) is None
+
+  # still gone after a restart, even if aioble's file had it again
+  store.flush()
+  restarted = bondstore.BondStore(path)
+  restarted.install(FakeSecurity(stale()))
+  assert not restarted.has_bond(ADDR)
+  assert restarted.has_bond(OTHER)
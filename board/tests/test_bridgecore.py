@@ -0,0 +1,261 @@
+import asyncio
+import struct
+
+import bridgecore
+import scanpolicy
+import settings
+import simbackend
+
+
+def make_bridge(tmp_path, **kwargs):
+  knobs = settings.Settings(str(tmp_path / 'settings.json'))
+  return bridgecore.Bridge(simbackend.SimBackend(count=0), knobs, scanpolicy.ScanPolicy(knobs), **kwargs)
+
+
+def settings_frame(key, value):
+  return bytes([settings.SETTINGS_TYPE, key]) + value.to_bytes(4, 'big') + bytes(4)
+
+
+def test_settings_batch_reconnects_for_server_knobs(tmp_path):
+  async def run():
+    bridge = make_bridge(tmp_path)
+    assert not bridge.read_bridge_command(settings_frame(1, 250))
+    assert not bridge.read_bridge_command(settings_frame(0, 0))  # applied, nothing to reconnect for
+    assert bridge.settings.delay_ms == 250
+
+    assert not bridge.read_bridge_command(settings_frame(8, 0))  # out of range, ignored
+    assert not bridge.read_bridge_command(settings_frame(0, 0))
+    assert not bridge.read_bridge_command(settings_frame(8, 8080))
+    assert bridge.read_bridge_command(settings_frame(0, 0))
+    assert bridge.settings.server_port == 8080
+
+  asyncio.run(run())
+
+
+def test_failing_pushed_server_falls_back_to_the_default(tmp_path, monkeypatch):
+  tried = []
+
+  async def open_connection(host, port):
+    tried.append((host, port))
+    if host != 'default.example':
+      raise OSError(113)
+    return 'reader', 'writer'
+
+  monkeypatch.setattr(bridgecore.asyncio, 'open_connection', open_connection)
+
+  async def run():
+    bridge = make_bridge(tmp_path, hostname='default.example', port=9000)
+    bridge.settings.set(9, 0x0a000002)  # pushed server_ip
+
+    for _ in range(bridgecore.PUSHED_ATTEMPTS):
+      try:
+        await bridge._open()
+      except OSError:
+        pass
+    assert await bridge._open() == ('reader', 'writer')
+
+    # the pushed address gets another chance on the next reconnect
+    try:
+      await bridge._open()
+    except OSError:
+      pass
+
+  asyncio.run(run())
+  pushed = ('10.0.0.2', 9999)
+  assert tried == [pushed] * bridgecore.PUSHED_ATTEMPTS + [('default.example', 9000), pushed]
+
+
+def sim_bridge(tmp_path, **kwargs):
+  bridge = make_bridge(tmp_path, hostname='127.0.0.1')
+  bridge.backend = simbackend.SimBackend(count=2, interval_ms=10, connect_ms=10, write_ms=10, **kwargs)
+  bridge.settings.set(1, 10)  # delay_ms
+  return bridge
+
+
+async def until(check):
+  for _ in range(200):
+    if check():
+      return
+    await asyncio.sleep(0.01)
+  raise AssertionError('timed out')
+
+
+async def start_enacting(bridge):
+  await bridge._pending_lock.acquire()  # as start() does
+  task = asyncio.create_task(bridge.enact_forever())
+  await asyncio.sleep(0)  # to wait for the first command, as it has long before the server connects
+  return task
+
+
+def test_scans_find_simulated_lights(tmp_path):
+  async def run():
+    bridge = sim_bridge(tmp_path)
+    await bridge.backend.scan(60, 100, 100, True, lambda: None, bridge._scan_result)
+    assert bridge.scan_policy.known == set(bridge.backend.lights)
+    for addr, light in bridge.backend.lights.items():
+      state = bridge.light_table.known[addr]
+      assert (state.is_on, state.brightness) == (light.is_on, light.brightness)
+
+  asyncio.run(run())
+
+
+def test_commands_are_enacted_and_confirmed(tmp_path):
+  async def run():
+    bridge = sim_bridge(tmp_path)
+    task = await start_enacting(bridge)
+    addr = simbackend.light_mac(1)
+
+    await bridge.read_command(addr, bytes([0x4c, 1, 30, 0, 0]))
+    await until(lambda: not bridge.pending)
+    light = bridge.backend.lights[addr]
+    assert (light.is_on, light.brightness) == (True, 30)
+    assert bridge.light_table.pop_change() == addr + bytes([0x43, 1, 30]) + bytes(7)
+
+    # a command replaced before it's enacted never runs
+    await bridge.read_command(addr, bytes([0x4c, 2, 255, 0, 0]))
+    await bridge.read_command(addr, bytes([0x4c, 0, 255, 0, 0]))
+    await until(lambda: not bridge.pending)
+    assert not light.is_on and light.brightness == 30
+    assert bridge.backend.enacted == 2
+    task.cancel()
+
+  asyncio.run(run())
+
+
+def test_a_command_replaced_in_flight_runs_next(tmp_path):
+  async def run():
+    bridge = sim_bridge(tmp_path)
+    task = await start_enacting(bridge)
+    addr = simbackend.light_mac(0)
+
+    await bridge.read_command(addr, bytes([0x4c, 1, 30, 0, 0]))
+    first = bridge.pending[addr]
+    await until(lambda: first.attempt)  # connecting
+    await bridge.read_command(addr, bytes([0x4c, 0, 255, 0, 0]))
+    await until(lambda: not bridge.pending)
+
+    assert not bridge.backend.lights[addr].is_on
+    assert bridge.backend.enacted == 2
+    task.cancel()
+
+  asyncio.run(run())
+
+def test_failing_commands_are_abandoned_after_expiry(tmp_path):
+  async def run():
+    bridge = sim_bridge(tmp_path, loss=1.0)
+    bridge.settings.set(3, 500)  # command_expiry_ms
+    task = await start_enacting(bridge)
+
+    await bridge.read_command(simbackend.light_mac(0), bytes([0x4c, 1, 30]))
+    await until(lambda: not bridge.pending)
+    assert bridge.backend.failed > 1 and bridge.backend.enacted == 0
+    assert bridge.light_table.pop_change() is None
+    task.cancel()
+
+  asyncio.run(run())
+
+
+def test_server_gets_a_snapshot_then_changes(tmp_path):
+  async def run():
+    bridge = sim_bridge(tmp_path)
+    await bridge.backend.scan(60, 100, 100, True, lambda: None, bridge._scan_result)
+    while bridge.light_table.pop_change() is not None:
+      pass  # the snapshot has them
+    await start_enacting(bridge)
+
+    connected = asyncio.Queue()
+    server = await asyncio.start_server(lambda r, w: connected.put_nowait((r, w)), '127.0.0.1', 0)
+    bridge.port = server.sockets[0].getsockname()[1]
+    network = asyncio.create_task(bridge.network_forever())
+    reader, writer = await asyncio.wait_for(connected.get(), 1)
+
+    snapshot = [await reader.readexactly(16) for _ in range(3)]
+    assert {f[:6] for f in snapshot[:2]} == set(bridge.backend.lights)
+    assert snapshot[2] == bytes(6) + bytes([0x53, 0xff]) + bytes(8)
+
+    addr = simbackend.light_mac(0)
+    writer.write(addr + bytes([0x4c, 1, 70]) + bytes(7))
+    frames = []
+    while not frames or frames[-1][6] != 0x43:
+      frames.append(await asyncio.wait_for(reader.readexactly(16), 1))
+    assert frames[-1] == addr + bytes([0x43, 1, 70]) + bytes(7)
+    assert frames[:-1] == bridge.settings.report()  # reported as soon as there's something to send
+
+    network.cancel()
+    writer.close()
+    server.close()
+
+  asyncio.run(run())
+
+
+def test_traced_commands_report_each_stage(tmp_path):
+  async def run():
+    bridge = sim_bridge(tmp_path)
+    task = await start_enacting(bridge)
+
+    assert not bridge.read_bridge_command(bytes([bridgecore.CLOCK_TYPE, 0, 1, 2, 3, 4]) + bytes(4))
+    echo = bridge.outbox.pop()
+    assert echo[:12] == bytes(6) + bytes([bridgecore.CLOCK_TYPE, 0, 1, 2, 3, 4])
+
+    await bridge.read_command(simbackend.light_mac(0), bytes([0x4c, 1, 30, 0x12, 0x34]))
+    await bridge.read_command(simbackend.light_mac(1), bytes([0x4c, 1, 30, 0, 0]))  # untraced
+    await until(lambda: not bridge.pending)
+    task.cancel()
+
+    stages = [struct.unpack('>BBHIBB', f[6:]) for f in bridge.outbox]
+    assert [(s[0], s[1], s[2], s[5]) for s in stages] == [
+        (bridgecore.TRACE_TYPE, stage, 0x1234, 1) for stage in range(bridgecore.RECEIVED, bridgecore.DONE + 1)]
+    ticks = [s[3] for s in stages]
+    assert ticks == sorted(ticks)
+
+  asyncio.run(run())
+
+
+def test_frames_queued_at_a_reconnect_go_to_the_next_connection(tmp_path):
+  async def run():
+    bridge = sim_bridge(tmp_path)
+    await start_enacting(bridge)
+
+    connected = asyncio.Queue()
+    server = await asyncio.start_server(lambda r, w: connected.put_nowait((r, w)), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    bridge.port = port
+    network = asyncio.create_task(bridge.network_forever())
+    reader, writer = await asyncio.wait_for(connected.get(), 1)
+    await reader.readexactly(16)  # empty snapshot
+
+    # a clock ping answered just before pushing the same server, which reconnects
+    ping = bytes([bridgecore.CLOCK_TYPE, 0, 1, 2, 3, 4]) + bytes(4)
+    writer.write(bytes(6) + ping + bytes(6) + settings_frame(8, port) + bytes(6) + settings_frame(0, 0))
+    reader, writer = await asyncio.wait_for(connected.get(), 1)
+
+    frames = []
+    while not frames or frames[-1][6] != bridgecore.CLOCK_TYPE:
+      frames.append(await asyncio.wait_for(reader.readexactly(16), 1))
+    assert frames[-1][:12] == bytes(6) + ping[:6]
+
+    network.cancel()
+    writer.close()
+    server.close()
+
+  asyncio.run(run())
+
+
+def test_a_command_replaced_in_flight_is_done_once(tmp_path):
+  async def run():
+    bridge = sim_bridge(tmp_path)
+    task = await start_enacting(bridge)
+    addr = simbackend.light_mac(0)
+
+    await bridge.read_command(addr, bytes([0x4c, 1, 30, 0, 1]))
+    first = bridge.pending[addr]
+    await until(lambda: first.attempt)
+    await bridge.read_command(addr, bytes([0x4c, 0, 255, 0, 2]))
+    await until(lambda: not bridge.pending)
+    task.cancel()
+
+    done = [struct.unpack('>BBHIBB', f[6:]) for f in bridge.outbox]
+    done = [(s[2], s[5]) for s in done if s[1] == bridgecore.DONE]
+    assert done == [(1, 1), (2, 1)]
+
+  asyncio.run(run())
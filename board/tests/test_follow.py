@@ -0,0 +1,35 @@
+import io
+import json
+
+import follow
+
+
+def records(data, chunk):
+  out = io.StringIO()
+  stream = follow.EventStream(out, clock=lambda: 1.5)
+  for i in range(0, len(data), chunk):
+    stream(data[i:i + chunk])
+  stream.finish()
+  return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+LOG = b"scanning...\r\ninserting b'\\x00\\ro\\xc6\\xaa\\xf5' command on\r\n\x04connected!"
+
+
+def test_lines_split_across_chunks():
+  expected = [
+      {'event': 'scan_start', 'ts': 1.5},
+      {'event': 'command', 'addr': '00:0d:6f:c6:aa:f5', 'command': 'command on', 'ts': 1.5},
+      {'event': 'network_connected', 'ts': 1.5},  # no newline, so only on finish()
+  ]
+  assert records(LOG, 1) == expected
+  assert records(LOG, 7) == expected
+  assert records(LOG, len(LOG)) == expected
+
+
+def test_long_line_a_byte_at_a_time():
+  out = io.StringIO()
+  stream = follow.EventStream(out, raw=True, clock=lambda: 0)
+  for b in b'x' * 200_000 + b'\n':
+    stream(bytes([b]))
+  assert json.loads(out.getvalue())['line'] == 'x' * 200_000
@@ -0,0 +1,78 @@
+import asyncio
+import types
+
+import bluetooth
+from aioble import core
+
+import bridgecore
+import gattwrite
+
+
+STATE = bluetooth.UUID('state')
+LEVEL = bluetooth.UUID('level')
+OTHER = bluetooth.UUID('other')
+
+
+def plan(on, brightness):
+  engine = gattwrite.WriteEngine(STATE, LEVEL)
+  return engine.plan(bridgecore.build_command(on, brightness))
+
+
+def test_plan():
+  assert plan(1, 255) == [(STATE, b'\x01')]
+  assert plan(0, 255) == [(STATE, b'\x00')]
+  assert plan(2, 255) == [(STATE, b'\x02')]
+  assert plan(255, 50) == [(LEVEL, (5000).to_bytes(2, 'little'))]
+  assert plan(1, 50) == [(LEVEL, (5000).to_bytes(2, 'little'))]  # a level turns it on anyway
+  assert plan(1, 0) == [(STATE, b'\x01'), (LEVEL, b'\x00\x00')]
+  assert plan(2, 80) == [(STATE, b'\x02'), (LEVEL, (8000).to_bytes(2, 'little'))]
+  # turning off goes last, so the level can't turn it back on
+  assert plan(0, 30) == [(LEVEL, (3000).to_bytes(2, 'little')), (STATE, b'\x00')]
+  assert plan(255, 255) == []
+
+
+class FakeRadio:
+  """A light with state, level and another characteristic, which records writes."""
+
+  def __init__(self, engine, no_response=True):
+    self._engine = engine
+    self._props = 0x04 | 0x08 if no_response else 0x08
+    self.discoveries = 0
+    self.writes = []  # (value handle, data, mode)
+
+  def gattc_discover_characteristics(self, conn_handle, start, end):
+    self.discoveries += 1
+    for def_handle, uuid in ((10, STATE), (13, LEVEL), (16, OTHER)):
+      self._engine._irq(11, (conn_handle, def_handle, def_handle + 1, self._props, uuid))
+    self._engine._irq(12, (conn_handle, 0))
+
+  def gattc_write(self, conn_handle, value_handle, data, mode):
+    self.writes.append((value_handle, bytes(data), mode))
+    if mode:
+      self._engine._irq(17, (conn_handle, value_handle, 0))
+
+
+def connection():
+  return types.SimpleNamespace(device=types.SimpleNamespace(addr=b'\x00' * 6), _conn_handle=1)
+
+
+def test_write_waits_only_for_the_last():
+  engine = gattwrite.WriteEngine(STATE, LEVEL, (OTHER,))
+  core.ble = FakeRadio(engine)
+
+  async def run():
+    assert await engine.write(connection(), bridgecore.build_command(0, 30)) == 1
+    assert core.ble.writes == [(14, (3000).to_bytes(2, 'little'), 0), (11, b'\x00', 1)]
+    assert await engine.write(connection(), bridgecore.build_command(1, 255)) == 1
+    assert core.ble.discoveries == 1  # handles are kept
+
+  asyncio.run(run())
+  handles = engine._handles[b'\x00' * 6]
+  assert handles[STATE] == (11, 0x0c, 12) and handles[LEVEL] == (14, 0x0c, 15) and handles[OTHER][0] == 17
+
+
+def test_write_waits_for_each_without_write_no_response():
+  engine = gattwrite.WriteEngine(STATE, LEVEL)
+  core.ble = FakeRadio(engine, no_response=False)
+  assert asyncio.run(engine.write(connection(), bridgecore.build_command(2, 80))) == 2
+  assert [mode for _, _, mode in core.ble.writes] == [1, 1]
@@ -0,0 +1,83 @@
+import types
+
+import pytest
+
+import latency
+
+
+A = b'\x01' * 6
+B = b'\x02' * 6
+CAPS = (10000, 30000, 5000)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  now = [0]
+  monkeypatch.setattr(latency, 'time', types.SimpleNamespace(ticks_ms=lambda: now[0], ticks_diff=lambda a, b: a - b))
+  return now
+
+
+def stage(table, clock, addr, which, ms):
+  timeout = table.begin(addr, which)
+  clock[0] += ms
+  table.end()
+  return timeout
+
+
+def test_timeout_follows_recent_p90(clock):
+  table = latency.LatencyTable(lambda: CAPS)
+  for _ in range(2):
+    assert stage(table, clock, A, latency.CONNECT, 800) == 10000  # too few samples yet
+  stage(table, clock, A, latency.CONNECT, 800)
+  assert table.timeout(A, latency.CONNECT) == 2400
+  assert table.timeout(A, latency.WRITE) == 5000  # per stage
+  assert table.timeout(B, latency.CONNECT) == 10000  # and per light
+
+  # only the last few samples count, and never below the floor
+  for _ in range(8):
+    stage(table, clock, A, latency.CONNECT, 50)
+  assert table.timeout(A, latency.CONNECT) == 1000
+
+
+def test_timeouts_back_off_until_a_success(clock):
+  table = latency.LatencyTable(lambda: CAPS)
+  for _ in range(3):
+    stage(table, clock, A, latency.CONNECT, 800)
+
+  timeouts = []
+  for _ in range(6):
+    timeouts.append(table.begin(A, latency.CONNECT))
+    table.outcome(A, False, timed_out=True)
+  assert timeouts == [2400, 4800, 9600, 10000, 10000, 10000]
+  assert table.devices[A].misses[latency.CONNECT] == 4
+
+  table.outcome(A, False, timed_out=True)  # no stage running, nothing to blame
+  assert stage(table, clock, A, latency.CONNECT, 800) == 10000
+  assert table.timeout(A, latency.CONNECT) == 2400
+
+
+def test_likely_lights_are_picked_more(monkeypatch):
+  table = latency.LatencyTable(lambda: CAPS)
+  for _ in range(8):
+    table.outcome(A, False)
+    table.outcome(B, True)
+  assert table.likelihood(A) == 0.1 and table.likelihood(B) == 0.9
+  assert table.likelihood(b'\x03' * 6) == 0.5
+
+  monkeypatch.setattr(latency.random, 'random', lambda: 0.5)
+  assert table.pick([A, B]) == B
+  monkeypatch.setattr(latency.random, 'random', lambda: 0.05)
+  assert table.pick([A, B]) == A
+
+
+def test_old_history_fades():
+  table = latency.LatencyTable(lambda: CAPS)
+  for _ in range(30):
+    table.outcome(A, False)
+  table.outcome(A, True)
+  table.outcome(A, True)
+  d = table.devices[A]
+  assert (d.successes, d.attempts) == (1, 16)
+  for _ in range(16):
+    table.outcome(A, True)
+  assert (d.successes, d.attempts) == (8, 16)  # now mostly successes
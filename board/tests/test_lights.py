@@ -0,0 +1,60 @@
+import lights
+
+
+ADDR = bytes([0x00, 0x0d, 0x6f, 0xc6, 0xaa, 0xf5])
+OTHER = bytes([0x00, 0x0d, 0x6f, 0xc6, 0xaa, 0xf9])
+
+
+def test_snapshot_has_every_light_with_its_age():
+  table = lights.LightTable()
+  table.seen(ADDR, True, 40, now=1000)
+  table.seen(OTHER, False, 100, now=5000)
+  table.pop_change(now=5000)
+
+  assert table.snapshot(now=12500) == [
+      ADDR + bytes([0x53, 1, 40, 0, 11, 0, 0, 0, 0, 0]),
+      OTHER + bytes([0x53, 0, 100, 0, 7, 0, 0, 0, 0, 0]),
+      bytes(6) + bytes([0x53, 0xff, 0, 0, 0, 0, 0, 0, 0, 0]),
+  ]
+  assert table.snapshot(now=1000 + 100_000_000)[0][9:11] == b'\xff\xff'  # capped
+  assert lights.LightTable().snapshot() == [bytes(6) + bytes([0x53, 0xff]) + bytes(8)]
+
+
+def advert(level, name=None):
+  """An advertisement like the dimmers send: optionally a name, then manufacturer data."""
+  out = b''
+  if name:
+    out += bytes([1 + len(name), 0x09]) + name
+  data = bytes([0x02, 0x01, 0, 0, 0, 0, 0, 7, 15 if level else 0, round(level * 2.55)])
+  return out + bytes([1 + len(data), 0xff]) + data
+
+
+def test_lights_are_known_by_name_then_address():
+  known = set()
+  assert lights.parse_result(0, ADDR, advert(40), None, known) is None  # not seen by name yet
+
+  assert lights.parse_result(0, ADDR, advert(40), advert(40, b'MICRO_DIMMER'), known) == ('MICRO_DIMMER', True, 40)
+  assert lights.parse_result(0, ADDR, advert(0), None, known) == ('', False, 0)
+
+  assert lights.parse_result(1, OTHER, advert(40, b'MICRO_DIMMER'), None, known) is None  # random address
+  assert lights.parse_result(0, OTHER, advert(40, b'SPEAKER'), None, known) is None
+  assert known == {ADDR}
+
+
+def test_unchanged_states_are_resent_as_keepalives():
+  table = lights.LightTable()
+  assert table.seen(ADDR, True, 40, now=0)
+  assert table.pop_change(now=0) == ADDR + bytes([0x55, 1, 40]) + bytes(7)
+  assert table.pop_change(now=0) is None
+
+  assert table.seen(ADDR, True, 40, now=29_000) is None
+  assert table.seen(ADDR, True, 40, now=30_000)
+  assert table.seen(ADDR, False, 40, now=30_500)  # changes are news at once
+
+
+def test_confirmed_state_is_not_news_when_advertised():
+  table = lights.LightTable()
+  table.seen(ADDR, False, 40, now=0)
+  table.confirm(ADDR, True, 60, now=100)
+  assert table.pop_change(now=100) == ADDR + bytes([0x43, 1, 60]) + bytes(7)
+  assert table.seen(ADDR, True, 60, now=200) is None
@@ -0,0 +1,89 @@
+import asyncio
+import types
+
+import loadgen
+
+
+def args(port, loss=0.0):
+  return types.SimpleNamespace(host='127.0.0.1', port=port, change_rate=0, latency_ms=0, jitter_ms=0, loss=loss)
+
+
+async def serve(handle):
+  server = await asyncio.start_server(handle, '127.0.0.1', 0)
+  return server, server.sockets[0].getsockname()[1]
+
+
+def test_devices_file_lists_every_light(tmp_path):
+  path = tmp_path / 'devices.json5'
+  macs = loadgen.light_macs(300)
+  loadgen.write_devices(str(path), macs)
+
+  lines = path.read_text().splitlines()
+  assert len(set(macs)) == 300
+  assert lines[1] == "  '02:4c:47:00:00:00': {type: 'clipsal', name: 'Load 0'},"
+  assert lines[300] == "  '02:4c:47:00:01:2b': {type: 'clipsal', name: 'Load 299'},"
+  assert lines[0] == '{' and lines[-1] == '}'
+
+
+def test_bridge_snapshots_then_confirms_commands():
+  lights = [loadgen.Light(mac) for mac in loadgen.light_macs(3)]
+  stats = loadgen.Stats()
+
+  async def run():
+    frames = asyncio.Queue()
+
+    async def handle(reader, writer):
+      while True:
+        frames.put_nowait(await reader.readexactly(loadgen.FRAME))
+        if frames.qsize() == 4:
+          writer.write(lights[1].mac + bytes([0x4c, 1, 42]) + bytes(7))  # on at 42%
+
+    server, port = await serve(handle)
+    bridge = loadgen.Bridge(0, lights, args(port), stats)
+    task = asyncio.create_task(bridge.run(1))
+
+    snapshot = [await frames.get() for _ in range(4)]
+    assert [f[:6] for f in snapshot[:3]] == [l.mac for l in lights]
+    assert all(f[6] == loadgen.SNAPSHOT_TYPE for f in snapshot[:3])
+    assert snapshot[3][:8] == bytes(6) + bytes([loadgen.SNAPSHOT_TYPE, 0xff])
+
+    confirm = await asyncio.wait_for(frames.get(), 1)
+    assert confirm == loadgen.frame(lights[1].mac, loadgen.CONFIRM_TYPE, True, 42)
+    assert lights[1].is_on and lights[1].brightness == 42
+    assert stats.frames == 5
+
+    task.cancel()
+    server.close()
+
+  asyncio.run(run())
+
+
+def test_lost_commands_are_counted_not_confirmed():
+  light = loadgen.Light(loadgen.light_macs(1)[0])
+  stats = loadgen.Stats()
+  bridge = loadgen.Bridge(0, [light], args(0, loss=1.0), stats)
+
+  asyncio.run(bridge.enact(light, bytes([0x4c, 1, 42])))
+  assert stats.dropped == 1 and stats.frames == 0
+
+
+def test_unfinished_commands_end_with_their_step():
+  light = loadgen.Light(loadgen.light_macs(1)[0])
+  stats = loadgen.Stats()
+  slow = args(0)
+  slow.latency_ms = 200
+  bridge = loadgen.Bridge(0, [light], slow, stats)
+
+  async def run():
+    stats.spawn(bridge.enact(light, bytes([0x4c, 1, 42])))
+    await asyncio.sleep(0)
+    await stats.settle()
+    await asyncio.sleep(0.3)  # long enough that it would have confirmed
+
+  asyncio.run(run())
+  assert not stats.tasks and stats.frames == 0
+
+def test_percentiles():
+  assert loadgen.pct([], 0.5) is None
+  assert loadgen.pct([0.3, 0.1, 0.2], 0.5) == 200
+  assert loadgen.pct([0.001 * i for i in range(1, 101)], 0.9) == 91
@@ -0,0 +1,46 @@
+import asyncio
+
+import localctl
+
+
+MAC = bytes([0x00, 0x0d, 0x6f, 0xc6, 0xaa, 0xf5])
+
+
+def test_parse_request():
+  assert localctl._parse_request('/light/00:0d:6f:c6:aa:f5?on=1&brightness=50') == (
+      MAC, bytes([0x55, 1, 50, 0, 0, 0, 0, 0, 0, 0]))
+  assert localctl._parse_request('/light/000d6fc6aaf5?on=toggle')[1][:3] == bytes([0x55, 2, 255])
+  assert localctl._parse_request('/light/000d6fc6aaf5?brightness=0')[1][:3] == bytes([0x55, 255, 0])
+
+  for bad in ('/light/000d6fc6aaf5?on=maybe', '/light/000d6fc6aaf5?brightness=101',
+              '/light/000d6fc6aaf5?brightness=x', '/light/000d6fc6aa', '/light/zz0d6fc6aaf5',
+              '/lights/000d6fc6aaf5', '/light/000d6fc6aaf5/on'):
+    assert localctl._parse_request(bad) is None, bad
+
+
+def test_http():
+  commands = []
+
+  async def on_command(mac, rest):
+    commands.append((mac, rest))
+
+  async def request(port, line):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(line.encode() + b'\r\nHost: bridge\r\n\r\n')
+    response = await reader.read()
+    writer.close()
+    return response.decode().split('\r\n')[0]
+
+  async def run():
+    server = await asyncio.start_server(
+        lambda r, w: localctl._handle_http(r, w, on_command, lambda: 'stats\n'), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    assert await request(port, 'POST /light/000d6fc6aaf5?on=0 HTTP/1.1') == 'HTTP/1.0 202 Accepted'
+    assert await request(port, 'GET /light/000d6fc6aaf5?on=2 HTTP/1.1') == 'HTTP/1.0 400 Bad Request'
+    assert await request(port, 'PUT /light/000d6fc6aaf5?on=0 HTTP/1.1') == 'HTTP/1.0 405 Method Not Allowed'
+    assert await request(port, 'GET /stats HTTP/1.1') == 'HTTP/1.0 200 OK'
+    server.close()
+
+  asyncio.run(run())
+  assert commands == [(MAC, bytes([0x55, 0, 255, 0, 0, 0, 0, 0, 0, 0]))]
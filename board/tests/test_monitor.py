@@ -0,0 +1,78 @@
+import asyncio
+
+import monitor
+
+
+class FakeGc:
+  """MicroPython's gc, over a heap the test moves around."""
+
+  def __init__(self):
+    self.alloc = 1000
+    self.free = 100_000
+    self.collections = 0
+    self.thresholds = []
+
+  def mem_alloc(self):
+    return self.alloc
+
+  def mem_free(self):
+    return self.free
+
+  def collect(self):
+    self.collections += 1
+    self.alloc = 1000
+
+  def threshold(self, value):
+    self.thresholds.append(value)
+
+
+def test_report_frame(monkeypatch):
+  frames = []
+  monkeypatch.setattr(monitor, 'gc', FakeGc())
+  m = monitor.Monitor(lambda: True, frames.append, (lambda: b'extra',))
+  m.lag_max, m.lag_total, m.samples, m.gc_max, m.auto_gcs, m.frag = 300, 50, 10, 12, 3, 25
+
+  m.report()
+  assert frames == [bytes(6) + bytes([0x4d, 1, 44, 5, 0, 97, 25, 0, 12, 3]), b'extra']
+  assert (m.lag_max, m.samples, m.auto_gcs) == (0, 0, 0)
+
+
+def test_collects_and_probes_only_while_idle(monkeypatch):
+  fake = FakeGc()
+  monkeypatch.setattr(monitor, 'gc', fake)
+  monkeypatch.setattr(monitor, '_SAMPLE_MS', 1)
+  probes = []
+
+  def probe(limit):
+    probes.append(limit)
+    fake.alloc = 200  # bisecting runs collections of its own
+    return limit // 2
+
+  monkeypatch.setattr(monitor, 'largest_free_block', probe)
+  idle = [False]
+  m = monitor.Monitor(lambda: idle[0], lambda frame: None)
+  assert fake.thresholds == [50_000]
+
+  async def run():
+    task = asyncio.ensure_future(m.run())
+    fake.alloc = 40_000  # past the idle collection point, but busy
+    await asyncio.sleep(0.02)
+    assert fake.collections == 0 and not probes
+
+    fake.alloc = 500  # an automatic collection
+    await asyncio.sleep(0.02)
+    assert m.auto_gcs == 1
+
+    idle[0] = True
+    fake.alloc = 40_000
+    await asyncio.sleep(0.02)
+    assert fake.collections == 1
+    assert probes == [100_000] and m.frag == 50
+    assert m.auto_gcs == 1  # the probe's collections aren't counted
+
+    m.report()
+    await asyncio.sleep(0.02)
+    assert len(probes) == 2  # once per report
+    task.cancel()
+
+  asyncio.run(run())
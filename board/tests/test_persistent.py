@@ -0,0 +1,45 @@
+import asyncio
+import types
+
+import persistent
+
+
+GOOD = bytes([0x00, 0x0d, 0x6f, 0xcd, 0x94, 0xe1])
+BAD = bytes([0x00, 0x0d, 0x6f, 0xc6, 0xaa, 0xf5])
+
+
+class FakeConnection:
+  def __init__(self, conn_handle):
+    self._conn_handle = conn_handle
+
+  def is_connected(self):
+    return True
+
+
+def test_bad_notification_doesnt_stop_links(monkeypatch):
+  monkeypatch.setattr(persistent, '_CHECK_MS', 5)
+  changes = []
+  settings = types.SimpleNamespace(persistent_slots=2, persistent_rotate_ms=60000)
+  links = persistent.PersistentLinks(
+      settings, None, 'state', 'level', None, lambda addr, *state: changes.append((addr, state)), None)
+
+  for conn_handle, addr in enumerate((BAD, GOOD)):
+    link = persistent.Link(FakeConnection(conn_handle), b'\x00', b'\x00\x00')
+    link.handles = (10, 12)
+    links.links[addr] = link
+    links._by_conn[conn_handle] = link
+
+  async def run():
+    task = asyncio.ensure_future(links.run(lambda addr: False))
+    links._irq(18, (0, 10, b''))  # too short to decode
+    links._irq(18, (1, 12, (5000).to_bytes(2, 'little')))
+    links._irq(18, (1, 10, b'\x01'))
+    await asyncio.sleep(0.05)
+    assert changes == [(GOOD, (True, 50))]
+
+    links._irq(18, (1, 10, b'\x00'))  # and it's still running
+    await asyncio.sleep(0.05)
+    assert changes == [(GOOD, (True, 50)), (GOOD, (False, 50))]
+    task.cancel()
+
+  asyncio.run(run())
@@ -0,0 +1,99 @@
+import asyncio
+import types
+
+import bluetooth
+import pytest
+from aioble import core
+
+import registers
+
+
+ADDR = bytes([0x00, 0x0d, 0x6f, 0xcd, 0x94, 0xe1])
+REQUEST = bluetooth.UUID('request')
+RESPONSE = bluetooth.UUID('response')
+HANDLES = {REQUEST: (20, 0x08, 21), RESPONSE: (22, 0x10, 0x30)}
+CCCD = 23
+NAME = b'KITCHEN\x00\x00\x00\x00\x00'
+
+
+class FakeRadio:
+  """Answers each request write with answer(frame) => (write status, notification or None)."""
+
+  def __init__(self, client, answer):
+    self._client = client
+    self.answer = answer
+    self.requests = 0
+
+  def gattc_discover_descriptors(self, conn_handle, start, end):
+    self._client._irq(13, (conn_handle, CCCD, bluetooth.UUID(0x2902)))
+    self._client._irq(14, (conn_handle, 0))
+
+  def gattc_write(self, conn_handle, value_handle, data, mode):
+    if value_handle == CCCD:
+      self._client._irq(17, (conn_handle, value_handle, 0))
+      return
+    self.requests += 1
+    status, reply = self.answer(bytes(data))
+    self._client._irq(17, (conn_handle, value_handle, status))
+    if reply is not None:
+      self._client._irq(18, (conn_handle, HANDLES[RESPONSE][0], reply))
+
+
+def read_reply(frame):
+  return 0, bytes([255, 255, 6 + len(NAME), 255, frame[4], 0, 0, 0]) + NAME
+
+
+def setup(answer):
+  client = registers.RegisterClient(REQUEST, RESPONSE)
+  core.ble = FakeRadio(client, answer)
+  connection = types.SimpleNamespace(device=types.SimpleNamespace(addr=ADDR), _conn_handle=1)
+  return client, connection
+
+
+def test_read_is_cached():
+  client, connection = setup(read_reply)
+  assert client.cached(ADDR, registers.REGISTER_NAME) is None
+  client.queue_read(ADDR, registers.REGISTER_NAME, registers.NAME_LENGTH)
+
+  assert asyncio.run(client.run(connection, HANDLES)) == 1
+  assert not client.pending(ADDR)
+  assert client.cached(ADDR, registers.REGISTER_NAME) == NAME
+
+
+def test_silent_device_is_dropped(monkeypatch):
+  monkeypatch.setattr(registers, '_TIMEOUT_MS', 10)
+  client, connection = setup(lambda frame: (0, None))
+  client.queue_read(ADDR, registers.REGISTER_NAME, registers.NAME_LENGTH)
+
+  async def run():
+    for _ in range(registers._MAX_ATTEMPTS):
+      assert client.pending(ADDR)
+      with pytest.raises(asyncio.TimeoutError):
+        await client.run(connection, HANDLES)
+
+    # not retried again, and the miss is remembered so the name isn't queued again
+    assert not client.pending(ADDR)
+    assert client.cached(ADDR, registers.REGISTER_NAME) == b''
+    assert await client.run(connection, HANDLES) == 0
+    assert core.ble.requests == registers._MAX_ATTEMPTS
+
+  asyncio.run(run())
+
+
+def test_write_status_fails_without_waiting():
+  client, connection = setup(lambda frame: (3, None))  # nothing is notified, so a wait would time out
+  client.queue_read(ADDR, registers.REGISTER_NAME, registers.NAME_LENGTH)
+  client.queue_write(ADDR, 0x2000, b'\x01', 2)
+
+  async def run():
+    with pytest.raises(registers.RegisterError):
+      await client.run(connection, HANDLES)
+    assert client.pending(ADDR)
+
+    # a later success starts the count again
+    core.ble.answer = read_reply
+    assert await client.run(connection, HANDLES) == 2
+    assert client.cached(ADDR, registers.REGISTER_NAME) == NAME
+    assert client._failures == {}
+
+  asyncio.run(run())
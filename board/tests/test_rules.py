@@ -0,0 +1,37 @@
+import machine
+import rules
+
+
+def frame(op, *rest):
+  return bytes([rules.RULES_TYPE, op] + list(rest) + [0] * (8 - len(rest)))
+
+
+def test_32_rules_read_back(tmp_path):
+  r = rules.Rules(None, str(tmp_path / 'rules.bin'))
+  r.handle(frame(1))
+  r.handle(frame(2, 0, 0xaa, 0xbb, 0xcc, 0xdd, 0xee, 0x01))
+  for i in range(32):
+    # trigger, a, b, target, on, brightness, as server/rules.js compiles them
+    r.handle(frame(3, i, rules.TRIGGER_TIME, i % 24, i, 0, i % 2, i))
+  assert r.handle(frame(0)) == (32, 1)
+
+  assert len(r._rules) == 32 * rules._RULE_SIZE
+  for i in range(32):
+    base = i * rules._RULE_SIZE
+    assert bytes(r._rules[base:base + rules._RULE_SIZE]) == bytes([rules.TRIGGER_TIME, i % 24, i, 0, i % 2, i])
+
+  # and the same after loading what was saved
+  loaded = rules.Rules(None, str(tmp_path / 'rules.bin'))
+  assert loaded._count == 32
+  assert loaded._rules == r._rules
+
+
+def test_time_rules_wait_for_the_clock(tmp_path):
+  r = rules.Rules(None, str(tmp_path / 'rules.bin'))
+  r._check_time()
+  assert r._last_minute is None  # not evaluated yet
+
+  # 2026-10-20 00:30:15 local, at UTC+11 (as server/rules.js encodes it)
+  r.handle(bytes([rules.RULES_TYPE, 4]) + bytes.fromhex('326972970294') + bytes(2))
+  assert r.clock_set and r.utc_offset_min == 660
+  assert machine.RTC.now == (2026, 10, 20, 2, 0, 30, 15, 0)
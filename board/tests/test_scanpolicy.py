@@ -0,0 +1,91 @@
+import scanpolicy
+import settings
+
+
+LIGHT = b'\x01' * 6
+OTHER = b'\x02' * 6
+
+
+def policy(tmp_path, min_duty=1):
+  knobs = settings.Settings(str(tmp_path / 'settings.json'))
+  knobs.set(6, min_duty)  # scan_min_duty
+  return scanpolicy.ScanPolicy(knobs), knobs
+
+
+def passive_scan(scans, results, lights=(LIGHT,), busy=False):
+  """Runs a passive scan where each light is heard `results` times; returns the duty used."""
+  duration, interval, window, active = scans.next(busy)
+  assert not active
+  for addr in lights:
+    for _ in range(results):
+      scans.observe(addr)
+  scans.finish(duration)
+  return window * 100 // interval
+
+
+def test_discovers_until_lights_are_known(tmp_path):
+  scans, knobs = policy(tmp_path)
+  duration, interval, window, active = scans.next(False)
+  assert active and window == interval
+
+  scans.known.add(LIGHT)
+  duration, interval, window, active = scans.next(False)
+  assert not active
+  assert duration == knobs.scan_ms and window == interval  # full duty until there are results
+
+
+def test_unknown_target_forces_one_discovery(tmp_path):
+  scans, _ = policy(tmp_path)
+  scans.known.add(LIGHT)
+  scans.need_discovery(LIGHT)
+  assert not scans.next(False)[3]
+
+  scans.need_discovery(OTHER)
+  assert scans.next(False)[3]
+  assert not scans.next(False)[3]
+
+
+def test_discovers_now_and_then(tmp_path):
+  scans, _ = policy(tmp_path)
+  scans.known.add(LIGHT)
+  active = [scans.next(False)[3] for _ in range(2 * scanpolicy._DISCOVERY_EVERY)]
+  assert active.count(True) == 2
+  assert active[scanpolicy._DISCOVERY_EVERY - 1]
+
+
+def test_duty_follows_advertisement_rate(tmp_path):
+  scans, knobs = policy(tmp_path)
+  scans.known.add(LIGHT)
+  seconds = knobs.scan_ms // 1000
+
+  # 10 adverts/s heard at full duty: one per second is enough, so listen 10% of the time
+  assert passive_scan(scans, 10 * seconds) == 100
+  # at 10% we hear a tenth of them, which is still the same real rate
+  assert passive_scan(scans, seconds) == 10
+  assert passive_scan(scans, seconds) == 10
+
+  # the rate is per light, so more lights don't lower it further
+  assert passive_scan(scans, seconds, lights=(LIGHT, OTHER)) == 10
+
+  # lights slowing down raise it again
+  assert passive_scan(scans, seconds // 2) == 10
+  assert passive_scan(scans, seconds // 2) == 20
+
+
+def test_duty_limits(tmp_path):
+  scans, knobs = policy(tmp_path, min_duty=25)
+  scans.known.add(LIGHT)
+  seconds = knobs.scan_ms // 1000
+
+  # never below the minimum, however chatty the lights
+  assert passive_scan(scans, 100 * seconds) == 100
+  assert passive_scan(scans, 100 * seconds) == 25
+
+  # never above 100, however quiet
+  knobs.set(6, 1)
+  assert passive_scan(scans, 1) == 25
+  assert passive_scan(scans, 0) == 100  # nothing heard leaves the duty alone
+  assert passive_scan(scans, 1) == 100
+
+  # capped while commands wait for a connection
+  assert passive_scan(scans, 1, busy=True) == scanpolicy._BUSY_DUTY
@@ -0,0 +1,52 @@
+import json
+import struct
+
+import settings
+
+
+def frame(key, value):
+  return bytes([settings.SETTINGS_TYPE, key]) + struct.pack('>I', value) + bytes(4)
+
+
+def test_out_of_range_values_are_rejected(tmp_path):
+  knobs = settings.Settings(str(tmp_path / 'settings.json'))
+  assert not knobs.set(1, 9)             # delay_ms below 10
+  assert not knobs.set(10, 4)            # persistent_slots above 3
+  assert not knobs.set(99, 1)            # unknown key
+  assert knobs.set(1, 10) and knobs.set(10, 3)
+  assert knobs.delay_ms == 10 and knobs.persistent_slots == 3
+  assert knobs.take_changed() == {'delay_ms', 'persistent_slots'}
+
+
+def test_batch_is_saved_and_reloaded(tmp_path):
+  path = str(tmp_path / 'settings.json')
+  knobs = settings.Settings(path)
+  assert not knobs.handle(frame(2, 5000))
+  assert not knobs.handle(frame(2, 1))   # rejected, keeps 5000
+  assert not knobs.handle(frame(9, 0x0a000002))
+  assert knobs.handle(frame(0, 0))
+
+  again = settings.Settings(path)
+  assert again.backoff_ms == 5000 and again.server_ip_str() == '10.0.0.2'
+  assert again.changed == set()
+
+
+def test_bad_saved_values_fall_back_to_defaults(tmp_path):
+  path = tmp_path / 'settings.json'
+  path.write_text(json.dumps({'delay_ms': 1, 'scan_ms': 2000}))
+  knobs = settings.Settings(str(path))
+  assert knobs.delay_ms == knobs.default('delay_ms')
+  assert knobs.scan_ms == 2000
+
+  path.write_text('{not json')
+  assert settings.Settings(str(path)).scan_ms == knobs.default('scan_ms')
+
+
+def test_report_lists_every_value(tmp_path):
+  knobs = settings.Settings(str(tmp_path / 'settings.json'))
+  knobs.set(8, 8080)
+  report = knobs.report()
+  assert len(report) == len(settings._KNOBS) + 1
+  assert all(len(f) == 16 and f[6] == settings.SETTINGS_TYPE for f in report)
+  assert report[7][7:12] == bytes([8]) + struct.pack('>I', 8080)
+  assert report[-1][7] == 0
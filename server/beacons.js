@@ -1,49 +1,397 @@
 import * as net from 'net';
+import * as fs from 'fs';
+
+// @ts-ignore
+import JSON5 from 'json5';
 import { listenPromise } from './lib/server.js';
-import { updateViaBeacon } from './devices.js';
+import { applySnapshot, tracer, updateViaBeacon } from './devices.js';
+import { FrameParser } from './lib/frames.js';
+import { RULES_TYPE, encodeTime, loadRules } from './rules.js';
+import { SendQueue } from './lib/sendqueue.js';
+import { CLOCK_TYPE, ClockSync, TRACE_TYPE } from './lib/tracing.js';
 
 const PACKET_SIZE = 16;
+const SNAPSHOT_TYPE = 0x53;
+const SNAPSHOT_END = 0xff;
+const MONITOR_TYPE = 0x4d;
+const SECURITY_TYPE = 0x73;
+const SETTINGS_TYPE = 0x63;
+const SETTINGS_END = 0;
+const CLOCK_SYNC_MS = 10_000;
+
+/**
+ * Bridge settings and their keys on the wire, see board/settings.py. The bridge checks ranges and
+ * reports back what it actually uses.
+ *
+ * @type {{[name: string]: number}}
+ */
+const SETTINGS_KEYS = {
+  delayMs: 1,
+  backoffMs: 2,
+  commandExpiryMs: 3,
+  pairTimeoutMs: 4,
+  scanIntervalUs: 5,
+  scanMinDuty: 6,
+  scanMs: 7,
+  serverPort: 8,
+  serverIp: 9,  // dotted IPv4 here, 0 on the bridge means look up the hostname
+  persistentSlots: 10,
+  persistentRotateMs: 11,
+};
+
+/**
+ * Allowed values of each setting, as the bridge checks them (must match board/settings.py).
+ *
+ * @type {{[name: string]: [number, number]}}
+ */
+const SETTINGS_RANGES = {
+  delayMs: [10, 5000],
+  backoffMs: [100, 30000],
+  commandExpiryMs: [500, 60000],
+  pairTimeoutMs: [1000, 120_000],
+  scanIntervalUs: [2500, 10_240_000],
+  scanMinDuty: [1, 100],
+  scanMs: [1000, 60_000],
+  serverPort: [1, 65535],
+  serverIp: [0, 0xffffffff],
+  persistentSlots: [0, 3],
+  persistentRotateMs: [5000, 3_600_000],
+};
+
+/** @type {Map<number, string>} */
+const SETTINGS_NAMES = new Map(Object.entries(SETTINGS_KEYS).map(([name, key]) => [key, name]));
+
+// Optional, e.g. `{'*': {scanMinDuty: 30}, '192.168.1.20': {delayMs: 50}}`. Re-read on connect and
+// on SIGHUP, which also pushes it (and rules, see rules.js) to every connected bridge.
+const bridgesPath = process.env.BRIDGES_PATH ?? new URL('../bridges.json5', import.meta.url);
 
 /** @type {Set<net.Socket>} */
 const active = new Set();
 
 /**
- * @param {Buffer} payload
+ * Everything sent to each bridge, so a slow one can't make us buffer without limit.
+ *
+ * @type {Map<net.Socket, SendQueue>}
+ */
+const queueBySocket = new Map();
+
+/**
+ * @typedef {{
+ *   when: number,
+ *   lagMaxMs: number,
+ *   lagAvgMs: number,
+ *   memFreeKb: number,
+ *   fragmentation: number,
+ *   gcMaxMs: number,
+ *   autoCollections: number,
+ * }} BridgeMonitor
+ */
+
+/** @type {Map<net.Socket, BridgeMonitor>} */
+const monitorBySocket = new Map();
+
+/**
+ * @typedef {{
+ *   when: number,
+ *   fast: number,
+ *   fastAvgMs: number,
+ *   slow: number,
+ *   slowAvgMs: number,
+ *   fallbacks: number,
+ * }} BridgeSecurity
+ */
+
+/** @type {Map<net.Socket, BridgeSecurity>} */
+const securityBySocket = new Map();
+
+/** @typedef {{[name: string]: number|string}} BridgeSettings */
+
+/** @type {Map<net.Socket, BridgeSettings>} */
+const settingsBySocket = new Map();
+
+/** @type {Map<net.Socket, BridgeSettings>} */
+const partialSettingsBySocket = new Map();
+
+/**
+ * How each bridge's clock relates to ours, so stages it reports for traced commands line up.
+ *
+ * @type {Map<net.Socket, ClockSync>}
+ */
+const clockBySocket = new Map();
+
+
+/**
+ * @param {net.Socket} socket
+ * @return {string}
+ */
+function remoteName(socket) {
+  return `${socket.remoteAddress}:${socket.remotePort}`;
+}
+
+
+/**
+ * @return {{[remote: string]: BridgeMonitor}} latest telemetry from each connected bridge
+ */
+export function bridgeStats() {
+  /** @type {{[remote: string]: BridgeMonitor}} */
+  const out = {};
+  monitorBySocket.forEach((stats, socket) => {
+    out[remoteName(socket)] = stats;
+  });
+  return out;
+}
+
+
+/**
+ * @return {{[remote: string]: BridgeSecurity}} how each bridge has secured its connections
+ */
+export function bridgeSecurity() {
+  /** @type {{[remote: string]: BridgeSecurity}} */
+  const out = {};
+  securityBySocket.forEach((stats, socket) => {
+    out[remoteName(socket)] = stats;
+  });
+  return out;
+}
+
+
+/**
+ * @return {{[remote: string]: BridgeSettings}} effective settings last reported by each bridge
+ */
+export function bridgeSettings() {
+  /** @type {{[remote: string]: BridgeSettings}} */
+  const out = {};
+  settingsBySocket.forEach((settings, socket) => {
+    out[remoteName(socket)] = settings;
+  });
+  return out;
+}
+
+
+/**
+ * @param {net.Socket} socket
+ * @return {BridgeSettings} configured settings for this bridge, defaults under '*'
+ */
+function configuredSettings(socket) {
+  let store;
+  try {
+    store = JSON5.parse(fs.readFileSync(bridgesPath, 'utf-8'));
+  } catch (e) {
+    if (/** @type {NodeJS.ErrnoException} */ (e).code !== 'ENOENT') {
+      console.warn('could not read bridge settings', e);
+    }
+    return {};
+  }
+  const address = (socket.remoteAddress ?? '').replace(/^::ffff:/, '');
+  return {...store['*'], ...store[address]};
+}
+
+
+/**
+ * @param {BridgeSettings} settings
+ * @return {Buffer} frames setting each value, then the end of the batch
+ */
+export function encodeSettings(settings) {
+  /** @type {Buffer[]} */
+  const frames = [];
+
+  for (const name in settings) {
+    const key = SETTINGS_KEYS[name];
+    if (key === undefined) {
+      console.warn('unknown bridge setting', name);
+      continue;
+    }
+
+    let value = settings[name];
+    if (typeof value === 'string') {
+      const parts = value.split('.').map(Number);
+      if (parts.length !== 4 || parts.some((p) => !(p >= 0 && p <= 255))) {
+        console.warn('bad bridge setting', name, value);
+        continue;
+      }
+      value = parts.reduce((out, p) => out * 256 + p, 0);
+    }
+
+    const [min, max] = SETTINGS_RANGES[name];
+    if (typeof value !== 'number' || !Number.isInteger(value) || value < min || value > max) {
+      console.warn('bad bridge setting', name, value);
+      continue;
+    }
+
+    const frame = Buffer.alloc(PACKET_SIZE);
+    frame[6] = SETTINGS_TYPE;
+    frame[7] = key;
+    frame.writeUInt32BE(value, 8);
+    frames.push(frame);
+  }
+
+  const end = Buffer.alloc(PACKET_SIZE);
+  end[6] = SETTINGS_TYPE;
+  end[7] = SETTINGS_END;
+  frames.push(end);
+  return Buffer.concat(frames);
+}
+
+
+/**
+ * Sends configured settings to a bridge (if there are any).
+ *
+ * @param {net.Socket} socket
+ */
+function pushSettings(socket) {
+  const settings = configuredSettings(socket);
+  if (!Object.keys(settings).length) {
+    return;
+  }
+  console.warn('pushing settings to', remoteName(socket), settings);
+  queueBySocket.get(socket)?.pushBridge('settings', encodeSettings(settings));
+}
+
+
+/**
+ * Sends the time (for time rules), then the rules file (if there is one), which replaces the
+ * bridge's rules.
+ *
+ * @param {net.Socket} socket
+ */
+function pushRules(socket) {
+  const queue = queueBySocket.get(socket);
+  queue?.pushBridge('time', () => encodeTime());  // the time it's sent, not queued
+  const rules = loadRules();
+  if (rules) {
+    queue?.pushBridge('rules', rules);
+  }
+}
+
+
+/**
+ * @param {net.Socket} socket
+ * @param {Buffer} frame from a zero MAC, about the bridge itself
+ */
+function handleBridgeFrame(socket, frame) {
+  switch (frame[6]) {
+    case MONITOR_TYPE: {
+      /** @type {BridgeMonitor} */
+      const stats = {
+        when: Date.now(),
+        lagMaxMs: frame.readUInt16BE(7),
+        lagAvgMs: frame[9],
+        memFreeKb: frame.readUInt16BE(10),
+        fragmentation: frame[12],
+        gcMaxMs: frame.readUInt16BE(13),
+        autoCollections: frame[15],
+      };
+      monitorBySocket.set(socket, stats);
+      console.debug('bridge monitor', socket.remoteAddress, stats);
+      break;
+    }
+
+    case SETTINGS_TYPE: {
+      const partial = partialSettingsBySocket.get(socket) ?? {};
+      if (frame[7] !== SETTINGS_END) {
+        const name = SETTINGS_NAMES.get(frame[7]) ?? `key${frame[7]}`;
+        const value = frame.readUInt32BE(8);
+        partial[name] = name === 'serverIp' && value ? [...frame.subarray(8, 12)].join('.') : value;
+        partialSettingsBySocket.set(socket, partial);
+        break;
+      }
+      partialSettingsBySocket.delete(socket);
+      settingsBySocket.set(socket, partial);
+      console.info('bridge settings', socket.remoteAddress, partial);
+      break;
+    }
+
+    case SECURITY_TYPE: {
+      // Totals since the bridge started: fast is encryption from a stored bond, slow is pairing.
+      /** @type {BridgeSecurity} */
+      const stats = {
+        when: Date.now(),
+        fast: frame.readUInt16BE(7),
+        fastAvgMs: frame.readUInt16BE(9),
+        slow: frame.readUInt16BE(11),
+        slowAvgMs: frame.readUInt16BE(13),
+        fallbacks: frame[15],
+      };
+      securityBySocket.set(socket, stats);
+      console.debug('bridge security', socket.remoteAddress, stats);
+      break;
+    }
+
+    case RULES_TYPE:
+      console.info('bridge rules', socket.remoteAddress, 'rules', frame[8], 'lights', frame[9]);
+      break;
+
+    case CLOCK_TYPE:
+      clockBySocket.get(socket)?.reply(frame);
+      break;
+
+    case TRACE_TYPE:
+      tracer.bridgeStage(frame, remoteName(socket), clockBySocket.get(socket));
+      break;
+
+    default:
+      console.warn('got unknown bridge frame', frame);
+  }
+}
+
+/**
+ * @param {Buffer} payload 16-byte command frame
+ * @param {number} maxAgeMs drop it unsent after this, e.g. once nobody is waiting for it
  * @return {number}
  */
-export function broadcastAllBeacons(payload) {
+export function broadcastAllBeacons(payload, maxAgeMs = Infinity) {
   console.warn('broadcast payload', payload, 'to sockets', active.size);
 
-  active.forEach((socket) => {
-    socket.write(payload, (err) => {
-      if (err) {
-        console.warn('could not write payload', payload, err);
-      }
-    });
-  });
+  queueBySocket.forEach((queue) => queue.push(payload, maxAgeMs));
 
   return active.size;
 }
 
 
+/**
+ * @return {{[remote: string]: import('./lib/sendqueue.js').SendQueueStats}}
+ */
+export function sendQueueStats() {
+  /** @type {{[remote: string]: import('./lib/sendqueue.js').SendQueueStats}} */
+  const out = {};
+  queueBySocket.forEach((queue, socket) => {
+    out[remoteName(socket)] = queue.stats();
+  });
+  return out;
+}
+
+
+/**
+ * @param {number} port
+ * @return {Promise<net.Server>}
+ */
 export async function createBeaconServer(port = 9999) {
   const server = net.createServer((socket) => {
     active.add(socket);
-    let pending = Buffer.from([]);
-    console.warn('got new socket', socket.address(), 'from', socket.remoteAddress);
-
-    socket.on('data', (data) => {
-      while (data.length + pending.length >= PACKET_SIZE) {
-        const front = PACKET_SIZE - pending.length;
+    queueBySocket.set(socket, new SendQueue(socket, 64, (frame) => tracer.sent(frame, remoteName(socket))));
+    const clock = new ClockSync();
+    clockBySocket.set(socket, clock);
+    /** @type {Buffer[]} */
+    let snapshot = [];
 
-        const next = Buffer.concat([pending, data.slice(0, front)]);
-        updateViaBeacon(next);
-
-        data = data.subarray(front);
+    const parser = new FrameParser(PACKET_SIZE, (frame) => {
+      if (frame[6] !== SNAPSHOT_TYPE && !frame.readUIntBE(0, 6)) {
+        handleBridgeFrame(socket, frame);
+      } else if (frame[6] !== SNAPSHOT_TYPE) {
+        updateViaBeacon(frame);
+      } else if (frame[7] === SNAPSHOT_END && !frame.readUIntBE(0, 6)) {
+        applySnapshot(snapshot);
+        snapshot = [];
+      } else {
+        snapshot.push(Buffer.from(frame));  // frame is only a view
       }
-
-      pending = data;
     });
+    console.warn('got new socket', socket.address(), 'from', socket.remoteAddress);
+    pushSettings(socket);
+    pushRules(socket);
+    queueBySocket.get(socket)?.pushBridge('clock', () => clock.ping());
+
+    socket.on('data', (data) => parser.push(data));
 
     // We need this otherwise Node will throw and crash.
     socket.on('error', (err) => {
@@ -54,6 +402,12 @@ export async function createBeaconServer(port = 9999) {
     socket.on('close', (hadError) => {
       console.warn('socket closed', socket.address());
       active.delete(socket);
+      queueBySocket.delete(socket);
+      monitorBySocket.delete(socket);
+      securityBySocket.delete(socket);
+      settingsBySocket.delete(socket);
+      partialSettingsBySocket.delete(socket);
+      clockBySocket.delete(socket);
     });
   });
 
@@ -61,5 +415,21 @@ export async function createBeaconServer(port = 9999) {
     throw err;
   });
 
+  // Bridges answer these right away, and the quickest answers of the last few set the offset.
+  setInterval(() => {
+    clockBySocket.forEach((clock, socket) => {
+      queueBySocket.get(socket)?.pushBridge('clock', () => clock.ping());
+    });
+  }, CLOCK_SYNC_MS).unref();
+
+  process.on('SIGHUP', () => {
+    console.warn('reloading bridge settings and rules');
+    active.forEach((socket) => {
+      pushSettings(socket);
+      pushRules(socket);
+    });
+  });
+
   await listenPromise(server, port);
+  return server;
 }
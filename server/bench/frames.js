@@ -0,0 +1,115 @@
+#!/usr/bin/env node
+
+/**
+ * @fileoverview Microbenchmark of beacon frame parsing and device lookup. Compares the old
+ * concat-and-stringify approach with FrameParser and an integer MAC index.
+ *
+ * nb. The old approach didn't reset its pending tail between frames, so it misparses any chunk
+ * following a partial frame; its "matched" count shows how often.
+ *
+ * Usage: node server/bench/frames.js [devices=100] [frames=1000000]
+ */
+
+import {performance} from 'perf_hooks';
+import { FrameParser, macKey } from '../lib/frames.js';
+
+const PACKET_SIZE = 16;
+
+const deviceCount = +(process.argv[2] ?? 100);
+const frameCount = +(process.argv[3] ?? 1_000_000);
+
+
+// Build a stream of frames for random devices, then split it into uneven TCP-ish chunks.
+const macs = [];
+for (let i = 0; i < deviceCount; ++i) {
+  const mac = Buffer.from([0x00, 0x0d, 0x6f, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff]);
+  macs.push(mac);
+}
+
+const stream = Buffer.alloc(frameCount * PACKET_SIZE);
+for (let i = 0; i < frameCount; ++i) {
+  const at = i * PACKET_SIZE;
+  macs[i % deviceCount].copy(stream, at);
+  stream[at + 6] = 0x55;
+  stream[at + 7] = i & 1;
+  stream[at + 8] = i % 101;
+}
+
+/** @type {Buffer[]} */
+const chunks = [];
+for (let at = 0; at < stream.length;) {
+  const length = 1 + ~~(Math.random() * 1400);
+  chunks.push(stream.subarray(at, at + length));
+  at += length;
+}
+
+
+/** @type {{[mac: string]: number}} */
+const byString = {};
+/** @type {Map<number, number>} */
+const byKey = new Map();
+macs.forEach((mac, i) => {
+  const parts = [...mac].map((b) => b.toString(16).padStart(2, '0'));
+  byString[parts.join(':')] = i;
+  byKey.set(macKey(mac), i);
+});
+
+
+let found = 0;
+
+/**
+ * @param {Buffer} buffer
+ */
+function legacyUpdate(buffer) {
+  const macParts = [];
+  for (let i = 0; i < 6; ++i) {
+    macParts.push(buffer[i].toString(16).padStart(2, '0'));
+  }
+  const mac = macParts.join(':').toLowerCase();
+  if (byString[mac] !== undefined && buffer.slice(6)[0] === 0x55) {
+    ++found;
+  }
+}
+
+function legacy() {
+  let pending = Buffer.from([]);
+  for (let data of chunks) {
+    while (data.length + pending.length >= PACKET_SIZE) {
+      const front = PACKET_SIZE - pending.length;
+      const next = Buffer.concat([pending, data.slice(0, front)]);
+      legacyUpdate(next);
+      data = data.subarray(front);
+    }
+    pending = data;
+  }
+}
+
+function current() {
+  const parser = new FrameParser(PACKET_SIZE, (buffer) => {
+    if (byKey.get(macKey(buffer)) !== undefined && buffer.subarray(6)[0] === 0x55) {
+      ++found;
+    }
+  });
+  for (const data of chunks) {
+    parser.push(data);
+  }
+}
+
+
+/**
+ * @param {string} name
+ * @param {() => void} fn
+ */
+function run(name, fn) {
+  fn();  // warm up
+  found = 0;
+  const start = performance.now();
+  fn();
+  const duration = performance.now() - start;
+  const rate = frameCount / (duration / 1000);
+  console.info(name.padEnd(8), `${(rate / 1e6).toFixed(2)}M frames/sec`, `(${duration.toFixed(0)}ms)`,
+      `matched ${found}/${frameCount}`);
+}
+
+run('legacy', legacy);
+run('current', current);
@@ -8,10 +8,24 @@ import JSON5 from 'json5';
 import { ClipsalPower } from './types/clipsal.js';
 import { broadcastAllBeacons } from './beacons.js';
 import { DaikinAC } from './types/daikin.js';
-import { sleep } from '../lib/promise.js';
+import { TimerWheel } from './lib/timerwheel.js';
+import { macKey } from './lib/frames.js';
+import { HistoryStore } from './lib/history.js';
+import { Tracer } from './lib/tracing.js';
+import { fileURLToPath } from 'url';
 
 
-const devicesPath = new URL('../devices.json5', import.meta.url);
+// nb. DEVICES_PATH can point elsewhere, e.g. for load testing.
+const devicesPath = process.env.DEVICES_PATH ?? new URL('../devices.json5', import.meta.url);
+
+const CONFIRM_TYPE = 0x43;
+
+// State changes and command outcomes, for questions like "when was the loft light last on?".
+const historyPath = process.env.HISTORY_PATH ?? fileURLToPath(new URL('../history/', import.meta.url));
+export const history = new HistoryStore(historyPath);
+
+// Recent commands, timed stage by stage from the request to the light (see lib/tracing.js).
+export const tracer = new Tracer();
 
 
 /** @type {types.DevicesStore} */
@@ -21,6 +35,13 @@ console.warn('startup has', Object.keys(devicesStore).length, 'known:', devicesS
 /** @type {{[id: string]: Device}} */
 const models = {};
 
+/**
+ * Devices keyed by their raw 6-byte MAC as an integer, so beacon frames don't need a string.
+ *
+ * @type {Map<number, {mac: string, model: Device}>}
+ */
+const modelsByKey = new Map();
+
 for (const mac in devicesStore) {
   const data = devicesStore[mac];
   data.mac = mac;
@@ -32,12 +53,13 @@ for (const mac in devicesStore) {
   }
   /**
    * @param {Buffer} payload
+   * @param {number=} maxAgeMs
    */
-  const broadcast = (payload) => {
+  const broadcast = (payload, maxAgeMs) => {
     if (payload.length !== 10) {
       throw new Error(`got bad payload: ${payload}`);
     }
-    return broadcastAllBeacons(Buffer.concat([decodedMac, payload]));
+    return broadcastAllBeacons(Buffer.concat([decodedMac, payload]), maxAgeMs);
   };
 
   /** @type {Device} */
@@ -57,6 +79,7 @@ for (const mac in devicesStore) {
   }
 
   models[mac] = model;
+  modelsByKey.set(macKey(decodedMac), {mac, model});
 }
 
 
@@ -80,36 +103,127 @@ export function unsubscribeFromChanges(sub) {
 }
 
 
+/**
+ * @typedef {{callback: (state: types.DeviceState) => boolean, resolve: (state: types.DeviceState?) => void}} Waiter
+ */
+
+/**
+ * Waiters for changes to specific devices, kept apart from general subscribers so an update only
+ * looks at waiters for its own device.
+ *
+ * @type {Map<string, Set<Waiter>>}
+ */
+const waitersById = new Map();
+
+const waiterTimeouts = new TimerWheel(100);
+
+
+/**
+ * @param {string} id
+ * @param {Waiter} waiter
+ */
+function removeWaiter(id, waiter) {
+  const waiters = waitersById.get(id);
+  if (waiters) {
+    waiters.delete(waiter);
+    if (!waiters.size) {
+      waitersById.delete(id);
+    }
+  }
+}
+
+
 /**
  * @param {string} id
  * @param {(state: types.DeviceState) => boolean} callback return true to stop
  * @param {number} timeout
  * @return {Promise<types.DeviceState?>} if callback stopped us
  */
-export async function waitForChangesTo(id, callback, timeout) {
-
-  /** @type {(id: string, state: types.DeviceState, change: boolean) => void} */
-  let sub;
-
-  /** @type {Promise<types.DeviceState>} */
-  const updatePromise = new Promise((resolve) => {
-    sub = (updateId, state, change) => {
-      if (updateId !== id || !change) {
-        return;
-      }
-      if (callback(state)) {
+export function waitForChangesTo(id, callback, timeout) {
+  return new Promise((resolve) => {
+    /** @type {Waiter} */
+    const waiter = {
+      callback,
+      resolve: (state) => {
+        removeWaiter(id, waiter);
+        waiterTimeouts.cancel(timer);
         resolve(state);
-      }
+      },
     };
-    subscribeToChanges(sub);
+    const timer = waiterTimeouts.add(timeout, () => waiter.resolve(null));
+
+    let waiters = waitersById.get(id);
+    if (!waiters) {
+      waiters = new Set();
+      waitersById.set(id, waiters);
+    }
+    waiters.add(waiter);
   });
+}
 
-  const timeoutPromise = sleep(timeout);
-  const result = await Promise.race([updatePromise, timeoutPromise]);
-  // @ts-ignore
-  unsubscribeFromChanges(sub);
 
-  return result ?? null;
+/**
+ * Tells waiters and subscribers that a device's state has changed. Beacon updates call this
+ * automatically; devices that poll for state call it themselves.
+ *
+ * @param {string} id
+ * @param {types.DeviceState} state
+ */
+export function notifyChange(id, state) {
+  notifyWaiters(id, state);
+  history.recordState(id, state);
+
+  try {
+    changeSubscribers.forEach((sub) => sub(id, state, true));
+  } catch (e) {
+    console.warn('got err rebroadcasting state', e);
+  }
+}
+
+
+/**
+ * @param {string} id
+ * @param {types.DeviceState} state
+ */
+function notifyWaiters(id, state) {
+  const waiters = waitersById.get(id);
+  if (waiters) {
+    for (const waiter of waiters) {  // nb. deleting while iterating a Set is fine
+      try {
+        if (waiter.callback(state)) {
+          waiter.resolve(state);
+        }
+      } catch (e) {
+        console.warn('got err in waiter', e);
+      }
+    }
+  }
+}
+
+
+/**
+ * Applies a bridge's snapshot of all the lights it knows about (sent when it connects).
+ *
+ * @param {Buffer[]} buffers
+ */
+export function applySnapshot(buffers) {
+  /** @type {[string, types.DeviceState][]} */
+  const changes = [];
+
+  for (const buffer of buffers) {
+    const entry = modelsByKey.get(macKey(buffer));
+    if (!entry) {
+      console.warn(`got snapshot for unknown device:`, buffer.subarray(0, 6).toString('hex'));
+      continue;
+    }
+    const changeState = entry.model.updateViaBeacon(buffer.subarray(6));
+    if (changeState) {
+      changes.push([entry.mac, changeState]);
+    }
+  }
+
+  console.warn('snapshot of', buffers.length, 'devices had', changes.length, 'changes');
+  changes.forEach(([mac, changeState]) => notifyChange(mac, changeState));
 }
 
 
@@ -122,26 +236,21 @@ export function updateViaBeacon(buffer) {
     return;
   }
 
-  const macParts = [];
-  for (let i = 0; i < 6; ++i) {
-    macParts.push(buffer[i].toString(16).padStart(2, '0'));
-  }
-  const mac = macParts.join(':').toLowerCase();
-
-  const device = getByMac(mac);
-  if (!device) {
-    console.warn(`got beacon update for unknown device:`, mac);
+  const entry = modelsByKey.get(macKey(buffer));
+  if (!entry) {
+    console.warn(`got beacon update for unknown device:`, buffer.subarray(0, 6).toString('hex'));
     return;
   }
+  const {mac, model: device} = entry;
 
-  const changeState = device.updateViaBeacon(buffer.slice(6));
+  const changeState = device.updateViaBeacon(buffer.subarray(6));
   if (changeState) {
     console.warn('change', mac, changeState);
-    try {
-      changeSubscribers.forEach((sub) => sub(mac, changeState, true));
-    } catch (e) {
-      console.warn('got err rebroadcasting state', e);
-    }
+    notifyChange(mac, changeState);
+  } else if (buffer[6] === CONFIRM_TYPE && waitersById.has(mac)) {
+    // The bridge read this back after a write: it's what any exec is waiting for, even if the
+    // light was already in this state.
+    device.state().then((state) => notifyWaiters(mac, state));
   }
 }
 
@@ -5,9 +5,16 @@ import * as types from '../types/index.js';
 import { sleep } from '../lib/promise.js';
 import { WorkQueueObject } from './lib/queue.js';
 import { runTask } from './lib/task.js';
+import {performance} from 'perf_hooks';
 
 
-const HOMEGRAPH_AGGREGATE_MS = 250;
+// Changes are sent once no more have arrived for a while. The quiet period adapts to how fast
+// changes are arriving (so a storm of lights is one request), and is bounded overall.
+const HOMEGRAPH_AGGREGATE_MIN_MS = 50;
+const HOMEGRAPH_AGGREGATE_MAX_MS = 1000;
+const HOMEGRAPH_MAX_DEVICES = 50;
+const HOMEGRAPH_RETRY_MS = 250;
+const HOMEGRAPH_RETRY_MAX_MS = 30_000;
 
 
 const homegraphScope = 'https://www.googleapis.com/auth/homegraph';
@@ -34,31 +41,122 @@ try {
 /** @type {WorkQueueObject<types.DeviceState>} */
 const changedDevicesQueue = new WorkQueueObject();
 
+let lastChangeAt = -Infinity;
+let firstChangeAt = 0;
+let changeGapMs = HOMEGRAPH_AGGREGATE_MAX_MS;
+
+const stats = {
+  reports: 0,
+  failures: 0,
+  lastLatencyMs: 0,
+  lastRequestMs: 0,
+};
+
+
+/**
+ * @return {{queueDepth: number, aggregateMs: number, reports: number, failures: number, lastLatencyMs: number, lastRequestMs: number}}
+ */
+export function homegraphStats() {
+  return {queueDepth: changedDevicesQueue.size, aggregateMs: quietPeriod(), ...stats};
+}
+
+
+/**
+ * @param {string} id
+ * @param {types.DeviceState} state
+ */
+function addChange(id, state) {
+  const now = performance.now();
+  const gap = now - lastChangeAt;
+  lastChangeAt = now;
+
+  if (gap >= HOMEGRAPH_AGGREGATE_MAX_MS) {
+    changeGapMs = HOMEGRAPH_AGGREGATE_MAX_MS;  // isolated change
+  } else {
+    changeGapMs = changeGapMs * 0.7 + gap * 0.3;
+  }
+
+  if (!changedDevicesQueue.size) {
+    firstChangeAt = now;
+  }
+  changedDevicesQueue.add(id, state);
+}
+
+
+/**
+ * @return {number} how long to wait for quiet before sending
+ */
+function quietPeriod() {
+  if (changeGapMs >= HOMEGRAPH_AGGREGATE_MAX_MS) {
+    return HOMEGRAPH_AGGREGATE_MIN_MS;
+  }
+  return Math.max(HOMEGRAPH_AGGREGATE_MIN_MS, Math.min(HOMEGRAPH_AGGREGATE_MAX_MS, changeGapMs * 2));
+}
+
+
+/**
+ * @param {{[id: string]: types.DeviceState}} changedDevices
+ * @param {string} requestId
+ */
+async function report(changedDevices, requestId) {
+  /** @type {types.HomegraphNotificationRequest} */
+  const request = {
+    agentUserId: 'sam',
+    requestId,
+    payload: {devices: {states: changedDevices}},
+  };
+  console.warn('sending changed state to Google', changedDevices);
+
+  const req = await client.request({url: homegraphNotificationUrl, method: 'POST', body: JSON.stringify(request)});
+  if (req.status !== 200) {
+    throw new Error(`failed to update: ${req.status}`);
+  }
+}
 
 
 async function updateGoogleTask(success) {
   const requestSuffix = (Math.random() * 255).toString(16).substr(2);
   let requestId = 0;
+  let retries = 0;
 
   for (;;) {
     await changedDevicesQueue.wait();
-    await sleep(HOMEGRAPH_AGGREGATE_MS);
-
-    const changedDevices = changedDevicesQueue.retrieve();
-
-    /** @type {types.HomegraphNotificationRequest} */
-    const request = {
-      agentUserId: 'sam',
-      requestId: `${++requestId}_r${requestSuffix}`,
-      payload: {devices: {states: changedDevices}},
-    };
-    console.warn('sending changed state to Google', changedDevices);
-
-    const req = await client.request({url: homegraphNotificationUrl, method: 'POST', body: JSON.stringify(request)});
-    if (req.status !== 200) {
-      // TODO: this throws away pending changes
-      throw new Error(`failed to update: ${req.status}`);
+
+    const start = performance.now();
+    for (;;) {
+      const now = performance.now();
+      const remaining = Math.min(
+        quietPeriod() - (now - lastChangeAt),
+        HOMEGRAPH_AGGREGATE_MAX_MS - (now - start),
+      );
+      if (remaining <= 0) {
+        break;
+      }
+      await sleep(remaining);
+    }
+
+    const batchStartedAt = firstChangeAt;
+    const changedDevices = changedDevicesQueue.retrieve(HOMEGRAPH_MAX_DEVICES);
+    const requestStart = performance.now();
+
+    try {
+      await report(changedDevices, `${++requestId}_r${requestSuffix}`);
+    } catch (e) {
+      // Put these back (anything newer wins) and try again soon.
+      changedDevicesQueue.restore(changedDevices);
+      firstChangeAt = Math.min(firstChangeAt, batchStartedAt);
+      ++stats.failures;
+      const delay = Math.min(HOMEGRAPH_RETRY_MAX_MS, HOMEGRAPH_RETRY_MS * 2 ** retries++);
+      console.warn('failed to send state to Google, retry in', delay, e);
+      await sleep(delay);
+      continue;
     }
+
+    const now = performance.now();
+    retries = 0;
+    ++stats.reports;
+    stats.lastRequestMs = Math.round(now - requestStart);
+    stats.lastLatencyMs = Math.round(now - batchStartedAt);
     success();
   }
 }
@@ -67,10 +165,9 @@ async function updateGoogleTask(success) {
 if (client) {
   subscribeToChanges((id, state, change) => {
     if (change) {
-      changedDevicesQueue.add(id, state);
+      addChange(id, state);
     }
   });
 
   runTask('homegraph', updateGoogleTask);
 }
-
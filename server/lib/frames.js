@@ -0,0 +1,62 @@
+
+/**
+ * Splits a byte stream into fixed-size frames. Complete frames are passed to the callback as
+ * views into the incoming chunk (valid only for the duration of the call); only a partial tail
+ * is ever copied.
+ */
+export class FrameParser {
+  #size;
+  #onFrame;
+  #partial;
+  #partialLength = 0;
+
+  /**
+   * @param {number} size
+   * @param {(frame: Buffer) => void} onFrame
+   */
+  constructor(size, onFrame) {
+    this.#size = size;
+    this.#onFrame = onFrame;
+    this.#partial = Buffer.alloc(size);
+  }
+
+  /**
+   * @param {Buffer} data
+   */
+  push(data) {
+    const size = this.#size;
+    let offset = 0;
+
+    if (this.#partialLength) {
+      const need = size - this.#partialLength;
+      const copied = data.copy(this.#partial, this.#partialLength, 0, need);
+      this.#partialLength += copied;
+      offset = copied;
+      if (this.#partialLength < size) {
+        return;
+      }
+      this.#partialLength = 0;
+      this.#onFrame(this.#partial);
+    }
+
+    while (data.length - offset >= size) {
+      this.#onFrame(data.subarray(offset, offset + size));
+      offset += size;
+    }
+
+    if (offset < data.length) {
+      this.#partialLength = data.copy(this.#partial, 0, offset);
+    }
+  }
+}
+
+
+/**
+ * Returns the 6-byte MAC at offset as an integer, for use as a map key.
+ *
+ * @param {Buffer} buffer
+ * @param {number} offset
+ */
+export function macKey(buffer, offset = 0) {
+  return buffer.readUIntBE(offset, 6);
+}
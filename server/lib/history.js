@@ -0,0 +1,429 @@
+
+import * as fs from 'fs';
+import * as path from 'path';
+
+
+// Each record: when (f64 ms), device index (u16), kind (u8), flags (u8), on (u8), brightness (u8),
+// value (u16, e.g. command latency in ms). All little-endian.
+const RECORD_SIZE = 16;
+const INDEX_SIZE = 16;  // when (f64 ms), record number (u32), spare
+const INDEX_EVERY = 256;  // records
+const READ_CHUNK = 4096;  // records
+
+const FLUSH_MS = 1000;
+const FLUSH_RECORDS = 256;
+
+const KIND_STATE = 1;
+const KIND_COMMAND = 2;
+
+const FLAG_ONLINE = 1;
+const FLAG_OK = 2;
+
+const UNKNOWN = 0xff;
+
+
+/**
+ * @typedef {{
+ *   when: number,
+ *   device: string,
+ *   kind: 'state'|'command',
+ *   online?: boolean,
+ *   ok?: boolean,
+ *   on?: boolean,
+ *   brightness?: number,
+ *   latencyMs?: number,
+ * }} HistoryEntry
+ */
+
+
+/**
+ * @typedef {{
+ *   file: string,
+ *   start: number,
+ *   records: number,
+ *   indexTimes: number[],
+ *   indexRecords: number[],
+ * }} Segment
+ */
+
+
+/**
+ * Append-only log of device state changes and command outcomes, in fixed-size records.
+ *
+ * Records go to segment files named by their first timestamp, which rotate by size. Every
+ * INDEX_EVERY records an entry is added to the segment's time index, so a range query reads only
+ * from (roughly) where its range starts. Device IDs are stored once, in devices.json, and records
+ * refer to them by index.
+ */
+export class HistoryStore {
+  #dir;
+  #segmentBytes;
+  #maxSegments;
+
+  /** @type {string[]} */
+  #devices = [];
+
+  /** @type {Map<string, number>} */
+  #deviceIndex = new Map();
+
+  /** @type {Segment[]} */
+  #segments = [];
+
+  /** @type {number?} */
+  #fd = null;
+
+  /** @type {Buffer[]} */
+  #pending = [];
+
+  /** @type {NodeJS.Timeout?} */
+  #flushTimer = null;
+
+  /**
+   * @param {string} dir
+   * @param {{segmentBytes?: number, maxSegments?: number}} options
+   */
+  constructor(dir, {segmentBytes = 8 * 1024 * 1024, maxSegments = 64} = {}) {
+    this.#dir = dir;
+    this.#segmentBytes = segmentBytes;
+    this.#maxSegments = maxSegments;
+
+    fs.mkdirSync(dir, {recursive: true});
+    try {
+      this.#devices = JSON.parse(fs.readFileSync(path.join(dir, 'devices.json'), 'utf-8'));
+    } catch (e) {
+      if (/** @type {NodeJS.ErrnoException} */ (e).code !== 'ENOENT') {
+        throw e;
+      }
+    }
+    this.#devices.forEach((id, i) => this.#deviceIndex.set(id, i));
+
+    for (const file of fs.readdirSync(dir).filter((f) => /^seg-\d+\.log$/.test(f)).sort()) {
+      this.#segments.push(this.#loadSegment(file));
+    }
+  }
+
+  /**
+   * @param {string} file
+   * @return {Segment}
+   */
+  #loadSegment(file) {
+    const full = path.join(this.#dir, file);
+    const records = Math.floor(fs.statSync(full).size / RECORD_SIZE);
+
+    /** @type {Segment} */
+    const segment = {file, start: Number(file.slice(4, -4)), records, indexTimes: [], indexRecords: []};
+
+    let index = Buffer.alloc(0);
+    try {
+      index = fs.readFileSync(full.replace(/\.log$/, '.idx'));
+    } catch (e) {
+      // rebuilt below
+    }
+    for (let at = 0; at + INDEX_SIZE <= index.length; at += INDEX_SIZE) {
+      const record = index.readUInt32LE(at + 8);
+      if (record >= records) {
+        break;
+      }
+      segment.indexTimes.push(index.readDoubleLE(at));
+      segment.indexRecords.push(record);
+    }
+
+    // The index is written with the records, but a crash can leave it behind.
+    const fd = fs.openSync(full, 'r');
+    try {
+      const buf = Buffer.alloc(RECORD_SIZE);
+      let next = segment.indexRecords.length * INDEX_EVERY;
+      for (; next < records; next += INDEX_EVERY) {
+        fs.readSync(fd, buf, 0, RECORD_SIZE, next * RECORD_SIZE);
+        segment.indexTimes.push(buf.readDoubleLE(0));
+        segment.indexRecords.push(next);
+      }
+    } finally {
+      fs.closeSync(fd);
+    }
+    return segment;
+  }
+
+  /**
+   * @param {string} id
+   * @return {number}
+   */
+  #indexFor(id) {
+    let index = this.#deviceIndex.get(id);
+    if (index === undefined) {
+      index = this.#devices.length;
+      this.#devices.push(id);
+      this.#deviceIndex.set(id, index);
+      fs.writeFileSync(path.join(this.#dir, 'devices.json'), JSON.stringify(this.#devices));
+    }
+    return index;
+  }
+
+  /**
+   * @param {string} id
+   * @param {{online: boolean, on?: boolean, brightness?: number}} state
+   * @param {number} when
+   */
+  recordState(id, state, when = Date.now()) {
+    const flags = state.online ? FLAG_ONLINE : 0;
+    this.#append(when, this.#indexFor(id), KIND_STATE, flags, state.on, state.brightness, 0);
+  }
+
+  /**
+   * @param {string} id
+   * @param {boolean} ok if the device confirmed the command
+   * @param {number} latencyMs
+   * @param {number} when
+   */
+  recordCommand(id, ok, latencyMs, when = Date.now()) {
+    const flags = FLAG_ONLINE | (ok ? FLAG_OK : 0);
+    this.#append(when, this.#indexFor(id), KIND_COMMAND, flags, undefined, undefined, latencyMs);
+  }
+
+  /**
+   * @param {number} when
+   * @param {number} device
+   * @param {number} kind
+   * @param {number} flags
+   * @param {boolean=} on
+   * @param {number=} brightness
+   * @param {number} value
+   */
+  #append(when, device, kind, flags, on, brightness, value) {
+    const record = Buffer.alloc(RECORD_SIZE);
+    record.writeDoubleLE(when, 0);
+    record.writeUInt16LE(device, 8);
+    record[10] = kind;
+    record[11] = flags;
+    record[12] = on === undefined ? UNKNOWN : Number(on);
+    record[13] = brightness === undefined ? UNKNOWN : Math.max(0, Math.min(100, Math.round(brightness)));
+    record.writeUInt16LE(Math.max(0, Math.min(0xffff, Math.round(value))), 14);
+    this.#pending.push(record);
+
+    if (this.#pending.length >= FLUSH_RECORDS) {
+      this.flush();
+    } else if (!this.#flushTimer) {
+      this.#flushTimer = setTimeout(() => this.flush(), FLUSH_MS);
+      this.#flushTimer.unref();
+    }
+  }
+
+  /**
+   * Writes pending records (and their index entries) to disk.
+   */
+  flush() {
+    if (this.#flushTimer) {
+      clearTimeout(this.#flushTimer);
+      this.#flushTimer = null;
+    }
+
+    for (const record of this.#pending) {
+      let segment = this.#segments[this.#segments.length - 1];
+      if (!segment || this.#fd === null || (segment.records + 1) * RECORD_SIZE > this.#segmentBytes) {
+        segment = this.#rotate(segment, record.readDoubleLE(0));
+      }
+
+      fs.writeSync(/** @type {number} */ (this.#fd), record);
+      if (segment.records % INDEX_EVERY === 0) {
+        const entry = Buffer.alloc(INDEX_SIZE);
+        entry.writeDoubleLE(record.readDoubleLE(0), 0);
+        entry.writeUInt32LE(segment.records, 8);
+        fs.appendFileSync(path.join(this.#dir, segment.file.replace(/\.log$/, '.idx')), entry);
+        segment.indexTimes.push(record.readDoubleLE(0));
+        segment.indexRecords.push(segment.records);
+      }
+      ++segment.records;
+    }
+    this.#pending = [];
+  }
+
+  /**
+   * @param {Segment|undefined} current
+   * @param {number} when
+   * @return {Segment}
+   */
+  #rotate(current, when) {
+    if (this.#fd !== null) {
+      fs.closeSync(this.#fd);
+      this.#fd = null;
+    }
+
+    // Continue the last segment after a restart, unless it's full.
+    if (!current || (current.records + 1) * RECORD_SIZE > this.#segmentBytes) {
+      const start = Math.max(Math.floor(when), current ? current.start + 1 : 0);
+      const file = `seg-${String(start).padStart(15, '0')}.log`;
+      current = {file, start, records: 0, indexTimes: [], indexRecords: []};
+      this.#segments.push(current);
+
+      while (this.#segments.length > this.#maxSegments) {
+        const old = /** @type {Segment} */ (this.#segments.shift());
+        fs.rmSync(path.join(this.#dir, old.file), {force: true});
+        fs.rmSync(path.join(this.#dir, old.file.replace(/\.log$/, '.idx')), {force: true});
+      }
+    }
+
+    const file = path.join(this.#dir, current.file);
+    if (fs.existsSync(file)) {
+      fs.truncateSync(file, current.records * RECORD_SIZE);  // drop a record cut off by a crash
+    }
+    this.#fd = fs.openSync(file, 'a');
+    return current;
+  }
+
+  /**
+   * @param {Buffer} buf
+   * @param {number} at
+   * @return {HistoryEntry}
+   */
+  #decode(buf, at) {
+    const kind = buf[at + 10];
+    const flags = buf[at + 11];
+    /** @type {HistoryEntry} */
+    const entry = {
+      when: buf.readDoubleLE(at),
+      device: this.#devices[buf.readUInt16LE(at + 8)],
+      kind: kind === KIND_COMMAND ? 'command' : 'state',
+    };
+    if (kind === KIND_COMMAND) {
+      entry.ok = Boolean(flags & FLAG_OK);
+      entry.latencyMs = buf.readUInt16LE(at + 14);
+    } else {
+      entry.online = Boolean(flags & FLAG_ONLINE);
+      if (buf[at + 12] !== UNKNOWN) {
+        entry.on = Boolean(buf[at + 12]);
+      }
+      if (buf[at + 13] !== UNKNOWN) {
+        entry.brightness = buf[at + 13];
+      }
+    }
+    return entry;
+  }
+
+  /**
+   * Reads records [first, end) of a segment in chunks, oldest first or newest first. Reads are
+   * async, so other work (beacon sockets, fulfillment) runs between chunks.
+   *
+   * @param {Segment} segment
+   * @param {number} first
+   * @param {boolean} reverse
+   * @return {AsyncGenerator<[Buffer, number], void, void>} buffer and offset of each record
+   */
+  async *#records(segment, first, reverse = false) {
+    /** @type {number[]} */
+    const chunks = [];
+    for (let chunk = first; chunk < segment.records; chunk += READ_CHUNK) {
+      chunks.push(chunk);
+    }
+    if (reverse) {
+      chunks.reverse();
+    }
+
+    let handle;
+    try {
+      handle = await fs.promises.open(path.join(this.#dir, segment.file), 'r');
+    } catch (e) {
+      if (/** @type {NodeJS.ErrnoException} */ (e).code === 'ENOENT') {
+        return;  // rotated away while we read others
+      }
+      throw e;
+    }
+
+    try {
+      const buf = Buffer.alloc(READ_CHUNK * RECORD_SIZE);
+      for (const chunk of chunks) {
+        const count = Math.min(READ_CHUNK, segment.records - chunk);
+        await handle.read(buf, 0, count * RECORD_SIZE, chunk * RECORD_SIZE);
+        for (let i = 0; i < count; ++i) {
+          yield [buf, (reverse ? count - 1 - i : i) * RECORD_SIZE];
+        }
+      }
+    } finally {
+      await handle.close();
+    }
+  }
+
+  /**
+   * @param {string?} id or null for every device
+   * @param {number} from ms, inclusive
+   * @param {number} to ms, inclusive
+   * @param {number} limit
+   * @return {Promise<HistoryEntry[]>} oldest first
+   */
+  async query(id, from = 0, to = Infinity, limit = 10_000) {
+    this.flush();
+
+    const device = id === null ? null : this.#deviceIndex.get(id);
+    if (device === undefined) {
+      return [];
+    }
+
+    /** @type {HistoryEntry[]} */
+    const out = [];
+    const segments = this.#segments.slice();  // appends may rotate while we read
+    for (let s = 0; s < segments.length; ++s) {
+      const segment = segments[s];
+      const next = segments[s + 1];
+      if (segment.start > to || (next && next.start <= from)) {
+        continue;
+      }
+
+      // Start from the last index entry at or before from.
+      let first = 0;
+      let lo = 0;
+      let hi = segment.indexTimes.length - 1;
+      while (lo <= hi) {
+        const mid = (lo + hi) >> 1;
+        if (segment.indexTimes[mid] <= from) {
+          first = segment.indexRecords[mid];
+          lo = mid + 1;
+        } else {
+          hi = mid - 1;
+        }
+      }
+
+      for await (const [buf, at] of this.#records(segment, first)) {
+        const when = buf.readDoubleLE(at);
+        if (when > to) {
+          return out;
+        }
+        if (when < from || (device !== null && buf.readUInt16LE(at + 8) !== device)) {
+          continue;
+        }
+        out.push(this.#decode(buf, at));
+        if (out.length >= limit) {
+          return out;
+        }
+      }
+    }
+    return out;
+  }
+
+  /**
+   * Finds the newest entry for a device that matches, e.g. when a light was last on.
+   *
+   * @param {string} id
+   * @param {(entry: HistoryEntry) => boolean} match
+   * @return {Promise<HistoryEntry?>}
+   */
+  async last(id, match) {
+    this.flush();
+
+    const device = this.#deviceIndex.get(id);
+    if (device === undefined) {
+      return null;
+    }
+
+    for (const segment of this.#segments.slice().reverse()) {
+      for await (const [buf, at] of this.#records(segment, 0, true)) {
+        if (buf.readUInt16LE(at + 8) !== device) {
+          continue;
+        }
+        const entry = this.#decode(buf, at);
+        if (match(entry)) {
+          return entry;
+        }
+      }
+    }
+    return null;
+  }
+}
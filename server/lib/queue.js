@@ -81,9 +81,42 @@ export class WorkQueueObject {
   }
 
   /**
+   * @return {number}
+   */
+  get size() {
+    return Object.keys(this.#data).length;
+  }
+
+  /**
+   * Puts back entries that couldn't be delivered. Anything added since they were retrieved is
+   * newer, so it wins.
+   *
+   * @param {{[id: string]: T}} data
+   */
+  restore(data) {
+    for (const id in data) {
+      if (!(id in this.#data)) {
+        this.add(id, data[id]);
+      }
+    }
+  }
+
+  /**
+   * @param {number} limit return at most this many entries, leaving the rest queued
    * @return {{[id: string]: T}}
    */
-  retrieve() {
+  retrieve(limit = Infinity) {
+    const keys = Object.keys(this.#data);
+    if (keys.length > limit) {
+      /** @type {{[id: string]: T}} */
+      const local = {};
+      for (const id of keys.slice(0, limit)) {
+        local[id] = this.#data[id];
+        delete this.#data[id];
+      }
+      return local;  // still non-empty, so wait() stays resolved
+    }
+
     this.#queue.retrieve();
     const local = this.#data;
     this.#data = {};
@@ -0,0 +1,143 @@
+
+import * as net from 'net';
+import {performance} from 'perf_hooks';
+import { macKey } from './frames.js';
+
+
+/**
+ * @typedef {{
+ *   depth: number,
+ *   blocked: boolean,
+ *   sent: number,
+ *   replaced: number,
+ *   expired: number,
+ *   overflowed: number,
+ * }} SendQueueStats
+ */
+
+
+/**
+ * Bounded outbound queue of 16-byte command frames for one bridge.
+ *
+ * Frames are written only while the socket accepts them; after `write()` returns false, the rest
+ * wait for 'drain'. While waiting, a newer frame for a MAC replaces the queued one (in its place),
+ * frames older than their max age are dropped unsent, and when full the oldest command is dropped.
+ *
+ * Messages to the bridge itself (settings, rules, clock pings) go through the same queue, keyed
+ * by kind rather than MAC, so they're bounded the same way. They aren't dropped for space.
+ */
+export class SendQueue {
+  #socket;
+  #max;
+  #blocked = false;
+  #onSent;
+
+  /**
+   * Commands by MAC, and bridge messages by kind. A message can be made as it's written.
+   *
+   * @type {Map<number|string, {frame: Buffer|(() => Buffer), expiresAt: number}>}
+   */
+  #pending = new Map();
+
+  sent = 0;
+  replaced = 0;
+  expired = 0;
+  overflowed = 0;
+
+  /**
+   * @param {net.Socket} socket
+   * @param {number} max frames queued
+   * @param {(frame: Buffer) => void} onSent called as each command frame is written
+   */
+  constructor(socket, max = 64, onSent = () => {}) {
+    this.#socket = socket;
+    this.#max = max;
+    this.#onSent = onSent;
+  }
+
+  /**
+   * @param {Buffer} frame
+   * @param {number} maxAgeMs after which it's not worth sending
+   */
+  push(frame, maxAgeMs = Infinity) {
+    const key = macKey(frame);
+    if (this.#pending.has(key)) {
+      ++this.replaced;
+    } else if (this.#pending.size >= this.#max) {
+      for (const oldest of this.#pending.keys()) {
+        if (typeof oldest === 'number') {
+          this.#pending.delete(oldest);
+          ++this.overflowed;
+          break;
+        }
+      }
+    }
+    this.#pending.set(key, {frame, expiresAt: performance.now() + maxAgeMs});
+
+    this.flush();
+  }
+
+  /**
+   * Queues a message to the bridge itself, replacing any of the same kind not yet written.
+   *
+   * @param {string} kind
+   * @param {Buffer|(() => Buffer)} frames one or more, or a function making them as they're
+   *     written (e.g. a clock ping, which carries the time it's sent)
+   */
+  pushBridge(kind, frames) {
+    if (this.#pending.has(kind)) {
+      ++this.replaced;
+    }
+    this.#pending.set(kind, {frame: frames, expiresAt: Infinity});
+
+    this.flush();
+  }
+
+  flush() {
+    if (this.#blocked || this.#socket.destroyed) {
+      return;
+    }
+
+    const now = performance.now();
+    for (const [key, {frame, expiresAt}] of this.#pending) {
+      this.#pending.delete(key);
+      if (now > expiresAt) {
+        ++this.expired;
+        continue;
+      }
+
+      ++this.sent;
+      let accepted;
+      if (typeof frame === 'function') {
+        accepted = this.#socket.write(frame());
+      } else {
+        accepted = this.#socket.write(frame);
+        if (typeof key === 'number') {
+          this.#onSent(frame);
+        }
+      }
+      if (!accepted) {
+        this.#blocked = true;
+        this.#socket.once('drain', () => {
+          this.#blocked = false;
+          this.flush();
+        });
+        return;
+      }
+    }
+  }
+
+  /**
+   * @return {SendQueueStats}
+   */
+  stats() {
+    return {
+      depth: this.#pending.size,
+      blocked: this.#blocked,
+      sent: this.sent,
+      replaced: this.replaced,
+      expired: this.expired,
+      overflowed: this.overflowed,
+    };
+  }
+}
@@ -0,0 +1,101 @@
+
+import {performance} from 'perf_hooks';
+
+/** @typedef {{fn: () => void, rounds: number, slot: number}} Timer */
+
+
+/**
+ * A hashed timer wheel: many timeouts share one Node timer, which only runs while there are
+ * timeouts pending. Timeouts never fire early, and fire up to one tick late.
+ */
+export class TimerWheel {
+  #tickMs;
+
+  /** @type {Set<Timer>[]} */
+  #slots = [];
+  #current = 0;
+  #count = 0;
+  #lastTick = 0;
+
+  /** @type {NodeJS.Timeout?} */
+  #timer = null;
+
+  /**
+   * @param {number} tickMs
+   * @param {number} slotCount
+   */
+  constructor(tickMs = 100, slotCount = 64) {
+    this.#tickMs = tickMs;
+    for (let i = 0; i < slotCount; ++i) {
+      this.#slots.push(new Set());
+    }
+  }
+
+  get size() {
+    return this.#count;
+  }
+
+  /**
+   * @param {number} ms
+   * @param {() => void} fn
+   * @return {Timer} pass to cancel()
+   */
+  add(ms, fn) {
+    if (this.#timer === null) {
+      this.#lastTick = performance.now();
+      this.#timer = setInterval(this.#tick, this.#tickMs);
+      this.#timer.unref();
+    }
+
+    // Count from the last tick, as the next comes less than a tick from now.
+    const sinceTick = performance.now() - this.#lastTick;
+    const ticks = Math.max(1, Math.ceil((ms + sinceTick) / this.#tickMs));
+    const slotCount = this.#slots.length;
+    const slot = (this.#current + ticks) % slotCount;
+
+    /** @type {Timer} */
+    const timer = {fn, rounds: Math.floor((ticks - 1) / slotCount), slot};
+    this.#slots[slot].add(timer);
+    ++this.#count;
+    return timer;
+  }
+
+  /**
+   * @param {Timer} timer
+   */
+  cancel(timer) {
+    if (this.#slots[timer.slot].delete(timer)) {
+      --this.#count;
+      this.#maybeStop();
+    }
+  }
+
+  #maybeStop = () => {
+    if (this.#count === 0 && this.#timer !== null) {
+      clearInterval(this.#timer);
+      this.#timer = null;
+    }
+  };
+
+  #tick = () => {
+    this.#lastTick = performance.now();
+    this.#current = (this.#current + 1) % this.#slots.length;
+    const slot = this.#slots[this.#current];
+
+    for (const timer of slot) {
+      if (timer.rounds > 0) {
+        --timer.rounds;
+        continue;
+      }
+      slot.delete(timer);
+      --this.#count;
+      try {
+        timer.fn();
+      } catch (e) {
+        console.warn('timer threw', e);
+      }
+    }
+
+    this.#maybeStop();
+  };
+}
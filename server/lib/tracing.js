@@ -0,0 +1,308 @@
+
+import {performance} from 'perf_hooks';
+
+const PACKET_SIZE = 16;
+export const CLOCK_TYPE = 0x74;
+export const TRACE_TYPE = 0x54;
+
+// Bridge timestamps are MicroPython ticks_ms, which wrap here.
+const TICKS_PERIOD = 2 ** 30;
+const CLOCK_SAMPLES = 8;
+
+// Must match board/bridgecore.py.
+const BRIDGE_STAGES = ['', 'received', 'dequeued', 'connected', 'paired', 'written', 'confirmed', 'done'];
+
+/**
+ * Names of the span ending at each stage, as shown in a flame chart.
+ *
+ * @type {{[stage: string]: string}}
+ */
+const SPAN_NAMES = {
+  exec: 'smarthome',
+  sent: 'send queue',
+  received: 'network',
+  dequeued: 'bridge queue',
+  connected: 'connect',
+  paired: 'pair',
+  written: 'write',
+  confirmed: 'read back',
+  done: 'finish',
+  changed: 'report',
+  end: 'respond',
+};
+
+
+/**
+ * @typedef {{
+ *   stage: string,
+ *   at: number,
+ *   bridge?: string,
+ *   attempt?: number,
+ *   ok?: boolean,
+ * }} TraceEvent
+ */
+
+/**
+ * @typedef {{
+ *   id: number,
+ *   mac: string,
+ *   events: TraceEvent[],
+ *   ok?: boolean,
+ * }} CommandTrace
+ */
+
+/**
+ * @typedef {{
+ *   name: string,
+ *   stage: string,
+ *   start: number,
+ *   ms: number,
+ *   attempt?: number,
+ *   ok?: boolean,
+ * }} Span
+ */
+
+/**
+ * @typedef {{
+ *   id: number,
+ *   mac: string,
+ *   ok?: boolean,
+ *   bridge?: string,
+ *   start: number,
+ *   ms: number,
+ *   spans: Span[],
+ * }} CommandSpans
+ */
+
+
+/**
+ * Estimates the offset between a bridge's clock and ours, from pings it echoes with its own time
+ * (like NTP). The sample with the lowest round trip of the last few is used, as it has the least
+ * room for error: bridge times are good to about half of it.
+ */
+export class ClockSync {
+  /** @type {{rttMs: number, bridgeAt: number, serverAt: number}[]} */
+  #samples = [];
+
+  /**
+   * @return {Buffer} frame asking the bridge for its time
+   */
+  ping() {
+    const frame = Buffer.alloc(PACKET_SIZE);
+    frame[6] = CLOCK_TYPE;
+    frame.writeUInt32BE(Math.floor(performance.now()) >>> 0, 8);
+    return frame;
+  }
+
+  /**
+   * @param {Buffer} frame the bridge's reply, with our time echoed and its own
+   */
+  reply(frame) {
+    const now = performance.now();
+    const rttMs = (Math.floor(now) - frame.readUInt32BE(8)) >>> 0;
+    this.#samples.push({rttMs, bridgeAt: frame.readUInt32BE(12), serverAt: now - rttMs / 2});
+    if (this.#samples.length > CLOCK_SAMPLES) {
+      this.#samples.shift();
+    }
+  }
+
+  #best() {
+    let best = null;
+    for (const sample of this.#samples) {
+      if (!best || sample.rttMs < best.rttMs) {
+        best = sample;
+      }
+    }
+    return best;
+  }
+
+  /**
+   * @param {number} ticks bridge time
+   * @return {number?} our time (as performance.now()), or null before the first reply
+   */
+  toServer(ticks) {
+    const best = this.#best();
+    if (!best) {
+      return null;
+    }
+    let delta = (ticks - best.bridgeAt) & (TICKS_PERIOD - 1);
+    if (delta >= TICKS_PERIOD / 2) {
+      delta -= TICKS_PERIOD;
+    }
+    return best.serverAt + delta;
+  }
+
+  /**
+   * @return {{rttMs: number, samples: number}?}
+   */
+  stats() {
+    const best = this.#best();
+    return best && {rttMs: best.rttMs, samples: this.#samples.length};
+  }
+}
+
+
+/**
+ * Per-command traces. The server marks its own stages, and bridges report theirs (in their own
+ * time, converted with a ClockSync) in frames tagged with the trace ID sent with the command.
+ * The most recent traces are kept, and can be exported for chrome://tracing or Perfetto.
+ */
+export class Tracer {
+  #nextId = 1;
+  #max;
+
+  /** @type {Map<number, CommandTrace>} */
+  #traces = new Map();
+
+  /**
+   * @param {number} max traces kept
+   */
+  constructor(max = 256) {
+    this.#max = max;
+  }
+
+  /**
+   * @param {string} mac
+   * @param {number=} since when the request arrived, if before now
+   * @return {CommandTrace} with a 16-bit ID (never zero, which means untraced)
+   */
+  begin(mac, since) {
+    const id = this.#nextId;
+    this.#nextId = (id % 0xffff) + 1;
+
+    /** @type {CommandTrace} */
+    const trace = {id, mac, events: []};
+    if (since !== undefined) {
+      trace.events.push({stage: 'request', at: since});
+    }
+    trace.events.push({stage: 'exec', at: performance.now()});
+
+    this.#traces.delete(id);
+    this.#traces.set(id, trace);
+    if (this.#traces.size > this.#max) {
+      const oldest = this.#traces.keys().next().value;
+      this.#traces.delete(/** @type {number} */ (oldest));
+    }
+    return trace;
+  }
+
+  /**
+   * @param {CommandTrace} trace
+   * @param {string} stage
+   */
+  mark(trace, stage) {
+    trace.events.push({stage, at: performance.now()});
+  }
+
+  /**
+   * @param {CommandTrace} trace
+   * @param {boolean} ok
+   */
+  end(trace, ok) {
+    trace.ok = ok;
+    trace.events.push({stage: 'end', at: performance.now()});
+  }
+
+  /**
+   * @param {Buffer} frame command frame, as written to a bridge
+   * @param {string} bridge
+   */
+  sent(frame, bridge) {
+    const trace = this.#traces.get(frame.readUInt16BE(9));
+    trace?.events.push({stage: 'sent', at: performance.now(), bridge});
+  }
+
+  /**
+   * @param {Buffer} frame from a zero MAC: [TRACE_TYPE, stage, id (2), ticks (4), attempt, ok]
+   * @param {string} bridge
+   * @param {ClockSync|undefined} clock for that bridge
+   */
+  bridgeStage(frame, bridge, clock) {
+    const trace = this.#traces.get(frame.readUInt16BE(8));
+    const at = clock?.toServer(frame.readUInt32BE(10));
+    const stage = BRIDGE_STAGES[frame[7]];
+    if (!trace || at == null || !stage) {
+      return;  // expired, before the clock is known, or newer than us
+    }
+    trace.events.push({stage, at, bridge, attempt: frame[14], ok: Boolean(frame[15])});
+  }
+
+  /**
+   * Assembles each kept trace into spans: one per bridge that took part (or one, if none did),
+   * each stage's span running from the stage before it.
+   *
+   * @return {CommandSpans[]}
+   */
+  spans() {
+    /** @type {CommandSpans[]} */
+    const out = [];
+
+    for (const trace of this.#traces.values()) {
+      const bridges = [...new Set(trace.events.map((e) => e.bridge).filter(Boolean))];
+
+      for (const bridge of bridges.length ? bridges : [undefined]) {
+        const events = trace.events
+            .filter((e) => !e.bridge || e.bridge === bridge)
+            .sort((a, b) => a.at - b.at);
+
+        /** @type {Span[]} */
+        const spans = [];
+        for (let i = 1; i < events.length; ++i) {
+          const {stage, at, attempt, ok} = events[i];
+          const prev = events[i - 1];
+          let name = SPAN_NAMES[stage] ?? stage;
+          if (stage === 'dequeued' && attempt && attempt > 1) {
+            name = 'retry';
+          } else if (stage === 'changed' && prev.stage === 'written') {
+            name = 'advertisement';  // read back failed, so this waited for the light to advertise
+          }
+          spans.push({name, stage, start: prev.at, ms: at - prev.at, attempt, ok});
+        }
+
+        const start = events[0].at;
+        out.push({
+          id: trace.id,
+          mac: trace.mac,
+          ok: trace.ok,
+          bridge,
+          start,
+          ms: events[events.length - 1].at - start,
+          spans,
+        });
+      }
+    }
+    return out;
+  }
+
+  /**
+   * Returns the kept traces as Chrome trace events (for chrome://tracing or Perfetto): a thread
+   * per command and bridge, with a span for the command and one for each stage within it.
+   *
+   * @return {{traceEvents: object[], displayTimeUnit: string}}
+   */
+  export() {
+    const us = (/** @type {number} */ ms) => Math.round((performance.timeOrigin + ms) * 1000);
+
+    /** @type {object[]} */
+    const traceEvents = [{name: 'process_name', ph: 'M', pid: 1, tid: 0, args: {name: 'commands'}}];
+    this.spans().forEach((command, i) => {
+      const tid = i + 1;
+      const label = `#${command.id} ${command.mac}` + (command.bridge ? ` via ${command.bridge}` : '');
+      traceEvents.push({name: 'thread_name', ph: 'M', pid: 1, tid, args: {name: label}});
+      traceEvents.push({
+        name: 'command', ph: 'X', pid: 1, tid,
+        ts: us(command.start), dur: us(command.start + command.ms) - us(command.start),
+        args: {id: command.id, mac: command.mac, ok: command.ok, bridge: command.bridge},
+      });
+
+      for (const {name, stage, start, ms, attempt, ok} of command.spans) {
+        traceEvents.push({
+          name, ph: 'X', pid: 1, tid, ts: us(start), dur: us(start + ms) - us(start),
+          args: {stage, attempt, ok},
+        });
+      }
+    });
+
+    return {traceEvents, displayTimeUnit: 'ms'};
+  }
+}
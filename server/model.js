@@ -14,9 +14,10 @@ export class Device {
 
   /**
    * @param {types.AssistantExec[]} exec 
+   * @param {number=} since when the request arrived (as performance.now()), for tracing
    * @return {Promise<types.DeviceState>}
    */
-  async exec(exec) {
+  async exec(exec, since) {
     return {online: false};
   }
 
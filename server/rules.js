@@ -0,0 +1,168 @@
+
+import * as fs from 'fs';
+
+// @ts-ignore
+import JSON5 from 'json5';
+
+
+const PACKET_SIZE = 16;
+export const RULES_TYPE = 0x52;
+
+const OP_COMMIT = 0;
+const OP_BEGIN = 1;
+const OP_LIGHT = 2;
+const OP_RULE = 3;
+const OP_TIME = 4;
+
+const TRIGGER_CHANGE = 1;
+const TRIGGER_TIME = 2;
+const WHEN = {off: 0, on: 1, changed: 2};
+
+const ALL_LIGHTS = 0xff;
+const NONE = 0xff;
+
+// Seconds from the Unix epoch to 2000-01-01, the epoch of the bridge's clock.
+const EPOCH_2000 = 946_684_800;
+
+// Must match board/rules.py.
+const MAX_LIGHTS = 32;
+const MAX_RULES = 32;
+
+// Optional, e.g.
+//   [
+//     {when: {light: 'aa:bb:cc:dd:ee:01', is: 'on'}, then: {light: 'aa:bb:cc:dd:ee:02', on: true}},
+//     {when: {at: '00:00'}, then: {light: '*', on: false}},
+//   ]
+// Times are the bridge's local time. Re-read on connect and on SIGHUP, like bridges.json5.
+const rulesPath = process.env.RULES_PATH ?? new URL('../rules.json5', import.meta.url);
+
+
+/**
+ * @typedef {{
+ *   when: {light?: string, is?: 'on'|'off'|'changed', at?: string},
+ *   then: {light: string, on?: boolean|'toggle', brightness?: number},
+ * }} Rule
+ */
+
+
+/**
+ * @param {string} mac
+ * @return {Buffer}
+ */
+function decodeMac(mac) {
+  const parts = mac.split(':');
+  if (parts.length !== 6 || !parts.every((raw) => /^[0-9a-f]{1,2}$/i.test(raw))) {
+    throw new Error(`got bad mac: ${mac}`);
+  }
+  return Buffer.from(parts.map((raw) => parseInt(raw, 16)));
+}
+
+
+/**
+ * @param {number} op
+ * @param {number[]|Buffer} rest after the op
+ * @return {Buffer}
+ */
+function frame(op, rest = []) {
+  const out = Buffer.alloc(PACKET_SIZE);
+  out[6] = RULES_TYPE;
+  out[7] = op;
+  Buffer.from(rest).copy(out, 8);
+  return out;
+}
+
+
+/**
+ * Compiles rules into frames for the bridge: a table of light slots, then fixed-size records.
+ *
+ * @param {Rule[]} rules
+ * @return {Buffer}
+ */
+export function compileRules(rules) {
+  /** @type {Map<string, number>} */
+  const slots = new Map();
+  /** @type {Buffer[]} */
+  const frames = [frame(OP_BEGIN)];
+
+  /** @param {string} mac */
+  const slotFor = (mac) => {
+    mac = mac.toLowerCase();
+    let slot = slots.get(mac);
+    if (slot === undefined) {
+      slot = slots.size;
+      if (slot >= MAX_LIGHTS) {
+        throw new Error(`rules use more than ${MAX_LIGHTS} lights`);
+      }
+      slots.set(mac, slot);
+      frames.push(frame(OP_LIGHT, [slot, ...decodeMac(mac)]));
+    }
+    return slot;
+  };
+
+  if (rules.length > MAX_RULES) {
+    throw new Error(`got ${rules.length} rules, max ${MAX_RULES}`);
+  }
+
+  rules.forEach(({when, then}, index) => {
+    let trigger;
+    if (when.at !== undefined) {
+      const [hour, minute] = when.at.split(':').map(Number);
+      if (!(hour >= 0 && hour < 24 && minute >= 0 && minute < 60)) {
+        throw new Error(`bad time in rule ${index}: ${when.at}`);
+      }
+      trigger = [TRIGGER_TIME, hour, minute];
+    } else if (when.light !== undefined) {
+      const is = WHEN[when.is ?? 'changed'];
+      if (is === undefined) {
+        throw new Error(`bad condition in rule ${index}: ${when.is}`);
+      }
+      trigger = [TRIGGER_CHANGE, slotFor(when.light), is];
+    } else {
+      throw new Error(`rule ${index} has no trigger`);
+    }
+
+    const target = then.light === '*' ? ALL_LIGHTS : slotFor(then.light);
+    let on = NONE;
+    if (then.on === 'toggle') {
+      on = 2;
+    } else if (then.on !== undefined) {
+      on = then.on ? 1 : 0;
+    }
+    const brightness = then.brightness === undefined ? NONE : Math.max(0, Math.min(100, then.brightness));
+
+    frames.push(frame(OP_RULE, [index, ...trigger, target, on, brightness]));
+  });
+
+  frames.push(frame(OP_COMMIT));
+  return Buffer.concat(frames);
+}
+
+
+/**
+ * The bridge's clock starts at 2000-01-01 on each boot, so its time rules need our local time.
+ *
+ * @param {Date} now
+ * @return {Buffer} frame setting the bridge's clock
+ */
+export function encodeTime(now = new Date()) {
+  const offsetMin = -now.getTimezoneOffset();
+  const out = frame(OP_TIME);
+  out.writeUInt32BE(Math.floor(now.getTime() / 1000) + offsetMin * 60 - EPOCH_2000, 8);
+  out.writeInt16BE(offsetMin, 12);
+  return out;
+}
+
+
+/**
+ * @return {Buffer?} compiled rules from the rules file, or null if there is none (or it's bad)
+ */
+export function loadRules() {
+  try {
+    return compileRules(JSON5.parse(fs.readFileSync(rulesPath, 'utf-8')));
+  } catch (e) {
+    if (/** @type {NodeJS.ErrnoException} */ (e).code !== 'ENOENT') {
+      console.warn('could not load rules', e);
+    }
+    return null;
+  }
+}
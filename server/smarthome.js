@@ -1,8 +1,11 @@
 import {SmartHomeError} from './error.js';
 import * as http from 'http';
+import {performance} from 'perf_hooks';
 import { listenPromise } from './lib/server.js';
 import * as types from '../types/index.js';
-import { allSmartHomeDevices, getByMac, subscribeToChanges, unsubscribeFromChanges } from './devices.js';
+import { allSmartHomeDevices, getByMac, history, subscribeToChanges, tracer, unsubscribeFromChanges } from './devices.js';
+import { bridgeSecurity, bridgeSettings, bridgeStats, sendQueueStats } from './beacons.js';
+import { homegraphStats } from './homegraph.js';
 import ws from 'ws';
 
 
@@ -33,6 +36,95 @@ async function parsePostJson(req) {
 }
 
 
+const HISTORY_LIMIT = 10_000;
+
+
+/**
+ * Serves `GET /history/<id>?from=<ms>&to=<ms>&limit=<n>`, or `?last=on|off` for the newest entry
+ * in that state. Bad numbers get a 400, and limit is capped at HISTORY_LIMIT.
+ *
+ * @param {http.IncomingMessage} req
+ * @param {http.ServerResponse} res
+ */
+async function handleHistory(req, res) {
+  const url = new URL(req.url ?? '', 'http://localhost');
+  let id;
+  try {
+    id = decodeURIComponent(url.pathname.slice('/history/'.length));
+  } catch (err) {
+    res.writeHead(400);  // a malformed escape
+    return res.end();
+  }
+  const param = (/** @type {string} */ name, /** @type {number} */ fallback) => {
+    const raw = url.searchParams.get(name);
+    return raw === null ? fallback : Number(raw);
+  };
+
+  const from = param('from', 0);
+  const to = param('to', Infinity);
+  const limit = param('limit', 1000);
+  if (Number.isNaN(from) || Number.isNaN(to) || !Number.isInteger(limit) || limit < 1) {
+    res.writeHead(400);
+    return res.end();
+  }
+
+  let out;
+  const last = url.searchParams.get('last');
+  try {
+    if (last === 'on' || last === 'off') {
+      out = await history.last(id, (entry) => entry.on === (last === 'on'));
+    } else {
+      out = await history.query(id, from, to, Math.min(limit, HISTORY_LIMIT));
+    }
+  } catch (err) {
+    console.warn('history request error', err);
+    res.writeHead(500);
+    return res.end();
+  }
+
+  res.setHeader('Content-Type', 'application/json');
+  res.end(JSON.stringify(out));
+}
+
+
+/**
+ * Serves `GET /traces`, recent commands as a Chrome trace file (open in chrome://tracing or
+ * Perfetto), or `?format=spans` for the same spans as plain JSON.
+ *
+ * @param {http.IncomingMessage} req
+ * @param {http.ServerResponse} res
+ */
+function handleTraces(req, res) {
+  const url = new URL(req.url ?? '', 'http://localhost');
+  res.setHeader('Content-Type', 'application/json');
+  if (url.searchParams.get('format') === 'spans') {
+    return res.end(JSON.stringify(tracer.spans()));
+  }
+  res.setHeader('Content-Disposition', 'attachment; filename="traces.json"');
+  res.end(JSON.stringify(tracer.export()));
+}
+
+
+/**
+ * Serves `GET /stats`, diagnostics for each connected bridge: its send queue (depth, replaced and
+ * dropped frames), and the telemetry, security and settings it last reported. Also the HomeGraph
+ * report pipeline's queue depth, quiet period and report latency.
+ *
+ * @param {http.IncomingMessage} req
+ * @param {http.ServerResponse} res
+ */
+function handleStats(req, res) {
+  res.setHeader('Content-Type', 'application/json');
+  res.end(JSON.stringify({
+    queues: sendQueueStats(),
+    bridges: bridgeStats(),
+    security: bridgeSecurity(),
+    settings: bridgeSettings(),
+    homegraph: homegraphStats(),
+  }));
+}
+
+
 /**
  * @param {WebSocket} socket
  */
@@ -56,8 +148,9 @@ export async function createSmartHomeActionsSever(port = 8888) {
 
   /**
    * @param {types.AssistantInput} only
+   * @param {number} since when the request arrived
    */
-  const inputHandler = async (only) => {
+  const inputHandler = async (only, since) => {
     switch (only.intent) {
       case 'action.devices.SYNC': {
         return {
@@ -126,7 +219,7 @@ export async function createSmartHomeActionsSever(port = 8888) {
           let execResult;
           try {
             console.debug('exec', id, exec);
-            execResult = await device.exec(exec);
+            execResult = await device.exec(exec, since);
           } catch (e) {
             errorCode = 'hardError';
             if (e instanceof SmartHomeError) {
@@ -170,9 +263,10 @@ export async function createSmartHomeActionsSever(port = 8888) {
 
   /**
    * @param {types.AssistantRequest} payload
+   * @param {number} since when the request arrived
    * @return {Promise<types.AssistantResponse>}
    */
-  const requestHandler = async (payload) => {
+  const requestHandler = async (payload, since) => {
     if (payload.inputs.length !== 1) {
       console.warn('expected single input, had:', payload.inputs.length);
       return {
@@ -183,7 +277,7 @@ export async function createSmartHomeActionsSever(port = 8888) {
     const only = payload.inputs[0];
     //console.warn('got sh-request ==>', JSON.stringify(only, undefined, 2));
     console.info('==>', only.intent);
-    const out = await inputHandler(only);
+    const out = await inputHandler(only, since);
     //console.warn('got sh-response <=', JSON.stringify(out, undefined, 2));
 
     return {
@@ -193,6 +287,22 @@ export async function createSmartHomeActionsSever(port = 8888) {
   };
 
   const httpServer = http.createServer((req, res) => {
+    const since = performance.now();
+    if (req.method === 'GET' && req.url?.startsWith('/history/')) {
+      return handleHistory(req, res).catch((err) => {
+        console.warn('history request error', err);
+        if (!res.headersSent) {
+          res.writeHead(500);
+        }
+        res.end();
+      });
+    }
+    if (req.method === 'GET' && req.url?.split('?')[0] === '/traces') {
+      return handleTraces(req, res);
+    }
+    if (req.method === 'GET' && req.url?.split('?')[0] === '/stats') {
+      return handleStats(req, res);
+    }
     if (req.url !== '/') {
       res.writeHead(404);
       return res.end();
@@ -211,7 +321,7 @@ export async function createSmartHomeActionsSever(port = 8888) {
 
       try {
         const request = await parsePostJson(req);
-        const response = await requestHandler(request);
+        const response = await requestHandler(request, since);
 
         await /** @type {Promise<void>} */ (new Promise((r) => {
           res.write(JSON.stringify(response), () => r());
@@ -0,0 +1,127 @@
+
+import './env.js';
+
+import assert from 'assert';
+import * as net from 'net';
+import test, {after} from 'node:test';
+import {bridgeStats, createBeaconServer, encodeSettings} from '../beacons.js';
+import {FrameParser} from '../lib/frames.js';
+
+
+const server = await createBeaconServer(0);
+const {port} = /** @type {net.AddressInfo} */ (server.address());
+after(() => server.close());
+
+
+/**
+ * A bridge connected to the server, which keeps the frames it's sent.
+ */
+class FakeBridge {
+  /** @type {Buffer[]} */
+  frames = [];
+
+  /** @type {(() => void)?} */
+  #arrived = null;
+
+  constructor() {
+    const parser = new FrameParser(16, (frame) => {
+      this.frames.push(Buffer.from(frame));
+      this.#arrived?.();
+    });
+    this.socket = net.connect(port, '127.0.0.1');
+    this.socket.on('data', (data) => parser.push(data));
+  }
+
+  /**
+   * @param {Buffer} frame
+   */
+  send(frame) {
+    this.socket.write(frame);
+  }
+
+  /**
+   * @param {(frame: Buffer) => boolean} match
+   * @return {Promise<Buffer>} the first frame sent to us that matches, waiting for it if need be
+   */
+  async next(match) {
+    for (;;) {
+      const frame = this.frames.find(match);
+      if (frame) {
+        return frame;
+      }
+      await new Promise((r) => {
+        this.#arrived = () => r(undefined);
+      });
+    }
+  }
+
+  /**
+   * @template T
+   * @param {{[remote: string]: T}} byBridge e.g. from bridgeStats()
+   * @return {T|undefined} our entry
+   */
+  of(byBridge) {
+    const key = Object.keys(byBridge).find((remote) => remote.endsWith(`:${this.socket.localPort}`));
+    return key === undefined ? undefined : byBridge[key];
+  }
+
+  close() {
+    this.socket.destroy();
+  }
+}
+
+
+/**
+ * @param {() => boolean} check
+ */
+async function until(check) {
+  while (!check()) {
+    await new Promise((r) => setTimeout(r, 5));
+  }
+}
+
+
+test('monitor frames are reported per bridge', async () => {
+  const bridge = new FakeBridge();
+  await new Promise((r) => bridge.socket.once('connect', r));
+
+  const frame = Buffer.alloc(16);
+  frame[6] = 0x4d;
+  frame.writeUInt16BE(300, 7);  // lag max
+  frame[9] = 5;                 // lag avg
+  frame.writeUInt16BE(97, 10);  // free kb
+  frame[12] = 25;               // fragmentation
+  frame.writeUInt16BE(12, 13);  // our longest collection
+  frame[15] = 3;                // automatic collections
+  bridge.send(frame);
+
+  await until(() => bridge.of(bridgeStats()) !== undefined);
+  const {when, ...stats} = /** @type {any} */ (bridge.of(bridgeStats()));
+  assert.deepStrictEqual(stats, {
+    lagMaxMs: 300, lagAvgMs: 5, memFreeKb: 97, fragmentation: 25, gcMaxMs: 12, autoCollections: 3,
+  });
+
+  bridge.close();
+  await until(() => bridge.of(bridgeStats()) === undefined);
+});
+
+
+test('settings out of the bridge\'s ranges are not sent', () => {
+  const frames = encodeSettings({
+    delayMs: 250,
+    serverIp: '10.0.0.2',
+    scanMinDuty: 0,
+    serverPort: 70000,
+    backoffMs: 100.5,
+    scanMs: /** @type {any} */ ('fast'),
+    persistentSlots: 3,
+    mystery: 1,
+  });
+
+  const sent = [];
+  for (let i = 0; i < frames.length; i += 16) {
+    assert.strictEqual(frames[i + 6], 0x63);
+    sent.push([frames[i + 7], frames.readUInt32BE(i + 8)]);
+  }
+  assert.deepStrictEqual(sent, [[1, 250], [9, 0x0a000002], [10, 3], [0, 0]]);
+});
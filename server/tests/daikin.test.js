@@ -0,0 +1,98 @@
+
+import './env.js';
+
+import assert from 'assert';
+import * as fs from 'fs';
+import * as http from 'http';
+import test from 'node:test';
+
+
+const MAC = 'a0:cc:2b:ed:11:f2';
+const CACHED_MAC = 'a0:cc:2b:ed:22:01';
+const MOVED_MAC = 'a0:cc:2b:ed:22:02';  // its cached address now answers as another unit
+
+
+/**
+ * A unit's HTTP API, answering slowly enough that requests overlap.
+ *
+ * @param {string} mac
+ * @return {Promise<{address: string, requests: {[path: string]: number}, close: () => void}>}
+ */
+async function fakeUnit(mac) {
+  /** @type {{[path: string]: number}} */
+  const requests = {};
+  const bodies = {
+    '/common/basic_info': `ret=OK,type=aircon,mac=${mac.replaceAll(':', '').toUpperCase()}`,
+    '/aircon/get_sensor_info': 'ret=OK,htemp=22.5,otemp=-',
+    '/aircon/get_control_info': 'ret=OK,pow=1,mode=3,stemp=21.0,f_rate=A,f_dir=0',
+  };
+
+  const server = http.createServer((req, res) => {
+    const path = req.url ?? '';
+    requests[path] = (requests[path] ?? 0) + 1;
+    setTimeout(() => res.end(bodies[/** @type {keyof bodies} */ (path)] ?? 'ret=PARAM NG'), 20);
+  });
+  await new Promise((r) => server.listen(0, '127.0.0.1', () => r(undefined)));
+  const {port} = /** @type {import('net').AddressInfo} */ (server.address());
+  return {address: `127.0.0.1:${port}`, requests, close: () => server.close()};
+}
+
+
+// The cache from a previous run is read as daikin.js loads, so write it first.
+const cachedUnit = await fakeUnit(CACHED_MAC);
+fs.writeFileSync(/** @type {string} */ (process.env.DAIKIN_CACHE_PATH), JSON.stringify({
+  [CACHED_MAC]: cachedUnit.address,
+  [MOVED_MAC]: cachedUnit.address,
+}));
+
+const {subscribeToChanges} = await import('../devices.js');
+const {DaikinAC} = await import('../types/daikin.js');
+
+
+test('state is fetched once for concurrent callers, then served from cache', async () => {
+  const unit = await fakeUnit(MAC);
+  const ac = new DaikinAC(MAC, unit.address);
+
+  /** @type {string[]} */
+  const changed = [];
+  subscribeToChanges((id) => changed.push(id));
+
+  const states = await Promise.all([ac.state(), ac.state(), ac.state()]);
+  assert.deepStrictEqual(states[0], {
+    online: true,
+    on: true,
+    thermostatTemperatureAmbient: 22.5,
+    thermostatMode: 'cool',
+    thermostatTemperatureSetpoint: 21,
+    currentFanSpeedSetting: 'speed_auto',
+  });
+  assert.ok(states.every((state) => state === states[0]));
+  assert.deepStrictEqual(unit.requests, {'/aircon/get_sensor_info': 1, '/aircon/get_control_info': 1});
+  assert.deepStrictEqual(changed, [MAC]);
+
+  assert.strictEqual(await ac.state(), states[0]);  // still fresh
+  assert.strictEqual(unit.requests['/aircon/get_control_info'], 1);
+  unit.close();
+});
+
+
+test('a cached address is used once the unit there answers as the right one', async () => {
+  const ac = new DaikinAC(CACHED_MAC);
+  assert.strictEqual((await ac.state()).online, true);
+  assert.ok(cachedUnit.requests['/common/basic_info'] >= 1);
+
+  // and it's saved for next time
+  await new Promise((r) => setTimeout(r, 1200));
+  const saved = JSON.parse(fs.readFileSync(/** @type {string} */ (process.env.DAIKIN_CACHE_PATH), 'utf-8'));
+  assert.strictEqual(saved[CACHED_MAC], cachedUnit.address);
+});
+
+
+test('a cached address answering as another unit is not used', async () => {
+  const ac = new DaikinAC(MOVED_MAC);
+  await assert.rejects(ac.state(), {code: 'deviceNotFound'});
+
+  const saved = JSON.parse(fs.readFileSync(/** @type {string} */ (process.env.DAIKIN_CACHE_PATH), 'utf-8'));
+  assert.ok(!(MOVED_MAC in saved));
+  cachedUnit.close();
+});
@@ -0,0 +1,56 @@
+
+import './env.js';
+
+import assert from 'assert';
+import * as fs from 'fs';
+import test from 'node:test';
+
+
+const LIGHT = '00:0d:6f:c6:aa:f5';
+const OTHER_LIGHT = '00:0d:6f:c6:aa:f9';
+
+fs.writeFileSync(/** @type {string} */ (process.env.DEVICES_PATH), JSON.stringify({
+  [LIGHT]: {type: 'clipsal', name: 'Ensuite'},
+  [OTHER_LIGHT]: {type: 'clipsal', name: 'Loft'},
+}));
+
+const {applySnapshot, getByMac, subscribeToChanges} = await import('../devices.js');
+
+
+/**
+ * @param {string} mac
+ * @param {boolean} on
+ * @param {number} brightness
+ * @param {number} ageSec
+ * @return {Buffer}
+ */
+function snapshotEntry(mac, on, brightness, ageSec) {
+  const frame = Buffer.alloc(16);
+  Buffer.from(mac.replaceAll(':', ''), 'hex').copy(frame);
+  frame[6] = 0x53;
+  frame[7] = Number(on);
+  frame[8] = brightness;
+  frame.writeUInt16BE(ageSec, 9);
+  return frame;
+}
+
+
+test('a snapshot brings lights online and reports only what changed', async () => {
+  /** @type {[string, any][]} */
+  const changes = [];
+  subscribeToChanges((id, state) => changes.push([id, state]));
+
+  applySnapshot([
+    snapshotEntry(LIGHT, true, 40, 5),
+    snapshotEntry(OTHER_LIGHT, false, 100, 0xffff),  // seen too long ago to be online
+    snapshotEntry('00:00:00:00:00:01', true, 1, 0),  // unknown
+  ]);
+  assert.deepStrictEqual(changes, [[LIGHT, {online: true, on: true, brightness: 40}]]);
+  assert.deepStrictEqual(await getByMac(OTHER_LIGHT)?.state(), {online: false});
+
+  // from another bridge that heard it longer ago: older than what we know, so ignored
+  changes.length = 0;
+  applySnapshot([snapshotEntry(LIGHT, false, 40, 30)]);
+  assert.deepStrictEqual(changes, []);
+  assert.deepStrictEqual(await getByMac(LIGHT)?.state(), {online: true, on: true, brightness: 40});
+});
@@ -0,0 +1,21 @@
+
+/**
+ * @fileoverview Points the server's files at a temporary directory. Import this before anything
+ * that imports devices.js or beacons.js, which read their paths as they load.
+ */
+
+import * as fs from 'fs';
+import * as os from 'os';
+import * as path from 'path';
+
+export const dir = fs.mkdtempSync(path.join(os.tmpdir(), 'smarthome-'));
+
+process.env.DEVICES_PATH = path.join(dir, 'devices.json5');
+process.env.HISTORY_PATH = path.join(dir, 'history');
+process.env.BRIDGES_PATH = path.join(dir, 'bridges.json5');
+process.env.RULES_PATH = path.join(dir, 'rules.json5');
+process.env.DAIKIN_CACHE_PATH = path.join(dir, 'daikin-cache.json');
+
+fs.writeFileSync(process.env.DEVICES_PATH, '{}');
+
+process.on('exit', () => fs.rmSync(dir, {recursive: true, force: true}));
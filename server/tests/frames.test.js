@@ -0,0 +1,67 @@
+
+import assert from 'assert';
+import test from 'node:test';
+import {FrameParser, macKey} from '../lib/frames.js';
+
+
+/**
+ * @param {number} count
+ * @return {Buffer} frames whose bytes count up, so each is different
+ */
+function stream(count) {
+  const out = Buffer.alloc(count * 16);
+  for (let i = 0; i < out.length; ++i) {
+    out[i] = i & 0xff;
+  }
+  return out;
+}
+
+/**
+ * @param {Buffer} data
+ * @param {number[]} sizes chunk sizes, repeated
+ * @return {Buffer[]} frames, copied as they're parsed
+ */
+function parse(data, sizes) {
+  /** @type {Buffer[]} */
+  const frames = [];
+  const parser = new FrameParser(16, (frame) => frames.push(Buffer.from(frame)));
+  for (let offset = 0, i = 0; offset < data.length; ++i) {
+    const size = sizes[i % sizes.length];
+    parser.push(data.subarray(offset, offset + size));
+    offset += size;
+  }
+  return frames;
+}
+
+
+test('frames split across chunks come out whole and in order', () => {
+  const data = stream(20);
+  const expected = Array.from({length: 20}, (_, i) => data.subarray(i * 16, i * 16 + 16));
+
+  for (const sizes of [[16], [320], [1], [5], [15, 17], [3, 40, 1, 29], [31, 1]]) {
+    assert.deepStrictEqual(parse(data, sizes), expected, `chunks of ${sizes}`);
+  }
+});
+
+
+test('a partial tail waits for the rest', () => {
+  const data = stream(2);
+  /** @type {Buffer[]} */
+  const frames = [];
+  const parser = new FrameParser(16, (frame) => frames.push(Buffer.from(frame)));
+
+  parser.push(data.subarray(0, 10));
+  parser.push(data.subarray(10, 12));
+  assert.strictEqual(frames.length, 0);
+  parser.push(data.subarray(12, 20));  // completes the first, starts the second
+  assert.deepStrictEqual(frames, [data.subarray(0, 16)]);
+  parser.push(data.subarray(20));
+  assert.deepStrictEqual(frames, [data.subarray(0, 16), data.subarray(16)]);
+});
+
+
+test('macKey', () => {
+  const frame = Buffer.from('000d6fc6aaf5550100', 'hex');
+  assert.strictEqual(macKey(frame), 0x000d6fc6aaf5);
+  assert.strictEqual(macKey(frame, 1), 0x0d6fc6aaf555);
+});
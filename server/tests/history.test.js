@@ -0,0 +1,100 @@
+
+import assert from 'assert';
+import * as fs from 'fs';
+import * as os from 'os';
+import * as path from 'path';
+import test, {after} from 'node:test';
+import {HistoryStore} from '../lib/history.js';
+
+
+/** @type {string[]} */
+const dirs = [];
+after(() => dirs.forEach((dir) => fs.rmSync(dir, {recursive: true, force: true})));
+
+/**
+ * @return {string}
+ */
+function tempDir() {
+  const dir = fs.mkdtempSync(path.join(os.tmpdir(), 'history-'));
+  dirs.push(dir);
+  return dir;
+}
+
+
+test('query reads across rotated segments, oldest first', async () => {
+  const dir = tempDir();
+  const store = new HistoryStore(dir, {segmentBytes: 16 * 1000});
+  for (let i = 0; i < 2500; ++i) {
+    store.recordState(i % 2 ? 'b' : 'a', {online: true, on: Boolean(i % 4), brightness: i % 101}, 1000 + i);
+  }
+
+  const segments = fs.readdirSync(dir).filter((f) => f.endsWith('.log'));
+  assert.strictEqual(segments.length, 3);
+
+  const pending = store.query('a', 1900, 2100);
+  assert.ok(pending instanceof Promise);  // reads don't hold up the event loop
+  const out = await pending;
+  assert.deepStrictEqual(out.map((e) => e.when), Array.from({length: 101}, (_, i) => 1900 + 2 * i));
+  assert.strictEqual((await store.query('b', 0, Infinity, 5)).length, 5);
+  assert.strictEqual((await store.query(null)).length, 2500);
+  assert.deepStrictEqual(await store.query('nobody'), []);
+});
+
+
+test('old segments are dropped past maxSegments', async () => {
+  const dir = tempDir();
+  const store = new HistoryStore(dir, {segmentBytes: 16 * 100, maxSegments: 2});
+  for (let i = 0; i < 500; ++i) {
+    store.recordCommand('a', true, i, i);
+  }
+  store.flush();
+
+  assert.strictEqual(fs.readdirSync(dir).filter((f) => f.endsWith('.log')).length, 2);
+  const out = await store.query('a');
+  assert.strictEqual(out.length, 200);
+  assert.strictEqual(out[0].when, 300);
+  assert.strictEqual(out[0].latencyMs, 300);
+});
+
+
+test('appends that rotate during a query don\'t skip segments', async () => {
+  const dir = tempDir();
+  const store = new HistoryStore(dir, {segmentBytes: 16 * 100, maxSegments: 3});
+  for (let i = 0; i < 300; ++i) {
+    store.recordCommand('a', true, i, i);
+  }
+
+  const pending = store.query('a', 0, 299);
+  for (let i = 300; i < 400; ++i) {
+    store.recordCommand('a', true, i, i);
+  }
+  store.flush();  // drops the oldest segment while the query reads it
+
+  const out = await pending;
+  assert.deepStrictEqual(out.map((e) => e.when), Array.from({length: 300}, (_, i) => i));
+});
+
+test('a restart continues the last segment and rebuilds a lost index', async () => {
+  const dir = tempDir();
+  const store = new HistoryStore(dir);
+  for (let i = 0; i < 600; ++i) {
+    store.recordState('a', {online: true, on: i === 10}, i);
+  }
+  store.flush();
+
+  const [log] = fs.readdirSync(dir).filter((f) => f.endsWith('.log'));
+  fs.rmSync(path.join(dir, log.replace(/\.log$/, '.idx')));
+  fs.appendFileSync(path.join(dir, log), Buffer.alloc(5));  // a record cut off by a crash
+
+  const restarted = new HistoryStore(dir);
+  restarted.recordState('a', {online: false}, 600);
+  restarted.flush();
+
+  assert.deepStrictEqual(fs.readdirSync(dir).filter((f) => f.endsWith('.log')), [log]);
+  const out = await restarted.query('a', 590);
+  assert.deepStrictEqual(out.map((e) => e.when), [590, 591, 592, 593, 594, 595, 596, 597, 598, 599, 600]);
+  assert.strictEqual(out[out.length - 1].online, false);
+
+  const on = await restarted.last('a', (e) => e.on === true);
+  assert.strictEqual(on?.when, 10);
+});
@@ -0,0 +1,47 @@
+
+import assert from 'assert';
+import test from 'node:test';
+import {WorkQueueObject} from '../lib/queue.js';
+
+
+test('retrieve takes at most limit entries, and wait() holds until empty', async () => {
+  /** @type {WorkQueueObject<number>} */
+  const queue = new WorkQueueObject();
+  for (let i = 0; i < 5; ++i) {
+    queue.add(`d${i}`, i);
+  }
+  queue.add('d1', 10);  // replaces, in place
+
+  assert.deepStrictEqual(queue.retrieve(3), {d0: 0, d1: 10, d2: 2});
+  assert.strictEqual(queue.size, 2);
+  await queue.wait();  // still resolved
+
+  assert.deepStrictEqual(queue.retrieve(3), {d3: 3, d4: 4});
+  assert.strictEqual(queue.size, 0);
+
+  let waited = false;
+  const waiting = queue.wait().then(() => {
+    waited = true;
+  });
+  await new Promise((r) => setTimeout(r, 5));
+  assert.strictEqual(waited, false);
+  queue.add('d5', 5);
+  await waiting;
+});
+
+
+test('restore puts back a failed batch without overwriting newer entries', async () => {
+  /** @type {WorkQueueObject<number>} */
+  const queue = new WorkQueueObject();
+  queue.add('a', 1);
+  queue.add('b', 1);
+  const batch = queue.retrieve();
+
+  queue.add('b', 2);  // newer than the failed batch
+  queue.restore(batch);
+  assert.deepStrictEqual(queue.retrieve(), {b: 2, a: 1});
+
+  queue.restore({c: 1});  // into an empty queue, which wakes a waiter
+  await queue.wait();
+  assert.deepStrictEqual(queue.retrieve(), {c: 1});
+});
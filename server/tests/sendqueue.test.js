@@ -0,0 +1,142 @@
+
+import assert from 'assert';
+import {EventEmitter} from 'events';
+import test from 'node:test';
+import {SendQueue} from '../lib/sendqueue.js';
+
+
+/**
+ * Records writes, and accepts them (returns true) only while open.
+ */
+class FakeSocket extends EventEmitter {
+  destroyed = false;
+  open = true;
+
+  /** @type {Buffer[]} */
+  written = [];
+
+  /**
+   * @param {Buffer} data
+   */
+  write(data) {
+    this.written.push(data);
+    return this.open;
+  }
+
+  drain() {
+    this.open = true;
+    this.emit('drain');
+  }
+}
+
+/**
+ * @param {number} mac last byte of the MAC
+ * @param {number} value
+ * @return {Buffer}
+ */
+function command(mac, value) {
+  const frame = Buffer.alloc(16);
+  frame[5] = mac;
+  frame[7] = value;
+  return frame;
+}
+
+/**
+ * @param {FakeSocket} socket
+ * @return {number[][]} [mac, value] of each write
+ */
+function writes(socket) {
+  return socket.written.map((frame) => [frame[5], frame[7]]);
+}
+
+
+test('writes until the socket is full, then waits for drain', () => {
+  const socket = new FakeSocket();
+  const queue = new SendQueue(/** @type {any} */ (socket));
+
+  queue.push(command(1, 1));
+  socket.open = false;
+  queue.push(command(2, 1));  // written, but fills the socket
+  queue.push(command(3, 1));
+  assert.deepStrictEqual(writes(socket), [[1, 1], [2, 1]]);
+  assert.deepStrictEqual(queue.stats(), {
+    depth: 1, blocked: true, sent: 2, replaced: 0, expired: 0, overflowed: 0,
+  });
+
+  socket.drain();
+  assert.deepStrictEqual(writes(socket), [[1, 1], [2, 1], [3, 1]]);
+  assert.strictEqual(queue.stats().blocked, false);
+});
+
+
+test('a newer command for a MAC replaces the queued one in its place', () => {
+  const socket = new FakeSocket();
+  const queue = new SendQueue(/** @type {any} */ (socket));
+  socket.open = false;
+  queue.push(command(1, 1));
+
+  queue.push(command(2, 1));
+  queue.push(command(3, 1));
+  queue.push(command(2, 2));
+  socket.drain();
+
+  assert.deepStrictEqual(writes(socket), [[1, 1], [2, 2], [3, 1]]);
+  assert.strictEqual(queue.stats().replaced, 1);
+});
+
+
+test('expired commands are dropped unsent', async () => {
+  const socket = new FakeSocket();
+  const queue = new SendQueue(/** @type {any} */ (socket));
+  socket.open = false;
+  queue.push(command(1, 1));
+
+  queue.push(command(2, 1), 5);
+  queue.push(command(3, 1));
+  await new Promise((r) => setTimeout(r, 20));
+  socket.drain();
+
+  assert.deepStrictEqual(writes(socket), [[1, 1], [3, 1]]);
+  assert.strictEqual(queue.stats().expired, 1);
+});
+
+
+test('when full, the oldest command is dropped but bridge messages are kept', () => {
+  const socket = new FakeSocket();
+  /** @type {Buffer[]} */
+  const sent = [];
+  const queue = new SendQueue(/** @type {any} */ (socket), 3, (frame) => sent.push(frame));
+  socket.open = false;
+  queue.push(command(1, 1));
+
+  queue.pushBridge('settings', Buffer.alloc(32, 0xee));
+  queue.push(command(2, 1));
+  queue.push(command(3, 1));
+  queue.push(command(4, 1));
+  socket.drain();
+
+  assert.deepStrictEqual(socket.written.map((data) => data.length), [16, 32, 16, 16]);
+  assert.deepStrictEqual(writes(socket).slice(2), [[3, 1], [4, 1]]);
+  assert.strictEqual(queue.stats().overflowed, 1);
+  assert.strictEqual(sent.length, 3);  // only commands are reported as sent
+});
+
+
+test('bridge messages are replaced by kind and made when written', () => {
+  const socket = new FakeSocket();
+  const queue = new SendQueue(/** @type {any} */ (socket));
+  socket.open = false;
+  queue.push(command(1, 1));
+
+  let made = 0;
+  const ping = () => command(0, ++made);
+  queue.pushBridge('clock', ping);
+  queue.pushBridge('rules', Buffer.alloc(48));
+  queue.pushBridge('clock', ping);
+  assert.strictEqual(made, 0);
+
+  socket.drain();
+  assert.deepStrictEqual(socket.written.map((data) => data.length), [16, 16, 48]);
+  assert.deepStrictEqual(writes(socket)[1], [0, 1]);
+  assert.strictEqual(queue.stats().replaced, 1);
+});
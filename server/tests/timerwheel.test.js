@@ -0,0 +1,54 @@
+
+import assert from 'assert';
+import {performance} from 'perf_hooks';
+import test from 'node:test';
+import {TimerWheel} from '../lib/timerwheel.js';
+
+
+/**
+ * @param {number} ms
+ */
+const sleep = (ms) => new Promise((r) => setTimeout(r, ms));
+
+
+test('timers fire in deadline order, never early', async () => {
+  const wheel = new TimerWheel(10, 8);  // 80ms around, so the longer ones take more than a round
+
+  /** @type {{ms: number, early: number}[]} */
+  const fired = [];
+  const add = (/** @type {number} */ ms) => {
+    const start = performance.now();
+    wheel.add(ms, () => fired.push({ms, early: ms - (performance.now() - start)}));
+  };
+
+  add(200);
+  add(30);
+  await sleep(7);  // partway through a tick
+  add(95);
+  add(1);
+  add(10);
+  await sleep(3);
+  add(50);
+
+  while (wheel.size) {
+    await sleep(10);
+  }
+  assert.deepStrictEqual(fired.map((f) => f.ms), [1, 10, 30, 50, 95, 200]);
+  for (const {ms, early} of fired) {
+    assert.ok(early <= 1, `${ms}ms timer fired ${early.toFixed(1)}ms early`);  // setInterval's own slop
+  }
+});
+
+
+test('cancelled timers don\'t fire', async () => {
+  const wheel = new TimerWheel(5);
+  let fired = 0;
+  const timer = wheel.add(10, () => ++fired);
+  wheel.add(15, () => ++fired);
+  wheel.cancel(timer);
+  assert.strictEqual(wheel.size, 1);
+
+  await sleep(40);
+  assert.strictEqual(fired, 1);
+  assert.strictEqual(wheel.size, 0);
+});
@@ -0,0 +1,106 @@
+
+import assert from 'assert';
+import {performance} from 'perf_hooks';
+import test from 'node:test';
+import {CLOCK_TYPE, ClockSync, TRACE_TYPE, Tracer} from '../lib/tracing.js';
+
+
+/**
+ * @param {number} ms
+ */
+const sleep = (ms) => new Promise((r) => setTimeout(r, ms));
+
+/**
+ * @param {ClockSync} clock
+ * @param {number} ticks the bridge's time as it echoes the ping
+ * @param {number=} agoMs how long before now the ping was sent
+ */
+function echo(clock, ticks, agoMs = 0) {
+  const frame = clock.ping();
+  assert.strictEqual(frame[6], CLOCK_TYPE);
+  frame.writeUInt32BE((frame.readUInt32BE(8) - agoMs) >>> 0, 8);
+  frame.writeUInt32BE(ticks, 12);
+  clock.reply(frame);
+}
+
+/**
+ * @param {number} id
+ * @param {number} stage
+ * @param {number} ticks
+ * @param {number=} attempt
+ */
+function stageFrame(id, stage, ticks, attempt = 1) {
+  const frame = Buffer.alloc(16);
+  frame[6] = TRACE_TYPE;
+  frame[7] = stage;
+  frame.writeUInt16BE(id, 8);
+  frame.writeUInt32BE(ticks, 10);
+  frame[14] = attempt;
+  frame[15] = 1;
+  return frame;
+}
+
+
+test('bridge times are converted with the quickest ping', () => {
+  const clock = new ClockSync();
+  assert.strictEqual(clock.toServer(0), null);
+
+  echo(clock, 5000, 400);
+  echo(clock, 2 ** 30 - 100);
+  const stats = /** @type {{rttMs: number, samples: number}} */ (clock.stats());
+  assert.ok(stats.rttMs <= 1 && stats.samples === 2);
+
+  // the quick sample wins, and bridge ticks wrap
+  const at = /** @type {number} */ (clock.toServer(2 ** 30 - 100));
+  assert.ok(Math.abs(at - performance.now()) < 5);
+  assert.strictEqual(Math.round(/** @type {number} */ (clock.toServer(50)) - at), 150);
+  assert.strictEqual(Math.round(/** @type {number} */ (clock.toServer(2 ** 30 - 110)) - at), -10);
+});
+
+
+test('traces become spans per bridge', async () => {
+  const tracer = new Tracer();
+  const trace = tracer.begin('aa:bb:cc:dd:ee:ff');
+  const command = Buffer.alloc(16);
+  command.writeUInt16BE(trace.id, 9);
+  tracer.sent(command, 'b1');
+  await sleep(60);
+
+  const clock = new ClockSync();
+  tracer.bridgeStage(stageFrame(trace.id, 1, 9950), 'b1', clock);  // before the clock is known
+  echo(clock, 10_000);
+  tracer.bridgeStage(stageFrame(trace.id, 1, 9950), 'b1', clock);
+  tracer.bridgeStage(stageFrame(trace.id, 2, 9960), 'b1', clock);
+  tracer.bridgeStage(stageFrame(trace.id, 2, 9980, 2), 'b1', clock);
+  tracer.bridgeStage(stageFrame(trace.id, 5, 9990, 2), 'b1', clock);
+  tracer.bridgeStage(stageFrame(trace.id, 7, 9995, 2), 'b1', clock);
+  tracer.bridgeStage(stageFrame(trace.id, 1, 9970), 'b2', clock);  // heard by another bridge too
+  tracer.bridgeStage(stageFrame(trace.id + 1, 1, 9970), 'b1', clock);  // not ours
+  tracer.bridgeStage(stageFrame(trace.id, 9, 9970), 'b1', clock);  // a stage we don't know
+  tracer.end(trace, true);
+
+  const [b1, b2] = tracer.spans();
+  assert.deepStrictEqual(b1.spans.map((s) => s.name),
+      ['send queue', 'network', 'bridge queue', 'retry', 'write', 'finish', 'respond']);
+  assert.strictEqual(Math.round(/** @type {number} */ (b1.spans.find((s) => s.name === 'retry')?.ms)), 20);
+  assert.deepStrictEqual(b2.spans.map((s) => s.name), ['network', 'respond']);
+  assert.ok(b1.ok && b1.bridge === 'b1' && b2.bridge === 'b2');
+  assert.ok(b1.ms >= 55);
+
+  const {traceEvents} = tracer.export();
+  assert.strictEqual(traceEvents.length, 1 + (2 + 7) + (2 + 2));
+  assert.deepStrictEqual(traceEvents[1],
+      {name: 'thread_name', ph: 'M', pid: 1, tid: 1, args: {name: `#${trace.id} aa:bb:cc:dd:ee:ff via b1`}});
+});
+
+
+test('only recent traces are kept, with nonzero IDs', () => {
+  const tracer = new Tracer(2);
+  const ids = [];
+  for (let i = 0; i < 0xffff + 1; ++i) {
+    ids.push(tracer.begin('aa:bb:cc:dd:ee:ff').id);
+  }
+  assert.deepStrictEqual(ids.slice(-2), [0xffff, 1]);
+  assert.ok(!ids.includes(0));
+  assert.deepStrictEqual(tracer.spans().map((s) => s.id), [0xffff, 1]);
+});
@@ -2,10 +2,12 @@
 import {Device} from '../model.js';
 import {performance} from 'perf_hooks';
 import * as types from '../../types/index.js';
-import { subscribeToChanges, waitForChangesTo } from '../devices.js';
+import { history, subscribeToChanges, tracer, waitForChangesTo } from '../devices.js';
 
 
 const LIGHT_BEACON_TYPE = 0x55;
+const LIGHT_SNAPSHOT_TYPE = 0x53;
+const LIGHT_CONFIRM_TYPE = 0x43;
 const ONLINE_MS = 60_000;
 const EXEC_CHANGE_MS = 5_000;
 
@@ -19,7 +21,7 @@ export class ClipsalPower extends Device {
 
   /**
    * @param {string} mac
-   * @param {(buffer: Buffer) => number} writeToBeacon
+   * @param {(buffer: Buffer, maxAgeMs?: number) => number} writeToBeacon
    */
   constructor(mac, writeToBeacon) {
     super();
@@ -28,22 +30,34 @@ export class ClipsalPower extends Device {
   }
 
   /**
-   * @param {Buffer} buffer 12-byte payload (mac already stripped)
+   * Handles live updates (advertised, or read back by the bridge after a write) and snapshot
+   * entries, which carry how long ago (in seconds) the bridge last saw this state.
+   *
+   * @param {Buffer} buffer 10-byte payload (mac already stripped)
    * @return {types.DeviceState?}
    */
   updateViaBeacon(buffer) {
     const type = buffer[0];
-    if (type !== LIGHT_BEACON_TYPE) {
+    const now = performance.now();
+    let when = now;
+
+    if (type === LIGHT_SNAPSHOT_TYPE) {
+      when = now - buffer.readUInt16BE(3) * 1000;
+      if (when <= this.#when) {
+        return null;  // we've heard something newer
+      }
+    } else if (type !== LIGHT_BEACON_TYPE && type !== LIGHT_CONFIRM_TYPE) {
       throw new Error(`got non-light beacon update: ${type}`);
     }
-    const first = this.#when < 0;
-    this.#when = performance.now();
+
+    const wasOnline = (now - this.#when) <= ONLINE_MS;
+    this.#when = when;
 
     const isOn = Boolean(buffer[1]);
     const brightness = buffer[2];
 
     if (this.#isOn === isOn && this.#brightness === brightness) {
-      if (first) {
+      if (!wasOnline) {
         return this.#internalState();
       }
       return null;
@@ -79,13 +93,16 @@ export class ClipsalPower extends Device {
 
   /**
    * @param {types.AssistantExec[]} exec 
+   * @param {number=} since when the request arrived
    * @return {Promise<types.DeviceState>}
    */
-  async exec(exec) {
+  async exec(exec, since) {
+    const trace = tracer.begin(this.#mac, since);
     const payload = Buffer.alloc(10, 0);
     payload[0] = LIGHT_BEACON_TYPE;
     payload[1] = 255;
     payload[2] = 255;
+    payload.writeUInt16BE(trace.id, 3);  // the bridge reports its stages against this
 
     for (const e of exec) {
       switch (e.command) {
@@ -103,6 +120,7 @@ export class ClipsalPower extends Device {
 
         default:
           console.warn('got unhandled command on light:', e.command);
+          tracer.end(trace, false);
           return {
             online: true,
             errorCode: 'functionNotSupported',
@@ -110,17 +128,25 @@ export class ClipsalPower extends Device {
       }
     }
 
-    const writes = this.#writeToBeacon(payload);
+    // Not worth delivering once we've stopped waiting for it.
+    const writes = this.#writeToBeacon(payload, EXEC_CHANGE_MS);
     if (writes === 0) {
+      tracer.end(trace, false);
       return {
         online: false,
       };
     }
 
+    const start = performance.now();
     const update = await waitForChangesTo(this.#mac, (change) => {
       // This is probably our change.
       return true;
     }, EXEC_CHANGE_MS);
+    history.recordCommand(this.#mac, Boolean(update), performance.now() - start);
+    if (update) {
+      tracer.mark(trace, 'changed');
+    }
+    tracer.end(trace, Boolean(update));
 
     // Just return the previous seen state if nothing happens. Google has a pretty strict timeout
     // which means that updating many lights tends to make it unhappy, so we can't wait longer than
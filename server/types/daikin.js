@@ -7,11 +7,51 @@ import * as dgram from 'dgram';
 import { sleep } from '../../lib/promise.js';
 import fetch from 'node-fetch';
 import { runTask } from '../lib/task.js';
+import * as http from 'http';
+import { notifyChange } from '../devices.js';
+import * as fs from 'fs';
+
+
+// Serve QUERY from cache if it's this fresh, and refresh in the background after a while.
+const STATE_STALE_MS = 15_000;
+const STATE_REFRESH_MS = 60_000;
+
+// The units' Wi-Fi modules are slow and fall over easily, so reuse one connection per unit.
+const agent = new http.Agent({keepAlive: true, maxSockets: 1});
+const FETCH_TIMEOUT_MS = 5_000;
+const PROBE_TIMEOUT_MS = 500;
+
+// Discovery is a short burst of broadcasts, sent on startup and whenever a unit can't be found.
+const DISCOVERY_BURST_MS = [0, 150, 500];
+const DISCOVERY_MIN_INTERVAL_MS = 5_000;
+const DISCOVERY_WAIT_MS = 1_000;
 
 
 /** @type {{[mac: string]: string}} */
 const macToIP = {};
 
+/** @type {Set<string>} IPs from config, which we never forget */
+const staticIPs = new Set();
+
+/** @type {Map<string, Set<() => void>>} */
+const discoveryWaiters = new Map();
+
+const cachePath = process.env.DAIKIN_CACHE_PATH ?? new URL('../../daikin-cache.json', import.meta.url);
+
+/** @type {{[mac: string]: string}} from the last run, unvalidated */
+let cachedIPs = {};
+try {
+  cachedIPs = JSON.parse(fs.readFileSync(cachePath, 'utf-8'));
+} catch (e) {
+  // no cache yet
+}
+
+const discoveryPayload = Buffer.from('DAIKIN_UDP/common/basic_info', 'utf-8');
+
+/** @type {dgram.Socket?} */
+let discoverySocket = null;
+let lastBurstAt = -Infinity;
+
 
 /** @type {{[mode: string]: number}} */
 const assistantModeToValue = {
@@ -53,6 +93,127 @@ function parseValues(raw) {
 const clampToHalfDegree = (value) => Math.round(value * 2) / 2;
 
 
+/**
+ * @param {string} raw e.g. "a0cc2bed11f2"
+ * @return {string} e.g. "a0:cc:2b:ed:11:f2"
+ */
+function formatMac(raw) {
+  const macParts = [];
+  for (let i = 0; i < raw.length; i += 2) {
+    macParts.push(raw.substr(i, 2));
+  }
+  return macParts.join(':').toLowerCase();
+}
+
+
+/**
+ * @param {string} mac
+ * @param {string} ip
+ */
+function foundDevice(mac, ip) {
+  const waiters = discoveryWaiters.get(mac);
+  if (waiters) {
+    discoveryWaiters.delete(mac);
+    waiters.forEach((resolve) => resolve());
+  }
+
+  if (macToIP[mac] === ip) {
+    return;  // already seen this one at this address
+  }
+
+  console.debug('found daikin AC device', mac, 'at', ip);
+  macToIP[mac] = ip;
+  saveCache();
+}
+
+
+/**
+ * @param {string} mac
+ */
+function forgetDevice(mac) {
+  if (!staticIPs.has(mac) && macToIP[mac]) {
+    console.debug('forgetting daikin AC device', mac, 'at', macToIP[mac]);
+    delete macToIP[mac];
+  }
+}
+
+
+let saveCachePending = false;
+
+function saveCache() {
+  if (saveCachePending) {
+    return;
+  }
+  saveCachePending = true;
+  setTimeout(() => {
+    saveCachePending = false;
+    fs.promises.writeFile(cachePath, JSON.stringify(macToIP, undefined, 2)).catch((err) => {
+      console.warn('could not save daikin cache', err);
+    });
+  }, 1000);
+}
+
+
+/**
+ * Cheaply checks that the unit at ip is the one we expect.
+ *
+ * @param {string} mac
+ * @param {string} ip
+ */
+async function probe(mac, ip) {
+  try {
+    const response = await fetch(`http://${ip}/common/basic_info`, {agent, timeout: PROBE_TIMEOUT_MS});
+    const values = parseValues(await response.text());
+    return formatMac(values.mac ?? '') === mac;
+  } catch (e) {
+    return false;
+  }
+}
+
+
+/**
+ * @param {string} address
+ * @return {Promise<void>}
+ */
+async function sendDiscovery(address = '255.255.255.255') {
+  const sock = discoverySocket;
+  if (!sock) {
+    return;  // not bound yet, the task will burst on startup anyway
+  }
+  const bytes = await new Promise((resolve, reject) => {
+    sock.send(discoveryPayload, 30050, address, (err, bytes) => {
+      if (err) {
+        reject(err);
+      } else {
+        resolve(bytes);
+      }
+    });
+  });
+  if (bytes !== discoveryPayload.length) {
+    throw new Error(`discovery payload could not be sent`);
+  }
+}
+
+
+/**
+ * Sends a few broadcasts in quick succession (UDP is lossy). Rate-limited.
+ */
+async function discoveryBurst() {
+  const now = performance.now();
+  if (now - lastBurstAt < DISCOVERY_MIN_INTERVAL_MS) {
+    return;
+  }
+  lastBurstAt = now;
+
+  let at = 0;
+  for (const when of DISCOVERY_BURST_MS) {
+    await sleep(when - at);
+    at = when;
+    await sendDiscovery();
+  }
+}
+
+
 /**
  * @param {() => void} success
  */
@@ -69,62 +230,100 @@ async function broadcastTask(success) {
 
   sock.on('message', (message, rinfo) => {
     const values = parseValues(message.toString('utf-8'));
-
-    const macParts = [];
-    const rawMac = values.mac ?? '';
-    for (let i = 0; i < rawMac.length; i += 2) {
-      macParts.push(rawMac.substr(i, 2));
-    }
-    const mac = macParts.join(':').toLowerCase();
-
-    if (macToIP[mac] === rinfo.address) {
-      return;  // already seen this one at this address
-    }
-
-    console.debug('found daikin AC device', mac, 'at', rinfo.address);
-    macToIP[mac] = rinfo.address;
+    foundDevice(formatMac(values.mac ?? ''), rinfo.address);
   });
 
-  const broadcastPayload = Buffer.from('DAIKIN_UDP/common/basic_info', 'utf-8');
+  discoverySocket = sock;
+  lastBurstAt = -Infinity;
+  await discoveryBurst();
+  success();
 
   for (;;) {
-    const bytes = await new Promise((resolve, reject) => {
-      sock.send(broadcastPayload, 30050, '255.255.255.255', (err, bytes) => {
-        if (err) {
-          reject(err);
-        } else {
-          resolve(bytes);
-        }
-      });
-    });
-    success();
-
-    if (bytes !== broadcastPayload.length) {
-      throw new Error(`broadcast payload could not be sent`);
-    }
     const when = (120 + Math.random() * 60) * 1000;
     console.info('daikin broadcast ok, retry in', (when / 1000).toFixed(1) + 'sec');
     await sleep(when);
+
+    await sendDiscovery();
+    success();
   }
 }
 
 
+// Check last run's addresses right away; they'll usually still be right.
+for (const mac in cachedIPs) {
+  probe(mac, cachedIPs[mac]).then((ok) => ok && !macToIP[mac] && foundDevice(mac, cachedIPs[mac]));
+}
+
 runTask('daikin-broadcast', broadcastTask);
 
 
-async function getValues(mac, type) {
-  const ip = macToIP[mac];
+/**
+ * @param {string} mac
+ * @return {Promise<string>} IP of the device
+ */
+async function lookupIP(mac) {
+  let ip = macToIP[mac];
+  if (ip) {
+    return ip;
+  }
+
+  const cached = cachedIPs[mac];
+  if (cached && await probe(mac, cached)) {
+    foundDevice(mac, cached);
+    return cached;
+  }
+
+  const waiters = discoveryWaiters.get(mac) ?? new Set();
+  discoveryWaiters.set(mac, waiters);
+
+  /** @type {() => void} */
+  let waiter = () => {};
+  /** @type {Promise<void>} */
+  const found = new Promise((resolve) => {
+    waiter = resolve;
+    waiters.add(resolve);
+  });
+  discoveryBurst().catch((err) => console.warn('daikin discovery failed', err));
+  await Promise.race([found, sleep(DISCOVERY_WAIT_MS)]);
+
+  // Timed out waiters would otherwise pile up for a unit that never answers.
+  waiters.delete(waiter);
+  if (!waiters.size && discoveryWaiters.get(mac) === waiters) {
+    discoveryWaiters.delete(mac);
+  }
+
+  ip = macToIP[mac];
   if (!ip) {
     throw new SmartHomeError('deviceNotFound', `missing IP for ${mac}`);
   }
-  const response = await fetch(`http://${ip}/aircon/get_${type}_info`);
-  return parseValues(await response.text());
+  return ip;
+}
+
+
+async function getValues(mac, type) {
+  const ip = await lookupIP(mac);
+  try {
+    const response = await fetch(`http://${ip}/aircon/get_${type}_info`, {agent, timeout: FETCH_TIMEOUT_MS});
+    return parseValues(await response.text());
+  } catch (e) {
+    // It might have moved. Find it again for next time.
+    forgetDevice(mac);
+    discoveryBurst().catch((err) => console.warn('daikin discovery failed', err));
+    throw e;
+  }
 }
 
 
 export class DaikinAC extends Device {
   #mac;
 
+  /** @type {types.DeviceState?} */
+  #state = null;
+  #stateAt = -Infinity;
+
+  /** @type {Promise<types.DeviceState>?} */
+  #pending = null;
+
   /**
    * @param {string} mac
    * @param {string} ip
@@ -137,10 +336,61 @@ export class DaikinAC extends Device {
     if (ip) {
       console.warn('override mac to ip', mac, ip);
       macToIP[mac] = ip;
+      staticIPs.add(mac);
     }
+
+    runTask(`daikin-refresh-${mac}`, async (success) => {
+      for (;;) {
+        await sleep(STATE_REFRESH_MS * (Math.random() + 0.5));
+        if (performance.now() - this.#stateAt < STATE_REFRESH_MS || !macToIP[mac]) {
+          continue;
+        }
+        try {
+          await this.#refresh();
+          success();
+        } catch (e) {
+          // state() will report this if anyone asks
+        }
+      }
+    });
   }
 
+  /**
+   * @return {Promise<types.DeviceState>}
+   */
   async state() {
+    if (this.#state && performance.now() - this.#stateAt <= STATE_STALE_MS) {
+      return this.#state;
+    }
+    return this.#refresh();
+  }
+
+  /**
+   * Fetches state from the unit, sharing any fetch already in flight. Reports changes.
+   *
+   * @return {Promise<types.DeviceState>}
+   */
+  #refresh() {
+    if (!this.#pending) {
+      this.#pending = this.#fetchState().then((state) => {
+        const changed = JSON.stringify(state) !== JSON.stringify(this.#state);
+        this.#state = state;
+        this.#stateAt = performance.now();
+        if (changed) {
+          notifyChange(this.#mac, state);
+        }
+        return state;
+      }).finally(() => {
+        this.#pending = null;
+      });
+    }
+    return this.#pending;
+  }
+
+  /**
+   * @return {Promise<types.DeviceState>}
+   */
+  async #fetchState() {
     const sensorValuesPromise = getValues(this.#mac, 'sensor');
     const controlValuesPromise = getValues(this.#mac, 'control');
 
@@ -213,8 +463,10 @@ export class DaikinAC extends Device {
    * @return {Promise<types.DeviceState>}
    */
   async exec(exec) {
-    const ip = macToIP[this.#mac];
-    if (!ip) {
+    let ip;
+    try {
+      ip = await lookupIP(this.#mac);
+    } catch (e) {
       return {online: false};
     }
     const sourceValues = await getValues(this.#mac, 'control');
@@ -292,7 +544,7 @@ export class DaikinAC extends Device {
     const body = Object.keys(values).map((key) => `${key}=${values[key]}`).join('&');
     const headers = {'Content-Type': 'application/x-www-form-urlencoded'};
     const args = {method: 'POST', body, headers};
-    const response = await fetch(`http://${ip}/aircon/set_control_info`, args);
+    const response = await fetch(`http://${ip}/aircon/set_control_info`, {...args, agent});
 
     const responseValues = parseValues(await response.text());
     if (responseValues.ret !== 'OK') {
@@ -300,6 +552,8 @@ export class DaikinAC extends Device {
       throw new SmartHomeError('transientError', `got non-OK response: ${responseValues.ret}`);
     }
 
-    return this.state();
+    // The cache is out of date now. Wait for any fetch that started before our change.
+    await this.#pending?.catch(() => {});
+    return this.#refresh();
   }
 }